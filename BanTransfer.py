@@ -0,0 +1,185 @@
+# Command line tool for bulk moving ban lists in and out of the ScamGuard database.
+#
+# Usage:
+#   python BanTransfer.py import bans.csv --assigner-id 1234 --assigner-name "Import"
+#   python BanTransfer.py export bans.jsonl
+#
+# Both directions stream their rows in fixed size chunks, so memory use stays flat no matter how large the list is.
+from Logger import Logger, LogLevel
+from BotSetup import SetupDatabases, CreateDatabaseEngine
+from BotDatabaseSchema import Ban
+from sqlalchemy import Engine, Connection, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, timezone
+from contextlib import nullcontext
+from typing import ContextManager, Iterator, TextIO
+import argparse, csv, json, sys, time
+
+BanFields:list[str] = ["discord_user_id", "assigner_discord_user_id", "assigner_discord_user_name", "created_at", "evidence_thread"]
+DefaultChunkSize:int = 10000
+
+class TransferStats():
+  def __init__(self):
+    self.StartTime:float = time.perf_counter()
+    self.Read:int = 0
+    self.Written:int = 0
+    self.Duplicates:int = 0
+    self.Invalid:int = 0
+
+  def GetRate(self) -> float:
+    Elapsed:float = max(time.perf_counter() - self.StartTime, 1e-9)
+    return self.Read / Elapsed
+
+  def __str__(self) -> str:
+    return f"read {self.Read}, written {self.Written}, duplicates {self.Duplicates}, invalid {self.Invalid} in {time.perf_counter() - self.StartTime:.2f}s ({self.GetRate():.0f} rows/sec)"
+
+def GetFormat(FileName:str, Format:str|None) -> str:
+  if (Format is not None):
+    return Format
+  if (FileName.endswith(".jsonl") or FileName.endswith(".ndjson")):
+    return "jsonl"
+  return "csv"
+
+# Only files we opened get closed, stdin/stdout are left open for the caller
+def OpenFile(FileName:str, Mode:str) -> ContextManager[TextIO]:
+  if (FileName == "-"):
+    return nullcontext(sys.stdin if Mode == "r" else sys.stdout)
+  return open(FileName, Mode, newline="", encoding="utf-8")
+
+def ReadRows(File:TextIO, Format:str) -> Iterator[dict]:
+  if (Format == "jsonl"):
+    for Line in File:
+      Line = Line.strip()
+      if (len(Line) == 0):
+        continue
+      try:
+        yield json.loads(Line)
+      except json.JSONDecodeError:
+        # Hand back an empty row so that it is counted as invalid
+        yield {}
+  else:
+    for Row in csv.DictReader(File):
+      yield Row
+
+def ParseTimestamp(Value) -> datetime|None:
+  if (Value is None or Value == ""):
+    return None
+  # Stored timestamps are naive UTC, matching the CURRENT_TIMESTAMP server default
+  Timestamp:datetime = datetime.fromisoformat(str(Value).replace("Z", "+00:00"))
+  if (Timestamp.tzinfo is not None):
+    Timestamp = Timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+  return Timestamp
+
+def ToBanRow(Row:dict, AssignerId:str, AssignerName:str, ImportTime:datetime) -> dict|None:
+  try:
+    UserId:int = int(Row["discord_user_id"])
+    EvidenceThread = Row.get("evidence_thread")
+    # Every row carries the same keys so the chunk can go through a single executemany
+    return {
+      "discord_user_id": UserId,
+      "assigner_discord_user_id": str(Row.get("assigner_discord_user_id") or AssignerId),
+      "assigner_discord_user_name": str(Row.get("assigner_discord_user_name") or AssignerName)[:32],
+      "created_at": ParseTimestamp(Row.get("created_at")) or ImportTime,
+      "evidence_thread": int(EvidenceThread) if EvidenceThread not in (None, "") else None,
+    }
+  except (KeyError, ValueError, TypeError):
+    return None
+
+def WriteChunk(Conn:Connection, Chunk:dict[int, dict], Stats:TransferStats):
+  # Users that are already banned are skipped by the unique index, the seq and stat counter triggers fire for the rest
+  Statement = sqlite_insert(Ban).on_conflict_do_nothing(index_elements=[Ban.discord_user_id])
+  with Conn.begin():
+    Result = Conn.execute(Statement, list(Chunk.values()))
+  Stats.Written += Result.rowcount
+  Stats.Duplicates += len(Chunk) - Result.rowcount
+  Logger.Log(LogLevel.Verbose, f"Import progress: {Stats}")
+
+def ImportBans(Engine:Engine, FileName:str, Format:str, ChunkSize:int, AssignerId:str, AssignerName:str) -> TransferStats:
+  Stats:TransferStats = TransferStats()
+  ImportTime:datetime = datetime.now(timezone.utc).replace(tzinfo=None)
+  # Keyed by user id so that duplicates inside a chunk collapse before they hit the database
+  Chunk:dict[int, dict] = {}
+
+  with OpenFile(FileName, "r") as File, Engine.connect() as Conn:
+    for Row in ReadRows(File, Format):
+      Stats.Read += 1
+      BanRow = ToBanRow(Row, AssignerId, AssignerName, ImportTime)
+      if (BanRow is None):
+        Stats.Invalid += 1
+        Logger.Log(LogLevel.Warn, f"Skipping invalid row #{Stats.Read}: {Row}")
+        continue
+
+      if (BanRow["discord_user_id"] in Chunk):
+        Stats.Duplicates += 1
+        continue
+
+      Chunk[BanRow["discord_user_id"]] = BanRow
+      if (len(Chunk) >= ChunkSize):
+        WriteChunk(Conn, Chunk, Stats)
+        Chunk.clear()
+
+    if (len(Chunk) > 0):
+      WriteChunk(Conn, Chunk, Stats)
+
+  return Stats
+
+def ExportBans(Engine:Engine, FileName:str, Format:str, ChunkSize:int) -> TransferStats:
+  Stats:TransferStats = TransferStats()
+  Columns = [getattr(Ban, Field) for Field in BanFields]
+  LastSeq:int = 0
+
+  with OpenFile(FileName, "w") as File, Engine.connect() as Conn:
+    Writer = None
+    if (Format == "csv"):
+      Writer = csv.DictWriter(File, fieldnames=BanFields)
+      Writer.writeheader()
+
+    # Walk the ban sequence in pages, so that no read transaction stays open for the entire export
+    while (True):
+      with Conn.begin():
+        Page = Conn.execute(select(Ban.seq, *Columns).where(Ban.seq > LastSeq).order_by(Ban.seq).limit(ChunkSize)).all()
+      if (len(Page) == 0):
+        break
+
+      for Row in Page:
+        Entry:dict = {Field: getattr(Row, Field) for Field in BanFields}
+        if (Entry["created_at"] is not None):
+          Entry["created_at"] = Entry["created_at"].isoformat(sep=" ")
+        if (Writer is not None):
+          Writer.writerow(Entry)
+        else:
+          File.write(json.dumps(Entry) + "\n")
+
+      Stats.Read += len(Page)
+      Stats.Written += len(Page)
+      LastSeq = Page[-1].seq
+      Logger.Log(LogLevel.Verbose, f"Export progress: {Stats}")
+
+  return Stats
+
+if __name__ == '__main__':
+  Parser = argparse.ArgumentParser(description="Stream ban lists into or out of the ScamGuard database")
+  Parser.add_argument("direction", choices=["import", "export"])
+  Parser.add_argument("file", help="CSV or JSONL file to read from or write to, - for stdin/stdout")
+  Parser.add_argument("--format", choices=["csv", "jsonl"], default=None, help="defaults to the file extension, otherwise csv")
+  Parser.add_argument("--chunk-size", type=int, default=DefaultChunkSize, help="rows per transaction")
+  Parser.add_argument("--assigner-id", default="0", help="assigner id for imported rows that do not have one")
+  Parser.add_argument("--assigner-name", default="BanTransfer", help="assigner name for imported rows that do not have one")
+  Args = Parser.parse_args()
+
+  # Make sure the schema (and the seq/counter triggers) are up to date before touching the bans table
+  SetupDatabases()
+  TransferEngine:Engine = CreateDatabaseEngine()
+  Format:str = GetFormat(Args.file, Args.format)
+  ChunkSize:int = max(Args.chunk_size, 1)
+
+  if (Args.direction == "import"):
+    Result = ImportBans(TransferEngine, Args.file, Format, ChunkSize, Args.assigner_id, Args.assigner_name)
+    Logger.Log(LogLevel.Notice, f"Import finished: {Result}")
+    if (Result.Written > 0):
+      Logger.Log(LogLevel.Notice, "New bans are applied to activated servers the next time they are reprocessed")
+  else:
+    Result = ExportBans(TransferEngine, Args.file, Format, ChunkSize)
+    Logger.Log(LogLevel.Notice, f"Export finished: {Result}")
+
+  TransferEngine.dispose()
\ No newline at end of file
@@ -11,6 +11,7 @@ from BotConnections import RelayClient
 import discord, asyncio, json, aiohttp, io
 from discord.ext import tasks
 from BotDatabase import DatabaseDriver
+from BotDatabaseAsync import AsyncDatabaseDriver
 from queue import SimpleQueue
 from BotCommands import GlobalScamCommands
 from CommandHelpers import CommandErrorHandler
@@ -22,6 +23,8 @@ __all__ = ["DiscordBot"]
 
 ConfigData:Config=Config()
 Messages:TextLibrary = TextLibrary()
+# Results that leave a ban as applied as it will ever be in a server, these get written to the ban ledger
+LedgerResults:tuple[BanResult, ...] = (BanResult.Processed, BanResult.InvalidUser, BanResult.ServerOwner)
 
 class DiscordBot(discord.Client):
   # Discord Channel that serves for notifications on bot activity/errors/warnings
@@ -35,7 +38,15 @@ class DiscordBot(discord.Client):
   BotID:int = -1
 
   def __init__(self, RelayFileLocation, AssignedBotID:int=-1):
-    self.Database:DatabaseDriver = DatabaseDriver()
+    # Sub-instances can keep their query traffic on a read-only handle, their writes still go through the read-write one
+    self.Database:DatabaseDriver = DatabaseDriver(ReadOnlyQueries=(AssignedBotID != ConfigData["ControlBotID"] and ConfigData["SubInstanceReadOnlyQueries"]))
+    # Coroutines should prefer this, it runs the database calls off of the event loop
+    self.AsyncDatabase:AsyncDatabaseDriver = AsyncDatabaseDriver(self.Database)
+    # Event loop lag tracking, in seconds
+    self.LastLoopLagCheck:float = 0.0
+    self.NumLoopLagSamples:int = 0
+    self.TotalLoopLag:float = 0.0
+    self.MaxLoopLag:float = 0.0
     # This gets set properly down below.
     self.ClientHandler:RelayClient = None # pyright: ignore[reportAttributeAccessIssue]
     # initialize other values
@@ -78,11 +89,14 @@ class DiscordBot(discord.Client):
     self.ClientHandler.RegisterFunction(RelayMessageType.BanUser, self.BanUser)
     self.ClientHandler.RegisterFunction(RelayMessageType.UnbanUser, self.UnbanUser)
     self.ClientHandler.RegisterFunction(RelayMessageType.Kick, self.KickUser)
+    self.ClientHandler.RegisterFunction(RelayMessageType.ActionBatch, self.ProcessActionBatch)
     self.ClientHandler.RegisterFunction(RelayMessageType.ReprocessInstance, self.ScheduleReprocessInstance)
     self.ClientHandler.RegisterFunction(RelayMessageType.ReprocessBans, self.ScheduleReprocessBans)
     self.ClientHandler.RegisterFunction(RelayMessageType.LeaveServer, self.LeaveServer)
     self.ClientHandler.RegisterFunction(RelayMessageType.ProcessServerActivation, self.ProcessServerActivationForInstance)
     self.ClientHandler.RegisterFunction(RelayMessageType.Ping, self.PostPongMessage)
+    self.ClientHandler.RegisterFunction(RelayMessageType.DatabaseProfile, self.SendDatabaseProfile)
+    self.ClientHandler.RegisterFunction(RelayMessageType.DatabaseProfileReport, self.PostDatabaseProfile)
       
   async def setup_hook(self):
     CommandControlServer=discord.Object(id=ConfigData["ControlServer"])
@@ -121,6 +135,8 @@ class DiscordBot(discord.Client):
     NewTask.add_done_callback(self.AsyncTasks.discard)
   
   ### Discord Tasks Handling ###
+  # Relay messages are normally handled by a reader callback the moment they arrive, this polling loop
+  # is only the fallback for event loops that can't watch sockets.
   @tasks.loop(seconds=0.5)
   async def HandleRelayMessages(self):
     await self.ClientHandler.RecvMessage()
@@ -129,6 +145,15 @@ class DiscordBot(discord.Client):
   async def BeforeClientRelay(self):
     await self.wait_until_ready()
     self.ClientHandler.SendHello()
+    
+  def StartRelayClient(self):
+    if (self.ClientHandler.IsEventDriven() or self.HandleRelayMessages.is_running()):
+      return
+    
+    if (self.ClientHandler.StartEventDriven()):
+      self.ClientHandler.SendHello()
+    else:
+      self.HandleRelayMessages.start()
   
   @tasks.loop(seconds=1)
   async def PostLogMessages(self):
@@ -143,6 +168,37 @@ class DiscordBot(discord.Client):
   @PostLogMessages.before_loop
   async def BeforePostLogMessages(self):
     await self.wait_until_ready()
+    
+  # Other processes share the database file, pick up their ban and server writes so our caches stay warm but never stale
+  @tasks.loop(seconds=2)
+  async def SyncDatabaseCaches(self):
+    await self.AsyncDatabase.SyncExternalChanges()
+    
+  # Measures how late the event loop wakes us up, anything blocking the loop shows up here.
+  @tasks.loop(seconds=1)
+  async def MonitorEventLoopLag(self):
+    CurrentTime:float = asyncio.get_running_loop().time()
+    if (self.LastLoopLagCheck > 0.0):
+      LoopLag:float = max(0.0, CurrentTime - self.LastLoopLagCheck - self.MonitorEventLoopLag.seconds)
+      self.NumLoopLagSamples += 1
+      self.TotalLoopLag += LoopLag
+      self.MaxLoopLag = max(self.MaxLoopLag, LoopLag)
+    self.LastLoopLagCheck = CurrentTime
+    
+    # Print out a summary every 5 minutes
+    if (self.NumLoopLagSamples >= 300):
+      # Calls made directly on the event loop share its session, so recycle it here as well
+      self.Database.EndSession()
+      Logger.Log(LogLevel.Log, f"Bot #{self.BotID} {self.GetEventLoopLagStats()} | {self.AsyncDatabase.GetStats()} | {self.Database.GetLockStats()} | {self.Database.GetSessionStats()}")
+      self.NumLoopLagSamples = 0
+      self.TotalLoopLag = self.MaxLoopLag = 0.0
+      self.AsyncDatabase.ResetStats()
+      
+  def GetEventLoopLagStats(self) -> str:
+    if (self.NumLoopLagSamples == 0):
+      return "Event Loop Lag: no samples"
+    AvgLagMS:float = (self.TotalLoopLag / self.NumLoopLagSamples) * 1000.0
+    return f"Event Loop Lag: avg {AvgLagMS:.2f}ms max {self.MaxLoopLag * 1000.0:.2f}ms"
       
   ### Config Handling ###
   def ProcessConfig(self, ShouldReload:bool):
@@ -271,7 +327,7 @@ class DiscordBot(discord.Client):
       return
     
     Logger.Log(LogLevel.Notice, f"Activating ServerID {ServerID} from user {UserID}")
-    self.Database.SetBotActivationForOwner([ServerID], True, self.BotID, ActivatorId=UserID)
+    await self.AsyncDatabase.SetBotActivationForOwner([ServerID], True, self.BotID, ActivatorId=UserID)
     self.AddAsyncTask(self.ReprocessBans(ServerID))
     
   def ProcessServerActivationForInstance(self, UserId:int, ServerId:int):
@@ -294,15 +350,20 @@ class DiscordBot(discord.Client):
     if (self.NotificationChannel is not None):
       Logger.SetNotificationCallback(self.PostNotification)
 
-    self.Database.ReconcileServers(self.guilds, self.BotID)
+    await self.AsyncDatabase.ReconcileServers(list(self.guilds), self.BotID)
     
     # If our task is not already running, start it. 
     # We do this check because on_ready could be called again on reconnections.
-    if (not self.HandleRelayMessages.is_running()):
-      self.HandleRelayMessages.start()
+    self.StartRelayClient()
       
     if (not self.PostLogMessages.is_running()):
       self.PostLogMessages.start()
+      
+    if (not self.MonitorEventLoopLag.is_running()):
+      self.MonitorEventLoopLag.start()
+      
+    if (not self.SyncDatabaseCaches.is_running()):
+      self.SyncDatabaseCaches.start()
 
     Logger.Log(LogLevel.Notice, f"Bot (#{self.BotID}) has started! Is Development? {ConfigData.IsDevelopment()}")
   
@@ -316,7 +377,7 @@ class DiscordBot(discord.Client):
       return
     
     if (PriorUpdate.owner_id != NewOwnerId):
-      self.Database.SetNewServerOwner(NewUpdate.id, NewOwnerId, self.BotID)
+      await self.AsyncDatabase.SetNewServerOwner(NewUpdate.id, NewOwnerId, self.BotID)
       Logger.Log(LogLevel.Notice, f"Detected that the server {self.GetServerInfoStr(PriorUpdate)} is now owned by {NewOwnerId}")
       
   async def on_guild_join(self, server:discord.Guild):
@@ -325,13 +386,13 @@ class DiscordBot(discord.Client):
       OwnerName = server.owner.display_name
       
     # Prevent ourselves from being added to a server we are already in.
-    if (self.Database.IsInServer(server.id)):
+    if (await self.AsyncDatabase.IsInServer(server.id)):
       Logger.Log(LogLevel.Notice, f"Bot #{self.BotID} was attempted to be added to server {self.GetServerInfoStr(server)} but already in there")
       # TODO: Print a message to the user?
       await server.leave()
       return
 
-    self.Database.SetBotActivationForOwner([server.id], False, self.BotID, OwnerId=server.owner_id or 0)
+    await self.AsyncDatabase.SetBotActivationForOwner([server.id], False, self.BotID, OwnerId=server.owner_id or 0)
     if (ConfigData["PostWelcomeMessages"]):
       self.AddAsyncTask(self.PostFirstTimeMessage(server.id))
     Logger.Log(LogLevel.Notice, f"Bot (#{self.BotID}) has joined server {self.GetServerInfoStr(server)} of owner {OwnerName}[{server.owner_id}]")
@@ -341,7 +402,7 @@ class DiscordBot(discord.Client):
     if (server.owner is not None):
       OwnerName = server.owner.display_name
     
-    self.Database.RemoveServerEntry(server.id, self.BotID)
+    await self.AsyncDatabase.RemoveServerEntry(server.id, self.BotID)
     Logger.Log(LogLevel.Notice, f"Bot (#{self.BotID}) has been removed from server {self.GetServerInfoStr(server)} of owner {OwnerName}[{server.owner_id}]")
     
   ### Report Handling ###
@@ -519,7 +580,7 @@ Failed Copied Evidence Links:
       Logger.Log(LogLevel.Notice, "Announcement channel is None, cannot manage webhooks!")
       return
     
-    ChannelID:int|None = self.Database.GetChannelIdForServer(ServerId)
+    ChannelID:int|None = await self.AsyncDatabase.GetChannelIdForServer(ServerId)
     if (ChannelID is None):
       Logger.Log(LogLevel.Warn, f"Could not install webhook for server {ServerId}, the ChannelID was None")
       return
@@ -553,7 +614,7 @@ Failed Copied Evidence Links:
       Logger.Log(LogLevel.Notice, "Announcement channel is None, cannot manage webhooks!")
       return
     
-    ChannelID:int|None = self.Database.GetChannelIdForServer(ServerId)
+    ChannelID:int|None = await self.AsyncDatabase.GetChannelIdForServer(ServerId)
     if (ChannelID is None):
       Logger.Log(LogLevel.Warn, f"Could not uninstall webhook for server {ServerId}, the ChannelID was None")
       return
@@ -597,12 +658,19 @@ Failed Copied Evidence Links:
   def PostPongMessage(self):
     Logger.Log(LogLevel.Notice, "I have been pinged!")
     
+  def SendDatabaseProfile(self, Reset:bool):
+    self.ClientHandler.SendDatabaseProfileReport(self.Database.GetProfileReport(Reset))
+    
+  def PostDatabaseProfile(self, InstanceId:int, Report:str):
+    # Keep it within a single discord message
+    self.LoggingMessageQueue.put(f"Instance #{InstanceId} ```{Report[:1900]}```")
+    
   async def PostNotification(self, Message:str):
     self.LoggingMessageQueue.put(Message)
     
   async def ApplySettings(self, NewSettings):
     ServerID:int = NewSettings.GetServerID()
-    self.Database.SetFromServerSettings(ServerID, NewSettings)
+    await self.AsyncDatabase.SetFromServerSettings(ServerID, NewSettings)
     if (NewSettings.WantsWebhooks):
       await self.InstallWebhook(ServerID)
     else:
@@ -646,7 +714,7 @@ Failed Copied Evidence Links:
     return ResponseEmbed
     
   async def CreateBanEmbed(self, TargetId:int) -> discord.Embed:
-    BanData = self.Database.GetBanInfo(TargetId)
+    BanData = await self.AsyncDatabase.GetBanInfo(TargetId)
     UserBanned:bool = (BanData is not None)
     User = await self.LookupUser(TargetId)
     HasUserData:bool = (User is not None)
@@ -686,12 +754,13 @@ Failed Copied Evidence Links:
     return UserData
 
   ### Ban Handling ###        
-  async def ReprocessBans(self, ServerId:int, LastActions:int=0, HandlingCooldown:bool=False) -> BanResult:
+  # Unless Force is set, only the bans that are missing from the server's ban ledger are sent
+  async def ReprocessBans(self, ServerId:int, LastActions:int=0, HandlingCooldown:bool=False, Force:bool=False) -> BanResult:
     Server:discord.Guild|None = self.get_guild(ServerId)
     if (Server is None):
       Logger.Log(LogLevel.Error, f"Could not look up the server {ServerId} while reprocessing bans")
       if (HandlingCooldown):
-        self.Database.SetProcessingServerCooldown(ServerId, False)
+        await self.AsyncDatabase.SetProcessingServerCooldown(ServerId, False)
       return BanResult.Error
     
     ServerInfoStr:str = self.GetServerInfoStr(Server)
@@ -699,19 +768,25 @@ Failed Copied Evidence Links:
     Logger.Log(LogLevel.Log, f"Attempting to import ban data to {ServerInfoStr}")
     NumBans:int = 0
     NumFailures:int = 0
-    RawBanQuery = self.Database.GetAllBans(LastActions)
-    CurrentNumBans:int = len(RawBanQuery)
     ActionsAppliedThisLoop:int = 0
     DoesSleep:bool = ConfigData["UseSleep"]
     DoesHaltOnFailures:bool = ConfigData["MaxBanFailures"] > 0
     DoesHaltOnMaxBans:bool = ConfigData["MaxBulkImports"] > 0
     
-    # resort the ban query list if we are handling cooldowns
-    BanQueryResult = RawBanQuery
+    # Cooldowns resume right after the last ban that was applied to the server
+    StartSeq:int = 0
     if (HandlingCooldown):
-      BanQueryResult = sorted(RawBanQuery, key=lambda ban: ban.created_at)
+      StartSeq = await self.AsyncDatabase.GetServerCooldownSeq(ServerId)
+    else:
+      StartSeq = await self.AsyncDatabase.GetBanSeqForLastActions(LastActions)
+    LastAppliedSeq:int = StartSeq
+    MissingFromServer:int|None = None if Force else ServerId
+    CurrentNumBans:int = await self.AsyncDatabase.GetNumBansAfter(StartSeq, MissingFromServer)
+    # The run of bans that have landed so far, written to the ledger together
+    RunFirstSeq:int = 0
+    RunLastSeq:int = 0
     
-    for Ban in BanQueryResult:
+    async for Ban in self.AsyncDatabase.IterateBans(StartSeq, MissingFromServer=MissingFromServer):
       if (DoesSleep):
         # Put in sleep functionality on this loop, as it could be heavy
         if (ActionsAppliedThisLoop >= ConfigData["ActionsPerTick"]):
@@ -730,10 +805,17 @@ Failed Copied Evidence Links:
         BanReturn = BanResult.BansExceeded
         break
 
-      UserId:int = int(Ban.discord_user_id)
+      UserId:int = Ban.discord_user_id
       UserToBan:discord.User = cast(discord.User, discord.Object(UserId))
       BanResponse = await self.PerformActionOnServer(Server, UserToBan, 
                                f"User banned by {Ban.assigner_discord_user_name}", ModerationAction.Ban)
+      if (BanResponse[0] or BanResponse[1] in LedgerResults):
+        RunFirstSeq = RunFirstSeq or Ban.seq
+        RunLastSeq = Ban.seq
+      elif (RunFirstSeq > 0):
+        await self.AsyncDatabase.RecordAppliedBans([ServerId], RunFirstSeq, RunLastSeq)
+        RunFirstSeq = 0
+      
       # See if the ban did go through.
       if (BanResponse[0] == False):
         NumFailures += 1
@@ -754,114 +836,139 @@ Failed Copied Evidence Links:
             break
       else:
         NumBans += 1
+      LastAppliedSeq = Ban.seq
+    
+    if (RunFirstSeq > 0):
+      await self.AsyncDatabase.RecordAppliedBans([ServerId], RunFirstSeq, RunLastSeq)
     
     # If this is being handled by a server reprocessing, then make sure to update the db properly
     if (HandlingCooldown):
-      CurrentNumBans = self.Database.GetNumBans()
       # Remove the server from the cooldown table ONLY if they have processed all the bans successfully
       if (BanReturn == BanResult.Processed):
-        self.Database.RemoveServerCooldown(ServerId)
+        await self.AsyncDatabase.RemoveServerCooldown(ServerId)
         Logger.Log(LogLevel.Notice, f"All delayed bans have been processed for {ServerInfoStr}")
-        NumBans = CurrentNumBans
       # Otherwise if we're already in cooldown (other error occurred), or we have exceeded our bans (i.e. first time exceed)
       # then we should update our current server cooldown information
-      elif (BanReturn == BanResult.BansExceeded or self.Database.IsServerInCooldown(ServerId)):
-        NewBanPos:int = self.Database.UpdateServerCooldown(ServerId, NumBans)
-        Logger.Log(LogLevel.Warn, f"{ServerInfoStr} had bans exceeded again, will continue from {NewBanPos}")
-        # Make the debug print look nice
-        NumBans = NewBanPos
+      elif (BanReturn == BanResult.BansExceeded or await self.AsyncDatabase.IsServerInCooldown(ServerId)):
+        NewBanSeq:int = await self.AsyncDatabase.UpdateServerCooldown(ServerId, LastAppliedSeq)
+        Logger.Log(LogLevel.Warn, f"{ServerInfoStr} had bans exceeded again, will continue after ban #{NewBanSeq}")
 
     # If we are not processing server cooldowns and we encounter this error, and we're not in the db for this,
     # then add us to the db
-    elif (BanReturn == BanResult.BansExceeded and not self.Database.IsServerInCooldown(ServerId)):
-      NewBanPos:int = self.Database.UpdateServerCooldown(ServerId, NumBans)
-      Logger.Log(LogLevel.Warn, f"Bans Exceeded. Pushing {ServerInfoStr} to continue processing in the future at {NewBanPos}")
+    elif (BanReturn == BanResult.BansExceeded and not await self.AsyncDatabase.IsServerInCooldown(ServerId)):
+      NewBanSeq:int = await self.AsyncDatabase.UpdateServerCooldown(ServerId, LastAppliedSeq)
+      Logger.Log(LogLevel.Warn, f"Bans Exceeded. Pushing {ServerInfoStr} to continue processing in the future after ban #{NewBanSeq}")
 
     Logger.Log(LogLevel.Notice, f"Processed {NumBans}/{CurrentNumBans} bans for {ServerInfoStr}!")
     return BanReturn
   
   async def ReprocessInstance(self, LastActions:int):
-    BanQueryResult = self.Database.GetAllBans(LastActions)
-    NumBans:int = self.Database.GetNumBans() - LastActions
-    Count:int = 0
-    for Ban in BanQueryResult:
-      UserId:int = int(Ban.discord_user_id)
-      AuthorizerName:str = Ban.assigner_discord_user_name
-      BanNumber:int = NumBans + Count
-      await self.ProcessActionOnUser(UserId, AuthorizerName, ModerationAction.Ban, BanNumber)
-      Count += 1
+    StartSeq:int = await self.AsyncDatabase.GetBanSeqForLastActions(LastActions)
+    async for Ban in self.AsyncDatabase.IterateBans(StartSeq):
+      await self.ProcessActionOnUser(Ban.discord_user_id, Ban.assigner_discord_user_name, ModerationAction.Ban, Ban.seq)
   
   def ScheduleReprocessInstance(self, LastActions:int):
     self.AddAsyncTask(self.ReprocessInstance(LastActions))
   
-  def ScheduleReprocessBans(self, ServerId:int, LastActions:int=0, HandlingCooldown:bool=False):
-    self.AddAsyncTask(self.ReprocessBans(ServerId, LastActions, HandlingCooldown))
+  def ScheduleReprocessBans(self, ServerId:int, LastActions:int=0, HandlingCooldown:bool=False, Force:bool=False):
+    self.AddAsyncTask(self.ReprocessBans(ServerId, LastActions, HandlingCooldown, Force))
     
   def KickUser(self, TargetId:int, AuthName:str):
     self.AddAsyncTask(self.ProcessActionOnUser(TargetId, AuthName, ModerationAction.Kick))
     
   def BanUser(self, TargetId:int, AuthName:str):
+    self.Database.UpdateBanIndex(TargetId, True)
     self.AddAsyncTask(self.ProcessActionOnUser(TargetId, AuthName, ModerationAction.Ban))
     
   def UnbanUser(self, TargetId:int, AuthName:str):
+    self.Database.UpdateBanIndex(TargetId, False)
     self.AddAsyncTask(self.ProcessActionOnUser(TargetId, AuthName, ModerationAction.Unban))
     
+  def ProcessActionBatch(self, TargetIds:list[int], AuthName:str, Action:ModerationAction):
+    if (Action == ModerationAction.Ban or Action == ModerationAction.Unban):
+      for TargetId in TargetIds:
+        self.Database.UpdateBanIndex(TargetId, Action == ModerationAction.Ban)
+    self.AddAsyncTask(self.ProcessActionOnUsers(TargetIds, AuthName, Action))
+    
   # Handles pushing the ban/unban to every server we are in
-  async def ProcessActionOnUser(self, TargetId:int, AuthorizerName:str, Action:ModerationAction, BanNumOverride:int=-1):
-    NumServersPerformed:int = 0
+  async def ProcessActionOnUser(self, TargetId:int, AuthorizerName:str, Action:ModerationAction, BanSeq:int=-1):
+    await self.ProcessActionOnUsers([TargetId], AuthorizerName, Action, {TargetId: BanSeq})
+    
+  # Same as above for many users at once (in ban order), the server list is only looked up and walked once
+  async def ProcessActionOnUsers(self, TargetIds:list[int], AuthorizerName:str, Action:ModerationAction, BanSeqs:dict[int, int]|None=None):
     ActionsAppliedThisLoop:int = 0
     DoesSleep:bool = ConfigData["UseSleep"]
-    # Used to get an estimation of what this ban number would be. It is not accurate in heavy ban waves.
-    BanNumber:int = self.Database.GetNumBans() if BanNumOverride == -1 else BanNumOverride
-    UserToWorkOn:discord.User = cast(discord.User, discord.Object(TargetId))
+    BanSeqs = BanSeqs or {}
     
     BanReason=f"Confirmed {str(Action)} by {AuthorizerName}"
-    AllServers = self.Database.GetAllActivatedServersForAction(self.BotID, Action)
+    AllServers:list[int] = await self.AsyncDatabase.GetAllActivatedServerIdsForAction(self.BotID, Action)
     NumServers:int = len(AllServers)
+    NumServersPerformed:dict[int, int] = {TargetId: 0 for TargetId in TargetIds}
+    # Servers each ban has landed in, for the ban ledger
+    LandedServers:dict[int, list[int]] = {TargetId: [] for TargetId in TargetIds}
+    # Users that discord says do not exist are dropped from the rest of the servers
+    UsersToWorkOn:list[int] = list(TargetIds)
     
     # Instead of going through all servers it's added to, choose all servers that are activated.
-    for ServerData in AllServers:
-      if (DoesSleep):
-        # Put in sleep functionality on this loop, as it could be heavy
-        if (ActionsAppliedThisLoop >= ConfigData["ActionsPerTick"]):
-          await asyncio.sleep(ConfigData["SleepAmount"])
-          ActionsAppliedThisLoop = 0
-        else:
-          ActionsAppliedThisLoop += 1
-
-      ServerId:int = int(ServerData.discord_server_id)
+    for ServerId in AllServers:
       DiscordServer = self.get_guild(ServerId)
-      if (DiscordServer is not None):
+      if (DiscordServer is None):
+        # TODO: Potentially remove the server from the list?
+        Logger.Log(LogLevel.Error, f"The server {ServerId} did not respond on a look up, does it still exist?")
+        continue
+      
+      for TargetId in list(UsersToWorkOn):
+        if (DoesSleep):
+          # Put in sleep functionality on this loop, as it could be heavy
+          if (ActionsAppliedThisLoop >= ConfigData["ActionsPerTick"]):
+            await asyncio.sleep(ConfigData["SleepAmount"])
+            ActionsAppliedThisLoop = 0
+          else:
+            ActionsAppliedThisLoop += 1
+        
+        UserToWorkOn:discord.User = cast(discord.User, discord.Object(TargetId))
         BanResultTuple = await self.PerformActionOnServer(DiscordServer, UserToWorkOn, BanReason, Action)
+        if (Action == ModerationAction.Ban and (BanResultTuple[0] or BanResultTuple[1] in LedgerResults)):
+          LandedServers[TargetId].append(ServerId)
+          
         if (BanResultTuple[0]):
           # Ban was successful, continue processing
-          NumServersPerformed += 1
-        else:
-          ResultFlag = BanResultTuple[1]
-          ServerStr:str = self.GetServerInfoStr(DiscordServer)
-          if (Action == ModerationAction.Ban):
-            if (ResultFlag == BanResult.InvalidUser):
-              Logger.Log(LogLevel.Warn, f"Got a ban result of invalid while trying to process ban for {TargetId}")
-              break
-            elif (ResultFlag == BanResult.ServerOwner):
-              Logger.Log(LogLevel.Error, f"Attempted to ban a server owner! {ServerStr} with user to work {UserToWorkOn.id} == {DiscordServer.owner_id}")
-              continue
-          elif (ResultFlag == BanResult.LostPermissions or ResultFlag == BanResult.Error or ResultFlag == BanResult.BansExceeded):
-            # Check if we should suppress the ban failure message, as the bot will automatically handle it later.
-            if (ResultFlag == BanResult.BansExceeded):
-              if (not self.Database.IsServerInCooldown(ServerId)):
-                Logger.Log(LogLevel.Notice, f"Server {ServerStr} hit ban quota on {BanNumber}, adding them to exhausted servers")
-                # This should be subtracted 1 so that we will retry this action from this ban forward
-                self.Database.UpdateServerCooldown(ServerId, BanNumber - 1)
-              continue
-            self.AddAsyncTask(self.PostBanFailureInformation(DiscordServer, TargetId, ResultFlag, Action))
-          elif (ResultFlag == BanResult.ServiceError):
-            self.AddAsyncTask(self.PerformActionOnServer(DiscordServer, UserToWorkOn, BanReason, Action, True))
-      else:
-        # TODO: Potentially remove the server from the list?
-        Logger.Log(LogLevel.Error, f"The server {ServerId} did not respond on a look up, does it still exist?")
+          NumServersPerformed[TargetId] += 1
+          continue
+        
+        ResultFlag = BanResultTuple[1]
+        ServerStr:str = self.GetServerInfoStr(DiscordServer)
+        if (Action == ModerationAction.Ban and ResultFlag == BanResult.InvalidUser):
+          Logger.Log(LogLevel.Warn, f"Got a ban result of invalid while trying to process ban for {TargetId}")
+          UsersToWorkOn.remove(TargetId)
+        elif (Action == ModerationAction.Ban and ResultFlag == BanResult.ServerOwner):
+          Logger.Log(LogLevel.Error, f"Attempted to ban a server owner! {ServerStr} with user to work {UserToWorkOn.id} == {DiscordServer.owner_id}")
+        elif (ResultFlag == BanResult.BansExceeded):
+          # No failure message for this one, the bot handles it on its own once the cooldown is up.
+          if (not await self.AsyncDatabase.IsServerInCooldown(ServerId)):
+            # Only looked up when needed, this is the exact position of the ban in the ban list.
+            # Users that are no longer banned (i.e. an unban) resume from the latest ban instead.
+            BanSeq:int = BanSeqs.get(TargetId, -1)
+            if (BanSeq == -1):
+              BanSeq = await self.AsyncDatabase.GetBanSeq(TargetId) or await self.AsyncDatabase.GetLastBanSeq()
+            Logger.Log(LogLevel.Notice, f"Server {ServerStr} hit ban quota on ban #{BanSeq}, adding them to exhausted servers")
+            # This should be subtracted 1 so that we will retry this action from this ban forward
+            await self.AsyncDatabase.UpdateServerCooldown(ServerId, BanSeq - 1)
+          # The rest of this batch would hit the same quota, the cooldown retries them later
+          break
+        elif (ResultFlag == BanResult.LostPermissions or ResultFlag == BanResult.Error):
+          self.AddAsyncTask(self.PostBanFailureInformation(DiscordServer, TargetId, ResultFlag, Action))
+        elif (ResultFlag == BanResult.ServiceError):
+          self.AddAsyncTask(self.PerformActionOnServer(DiscordServer, UserToWorkOn, BanReason, Action, True))
+
+    for TargetId in TargetIds:
+      if (len(LandedServers[TargetId]) > 0):
+        BanSeq = BanSeqs.get(TargetId, -1)
+        if (BanSeq == -1):
+          BanSeq = await self.AsyncDatabase.GetBanSeq(TargetId) or -1
+        await self.AsyncDatabase.RecordAppliedBans(LandedServers[TargetId], BanSeq, BanSeq)
 
-    Logger.Log(LogLevel.Notice, f"Action execution on {TargetId} performed in {NumServersPerformed}/{NumServers} servers")
+      Logger.Log(LogLevel.Notice, f"Action execution on {TargetId} performed in {NumServersPerformed[TargetId]}/{NumServers} servers")
     
   # Handles moderation actions an user in each individual server
   async def PerformActionOnServer(self, Server:discord.Guild, User:discord.Member|discord.User, Reason:str, Action:ModerationAction, ShouldWait:bool=False) -> tuple[bool, BanResult]:        
@@ -919,7 +1026,7 @@ Failed Copied Evidence Links:
     if (ConfigData["CanSendServerErrorMessages"] == False):
       return
     
-    ChannelIDToPost = self.Database.GetChannelIdForServer(Server.id)
+    ChannelIDToPost = await self.AsyncDatabase.GetChannelIdForServer(Server.id)
     if (ChannelIDToPost == None):
       return
     
@@ -2,9 +2,11 @@
 # via multiprocessing
 from Logger import Logger, LogLevel
 from multiprocessing.connection import Listener, Connection, Client, wait
-from BotEnums import RelayMessageType
+from BotEnums import RelayMessageType, ModerationAction
+from BotDatabaseAsync import AsyncDatabaseDriver
 from Config import Config
-import selectors, os, traceback
+from collections import deque
+import asyncio, selectors, os, struct, time, traceback
 from typing import cast
 
 __all__ = ["RelayMessage", "RelayServer", "RelayClient"]
@@ -17,6 +19,86 @@ def UseUnixSockets() -> bool:
     return True
   return False
 
+### Relay wire format ###
+# Relay messages cross the connections as compact binary frames rather than pickles.
+# Header: magic, wire version, message type, sender, destination and the number of data fields.
+# Each data field is a tag, a value kind and a value length followed by the value. Fields with a tag or kind
+# that this build does not know about are skipped, so newer instances can add fields without breaking older ones.
+# The wire version only needs to go up if the header itself changes.
+RelayWireVersion:int = 1
+RelayFrameMagic:bytes = b"SG"
+RelayHeader:struct.Struct = struct.Struct("<2sBBhhH")
+RelayFieldHeader:struct.Struct = struct.Struct("<BBI")
+RelayInt:struct.Struct = struct.Struct("<q")
+
+# Value kinds
+RelayKindBool:int = 1
+RelayKindInt:int = 2
+RelayKindStr:int = 3
+RelayKindIntList:int = 4
+
+# Tags are part of the wire format, never reuse or renumber them
+RelayFieldTags:dict[str, int] = {
+  "TargetUser": 1,
+  "AuthName": 2,
+  "TargetServer": 3,
+  "NumToRetry": 4,
+  "HandlingCooldown": 5,
+  "Force": 6,
+  "Reset": 7,
+  "Report": 8,
+  "TargetUsers": 9,
+  "Action": 10,
+  "MessageId": 11,
+  "Acks": 12,
+}
+RelayFieldNames:dict[int, str] = {Tag: Name for Name, Tag in RelayFieldTags.items()}
+
+# Message used when a coalesced action ends up with just one user, so older instances still understand it
+ActionMessageTypes:dict[ModerationAction, RelayMessageType] = {
+  ModerationAction.Ban: RelayMessageType.BanUser,
+  ModerationAction.Unban: RelayMessageType.UnbanUser,
+  ModerationAction.Kick: RelayMessageType.Kick,
+}
+# Keeps a single batch frame at a sane size, a full batch is sent right away
+MaxActionBatchSize:int = 1000
+# How many handled message ids a client remembers, so that a retried message is only handled once
+RecentMessageIdLimit:int = 4096
+# Messages that are replayed out of the outbox to an instance that missed them. Everything else
+# (pings, profile requests) is only useful at the time it was sent.
+DurableMessageTypes:list[int] = [RelayMessageType.BanUser, RelayMessageType.UnbanUser, RelayMessageType.Kick, RelayMessageType.ActionBatch,
+                                 RelayMessageType.ProcessServerActivation, RelayMessageType.LeaveServer,
+                                 RelayMessageType.ReprocessBans, RelayMessageType.ReprocessInstance]
+
+# A message that was sent to an instance and is waiting on its ack
+class PendingDelivery():
+  __slots__ = ("Frame", "FirstSentTime", "SentTime", "Attempts")
+  
+  def __init__(self, InFrame:bytes):
+    self.Frame:bytes = InFrame
+    self.FirstSentTime:float = time.monotonic()
+    self.SentTime:float = self.FirstSentTime
+    self.Attempts:int = 1
+
+class DeliveryStats():
+  __slots__ = ("NumAcked", "TotalLatency", "MaxLatency", "NumRetries", "NumExpired")
+  
+  def __init__(self):
+    self.NumAcked:int = 0
+    self.TotalLatency:float = 0.0
+    self.MaxLatency:float = 0.0
+    self.NumRetries:int = 0
+    self.NumExpired:int = 0
+  
+  def AddAck(self, Latency:float):
+    self.NumAcked += 1
+    self.TotalLatency += Latency
+    self.MaxLatency = max(self.MaxLatency, Latency)
+  
+  def __str__(self) -> str:
+    AvgMS:float = (self.TotalLatency / max(self.NumAcked, 1)) * 1000.0
+    return f"{self.NumAcked} acked, avg {AvgMS:.2f}ms max {self.MaxLatency * 1000.0:.2f}ms, {self.NumRetries} retries, {self.NumExpired} expired"
+
 class RelayMessage:
   Type:RelayMessageType = None # pyright: ignore[reportAssignmentType]
   Sender:int = -1
@@ -33,24 +115,147 @@ class RelayMessage:
     self.Destination = InInstance
     self.Data = InData
     
+  def Encode(self) -> bytes:
+    Fields:list[bytes] = []
+    for Name, Value in (self.Data or {}).items():
+      Tag:int|None = RelayFieldTags.get(Name)
+      if (Tag is None):
+        raise ValueError(f"Relay field {Name} does not have a wire tag")
+      
+      # bool has to be checked first, as it is also an int
+      if (isinstance(Value, bool)):
+        Kind, Encoded = RelayKindBool, (b"\x01" if Value else b"\x00")
+      elif (isinstance(Value, int)):
+        Kind, Encoded = RelayKindInt, RelayInt.pack(Value)
+      elif (isinstance(Value, str)):
+        Kind, Encoded = RelayKindStr, Value.encode("utf-8")
+      elif (isinstance(Value, list)):
+        Kind, Encoded = RelayKindIntList, struct.pack(f"<{len(Value)}q", *Value)
+      else:
+        raise ValueError(f"Relay field {Name} has a type that can't be encoded: {type(Value)}")
+      Fields.append(RelayFieldHeader.pack(Tag, Kind, len(Encoded)) + Encoded)
+    
+    return RelayHeader.pack(RelayFrameMagic, RelayWireVersion, int(self.Type), self.Sender, self.Destination, len(Fields)) + b"".join(Fields)
+  
+  # Checks the header and that every field fits exactly inside the frame, without decoding any values
   @staticmethod
-  def IsValid(InType) -> bool:
-    return InType != None and type(InType).__name__ == "RelayMessage"
+  def IsValidFrame(Frame:bytes) -> bool:
+    FrameLen:int = len(Frame)
+    if (FrameLen < RelayHeader.size):
+      return False
+    
+    Magic, Version, _, _, _, NumFields = RelayHeader.unpack_from(Frame)
+    if (Magic != RelayFrameMagic or Version < 1 or Version > RelayWireVersion):
+      return False
+    
+    Offset:int = RelayHeader.size
+    for _ in range(NumFields):
+      if (Offset + RelayFieldHeader.size > FrameLen):
+        return False
+      Offset += RelayFieldHeader.size + RelayFieldHeader.unpack_from(Frame, Offset)[2]
+    return Offset == FrameLen
+  
+  # Message type (as a plain int, it may be newer than this build), sender and destination of a valid frame
+  @staticmethod
+  def DecodeHeader(Frame:bytes) -> tuple[int, int, int]|None:
+    if (not RelayMessage.IsValidFrame(Frame)):
+      return None
+    _, _, TypeValue, Sender, Destination, _ = RelayHeader.unpack_from(Frame)
+    return (TypeValue, Sender, Destination)
+  
+  @staticmethod
+  def Decode(Frame:bytes):
+    Header = RelayMessage.DecodeHeader(Frame)
+    if (Header is None or Header[0] not in RelayMessageType._value2member_map_):
+      return None
+    
+    Data:dict = {}
+    Offset:int = RelayHeader.size
+    while (Offset < len(Frame)):
+      Tag, Kind, Length = RelayFieldHeader.unpack_from(Frame, Offset)
+      Offset += RelayFieldHeader.size
+      Value:bytes = Frame[Offset:Offset+Length]
+      Offset += Length
+      
+      Name:str|None = RelayFieldNames.get(Tag)
+      if (Name is None):
+        continue
+      if (Kind == RelayKindBool):
+        Data[Name] = Value != b"\x00"
+      elif (Kind == RelayKindInt and Length == RelayInt.size):
+        Data[Name] = RelayInt.unpack(Value)[0]
+      elif (Kind == RelayKindStr):
+        Data[Name] = Value.decode("utf-8", errors="replace")
+      elif (Kind == RelayKindIntList and Length % RelayInt.size == 0):
+        Data[Name] = list(struct.unpack(f"<{Length // RelayInt.size}q", Value))
+    
+    return RelayMessage(RelayMessageType(Header[0]), Header[1], Header[2], Data)
+  
+  # Adds the id the relay server assigned to a valid frame, without decoding the rest of it
+  @staticmethod
+  def StampMessageId(Frame:bytes, MessageId:int) -> bytes:
+    Stamped:bytearray = bytearray(Frame)
+    NumFields:int = RelayHeader.unpack_from(Frame)[5]
+    struct.pack_into("<H", Stamped, RelayHeader.size - 2, NumFields + 1)
+    Stamped += RelayFieldHeader.pack(RelayFieldTags["MessageId"], RelayKindInt, RelayInt.size) + RelayInt.pack(MessageId)
+    return bytes(Stamped)
 
 class RelayServer:
   Connections=[]
   # A very dumb way to keep track of error'd connections
   DeadConnections=[]
-  InstancesToConnections={}
+  # Routing table, filled in both directions when an instance says hello
+  InstancesToConnections:dict[int, Connection] = {}
+  ConnectionsToInstances:dict[Connection, int] = {}
+  # Instances that are configured to run, frames for them are held in their send queue until they say hello
+  ExpectedInstances:set[int] = set()
+  SendQueues:dict[int, deque[tuple[int, bytes]]] = {}
+  # Instances that said they ack messages, and what they have not acked yet (in send order)
+  AckInstances:set[int] = set()
+  Unacked:dict[int, dict[int, PendingDelivery]] = {}
+  Deliveries:dict[int, DeliveryStats] = {}
+  NextMessageId:int = 0
+  # Durable outbox, see AttachOutbox. Offsets are the last outbox id each instance consumed, saved every retry tick
+  Outbox:AsyncDatabaseDriver|None = None
+  Offsets:dict[int, int] = {}
+  DirtyOffsets:set[int] = set()
+  # Durable messages that are waiting to be written to the outbox by the database worker
+  PendingOutbox:list[tuple[int, int, int, bytes]] = []
+  OutboxWriteTask:asyncio.Task|None = None
+  # Instances that have durable messages in the outbox which are not held for them (a long replay, or dropped from a full send queue),
+  # and the outbox id their next replay reads after. Their offset can't move past it until the replay has caught up.
+  ReplayCursors:dict[int, int] = {}
+  # Instances that are reading the outbox right now, anything sent to them is held until the replay is queued up in front of it
+  ReplayingInstances:set[int] = set()
+  RelayTasks:set[asyncio.Task] = set()
   FileLocation:str = ""
   ShouldStop:bool = False
   HasPrintedStop:bool = False
   ControlBotId:int = -1
   BotInstance = None
+  # Set once the relay is driven by event loop reader callbacks rather than TickRelay polling
+  EventLoop:asyncio.AbstractEventLoop|None = None
+  IsRestarting:bool = False
   
   def __init__(self, InControlBotId:int, InBotInstance=None):
     self.ControlBotId = InControlBotId
     self.BotInstance = InBotInstance
+    self.InstancesToConnections = {}
+    self.ConnectionsToInstances = {}
+    self.SendQueues = {}
+    self.AckInstances = set()
+    self.Unacked = {}
+    self.Deliveries = {}
+    self.Offsets = {}
+    self.DirtyOffsets = set()
+    self.PendingOutbox = []
+    self.ReplayCursors = {}
+    self.ReplayingInstances = set()
+    self.RelayTasks = set()
+    # Ids only have to be unique for the lifetime of the receiving instances, start from the clock so a restart doesn't reuse them
+    self.NextMessageId = time.time_ns() // 1000
+    self.RoutingStats:dict[str, int] = {"Routed": 0, "Broadcasts": 0, "Queued": 0, "Flushed": 0, "Dropped": 0, "BadDestination": 0, "SendErrors": 0, "Replayed": 0}
+    self.LoadExpectedInstances()
     if (UseUnixSockets()):
       self.ListenSocket = Listener(None, "AF_UNIX", backlog=10)
       self.FileLocation = self.ListenSocket.address # pyright: ignore[reportAttributeAccessIssue]
@@ -82,23 +287,402 @@ class RelayServer:
   def GetFileLocation(self):
     return self.FileLocation
   
+  # Dispatches connections and messages from reader callbacks as soon as they arrive. Returns false if the
+  # running event loop can't watch sockets (the windows proactor loop), in which case TickRelay has to be polled.
+  def StartEventDriven(self) -> bool:
+    if (self.EventLoop is not None):
+      return True
+    
+    CurrentLoop = asyncio.get_running_loop()
+    try:
+      CurrentLoop.add_reader(self.ListenSocket._listener._socket.fileno(), self.OnAcceptReady) # pyright: ignore[reportAttributeAccessIssue]
+    except NotImplementedError:
+      Logger.Log(LogLevel.Log, "Event loop does not support reader callbacks, relay server is falling back to polling")
+      return False
+    
+    self.EventLoop = CurrentLoop
+    for ExistingConnection in self.Connections:
+      self.WatchConnection(ExistingConnection)
+    return True
+  
+  def WatchConnection(self, ConnectionToWatch:Connection):
+    if (self.EventLoop is not None):
+      self.EventLoop.add_reader(ConnectionToWatch.fileno(), self.OnConnectionReady, ConnectionToWatch)
+  
+  def UnwatchConnection(self, ConnectionToWatch:Connection):
+    if (self.EventLoop is not None and not ConnectionToWatch.closed):
+      self.EventLoop.remove_reader(ConnectionToWatch.fileno())
+  
+  def OnAcceptReady(self):
+    self.RunHandler(self.ListenForConnections)
+    
+  def OnConnectionReady(self, ReadyConnection:Connection):
+    self.RunHandler(self.HandleConnection, ReadyConnection)
+    
+  def RunHandler(self, Handler, *args):
+    if (self.ShouldStop):
+      return
+    
+    try:
+      Handler(*args)
+    except Exception as ex:
+      Logger.Log(LogLevel.Error, f"Encountered error while handling connections, stopping server! Exception type: {type(ex)} | message: {str(ex)} | trace: {traceback.format_stack()}")
+      self.ShouldStop = True
+      self.StopEventDriven()
+      return
+    
+    # Restart any dirty connections
+    if (len(self.DeadConnections) > 0 and not self.IsRestarting and self.EventLoop is not None):
+      self.IsRestarting = True
+      self.EventLoop.create_task(self.RestartAllConnections())
+  
+  def StopEventDriven(self):
+    if (self.EventLoop is None):
+      return
+    
+    self.EventLoop.remove_reader(self.ListenSocket._listener._socket.fileno()) # pyright: ignore[reportAttributeAccessIssue]
+    for ExistingConnection in self.Connections:
+      self.UnwatchConnection(ExistingConnection)
+    self.EventLoop = None
+  
   def GetInstanceForConnection(self, Connection) -> int:
-    for key, value in enumerate(self.InstancesToConnections):
-      if (value == Connection):
-        return key
-
-    return -1
+    return self.ConnectionsToInstances.get(Connection, -1)
+  
+  # Every durable message that is routed gets written to the outbox under its message id. Messages that were sent are written behind
+  # by the database worker so that the relay never waits on the database, messages that are held for an instance are written before
+  # they are queued (see WriteHeldOutbox). Instances that reconnect (or a control bot that restarted) replay whatever came after their saved offset.
+  def AttachOutbox(self, InDatabase:AsyncDatabaseDriver):
+    self.Outbox = InDatabase
+    # This is done before the event loop is running, so it's fine to go to the database directly
+    self.Offsets = InDatabase.Driver.GetRelayOffsets()
+    self.DirtyOffsets = set()
+    self.NextMessageId = max(self.NextMessageId, InDatabase.Driver.GetLastRelayOutboxId() + 1)
+    Logger.Log(LogLevel.Debug, f"Relay outbox attached, instance offsets: {self.Offsets}")
+  
+  def RunRelayTask(self, TaskToRun):
+    NewTask = asyncio.get_running_loop().create_task(TaskToRun)
+    self.RelayTasks.add(NewTask)
+    NewTask.add_done_callback(self.RelayTasks.discard)
+  
+  def LoadExpectedInstances(self):
+    self.ExpectedInstances = {self.ControlBotId} | {int(InstanceId) for InstanceId in Config.GetAllSubTokens()}
+  
+  def RegisterInstance(self, InstanceId:int, InstanceConnection:Connection, SupportsAcks:bool):
+    OldConnection:Connection|None = self.InstancesToConnections.get(InstanceId)
+    if (OldConnection is InstanceConnection):
+      Logger.Log(LogLevel.Warn, f"Got a hello message from an known sender {InstanceId}")
+      return
+    
+    if (OldConnection is not None):
+      Logger.Log(LogLevel.Notice, f"Instance {InstanceId} connected again, replacing its old connection")
+      self.ConnectionsToInstances.pop(OldConnection, None)
+      self.RequeueUnacked(InstanceId)
+    else:
+      Logger.Log(LogLevel.Notice, f"Established connection for {InstanceId}")
+    
+    self.InstancesToConnections[InstanceId] = InstanceConnection
+    self.ConnectionsToInstances[InstanceConnection] = InstanceId
+    self.ExpectedInstances.add(InstanceId)
+    # Older builds never ack, so nothing sent to them is tracked
+    if (SupportsAcks):
+      self.AckInstances.add(InstanceId)
+      # An instance the outbox has never seen starts from its first ack, it gets a full reprocess when it is set up anyways
+      Offset:int|None = self.Offsets.get(InstanceId)
+      if (Offset is not None):
+        self.ReplayCursors[InstanceId] = min(self.ReplayCursors.get(InstanceId, Offset), Offset)
+      # The held messages are sent once the replay is in front of them
+      if (self.StartReplay(InstanceId)):
+        return
+    else:
+      self.AckInstances.discard(InstanceId)
+      self.ReplayCursors.pop(InstanceId, None)
+    self.FlushSendQueue(InstanceId)
+  
+  def UnregisterConnection(self, OldConnection:Connection):
+    InstanceId:int|None = self.ConnectionsToInstances.pop(OldConnection, None)
+    if (InstanceId is not None and self.InstancesToConnections.get(InstanceId) is OldConnection):
+      del self.InstancesToConnections[InstanceId]
+      self.RequeueUnacked(InstanceId)
+  
+  def MarkConnectionDead(self, DeadConnection:Connection):
+    # Stop watching it, a closed socket is always readable
+    self.UnwatchConnection(DeadConnection)
+    self.UnregisterConnection(DeadConnection)
+    if (not DeadConnection in self.DeadConnections):
+      self.DeadConnections.append(DeadConnection)
+  
+  def AssignMessageId(self, Frame:bytes, TypeValue:int, Destination:int) -> tuple[int, bytes]:
+    MessageId:int = self.NextMessageId
+    self.NextMessageId += 1
+    # Pings and profile requests are only useful at the time they are sent, they are tracked but never replayed
+    if (self.Outbox is not None and TypeValue in DurableMessageTypes):
+      self.PendingOutbox.append((MessageId, TypeValue, Destination, Frame))
+      if (self.OutboxWriteTask is None or self.OutboxWriteTask.done()):
+        self.OutboxWriteTask = asyncio.get_running_loop().create_task(self.WriteOutbox())
+    return (MessageId, RelayMessage.StampMessageId(Frame, MessageId))
+  
+  # Messages that come in while a write is running go out together in the next one
+  async def WriteOutbox(self):
+    while (self.Outbox is not None and len(self.PendingOutbox) > 0):
+      Messages = self.PendingOutbox
+      self.PendingOutbox = []
+      try:
+        await self.Outbox.AppendRelayOutbox(Messages)
+      except Exception as ex:
+        # They were still delivered, they just can't be replayed
+        Logger.Log(LogLevel.Error, f"Unable to write {len(Messages)} relay messages to the outbox: {str(ex)}")
+  
+  # A held message only exists in the send queue until it is in the outbox, so a crash before the write behind lands would lose it.
+  # Held messages are written right away instead, which only happens while an instance is down or catching up.
+  def WriteHeldOutbox(self, MessageId:int):
+    if (self.Outbox is None or len(self.PendingOutbox) == 0 or MessageId < self.PendingOutbox[0][0]):
+      return
+    
+    Messages = self.PendingOutbox
+    self.PendingOutbox = []
+    try:
+      self.Outbox.Driver.AppendRelayOutbox(Messages)
+    except Exception as ex:
+      Logger.Log(LogLevel.Warn, f"Unable to write {len(Messages)} held relay messages to the outbox, leaving them to the database worker: {str(ex)}")
+      self.Outbox.Driver.EndSession()
+      self.PendingOutbox = Messages + self.PendingOutbox
+  
+  # Returns true if a replay was started, the instance's send queue is flushed once it's done
+  def StartReplay(self, InstanceId:int) -> bool:
+    if (self.Outbox is None or not InstanceId in self.ReplayCursors or InstanceId in self.ReplayingInstances):
+      return False
+    
+    self.ReplayingInstances.add(InstanceId)
+    self.RunRelayTask(self.ReplayOutbox(InstanceId))
+    return True
+  
+  async def ReplayOutbox(self, InstanceId:int):
+    try:
+      await self.LoadMissedMessages(InstanceId)
+    finally:
+      self.ReplayingInstances.discard(InstanceId)
+      if (InstanceId in self.InstancesToConnections):
+        self.FlushSendQueue(InstanceId)
+  
+  # Loads what an instance missed since its replay cursor into its send queue, merged with anything already held for it.
+  # A replay is read in chunks that fit in the send queue, the next chunk is loaded once the instance has caught up.
+  async def LoadMissedMessages(self, InstanceId:int):
+    Cursor:int|None = self.ReplayCursors.get(InstanceId)
+    Limit:int = self.GetMaxQueuedFrames() - len(self.SendQueues.get(InstanceId, ()))
+    if (self.Outbox is None or Cursor is None or Limit <= 0):
+      return
+    
+    try:
+      # Anything still waiting to be written has to be in the outbox before it is read back
+      await self.WriteOutbox()
+      Messages = await self.Outbox.GetRelayOutboxAfter(InstanceId, Cursor, DurableMessageTypes, Limit, InstanceId != self.ControlBotId)
+    except Exception as ex:
+      Logger.Log(LogLevel.Error, f"Unable to read the relay outbox for instance {InstanceId}: {str(ex)}")
+      return
+    
+    # If a message was dropped while the outbox was read the cursor moved back, and the next replay picks it up
+    if (self.ReplayCursors.get(InstanceId) == Cursor):
+      if (len(Messages) < Limit):
+        del self.ReplayCursors[InstanceId]
+      else:
+        self.ReplayCursors[InstanceId] = Messages[-1][0]
+    
+    # The queue may have changed while the outbox was read
+    Queue = self.GetSendQueue(InstanceId)
+    HeldIds:set[int] = {MessageId for MessageId, _ in Queue} | set(self.Unacked.get(InstanceId, {}).keys())
+    Missed:list[tuple[int, bytes]] = [(MessageId, RelayMessage.StampMessageId(Frame, MessageId)) for MessageId, Frame in Messages if not MessageId in HeldIds]
+    if (len(Missed) == 0):
+      return
+    
+    Logger.Log(LogLevel.Notice, f"Replaying {len(Missed)} missed messages to instance {InstanceId} from #{Cursor}")
+    self.RoutingStats["Replayed"] += len(Missed)
+    self.SendQueues[InstanceId] = deque(sorted(list(Queue) + Missed, key=lambda Entry: Entry[0]))
+  
+  # Anything before the oldest message still outstanding for an instance has been consumed by it
+  def UpdateOffset(self, InstanceId:int, ConsumedId:int):
+    if (self.Outbox is None or ConsumedId < 0):
+      return
+    
+    Outstanding:list[int] = list(self.Unacked.get(InstanceId, {}).keys()) + [MessageId for MessageId, _ in self.SendQueues.get(InstanceId, ()) if MessageId >= 0]
+    NewOffset:int = min(Outstanding) - 1 if len(Outstanding) > 0 else ConsumedId
+    # Messages after the replay cursor are still in the outbox waiting to be sent
+    if (InstanceId in self.ReplayCursors):
+      NewOffset = min(NewOffset, self.ReplayCursors[InstanceId])
+    if (NewOffset > self.Offsets.get(InstanceId, 0)):
+      self.Offsets[InstanceId] = NewOffset
+      self.DirtyOffsets.add(InstanceId)
+  
+  async def SaveOffsets(self):
+    # Offsets never get saved ahead of the messages they point at
+    await self.WriteOutbox()
+    if (self.Outbox is None or len(self.DirtyOffsets) == 0):
+      return
+    
+    OffsetsToSave:dict[int, int] = {InstanceId: self.Offsets[InstanceId] for InstanceId in self.DirtyOffsets}
+    self.DirtyOffsets = set()
+    try:
+      await self.Outbox.SaveRelayOffsets(OffsetsToSave)
+    except Exception as ex:
+      Logger.Log(LogLevel.Warn, f"Unable to save relay offsets, will try again: {str(ex)}")
+      self.DirtyOffsets.update(OffsetsToSave.keys())
+  
+  # Outbox messages up to this id have been consumed by every instance that has ever consumed anything
+  def GetConsumedOffset(self) -> int:
+    SubInstanceOffsets:list[int] = [self.Offsets.get(InstanceId, 0) for InstanceId in self.ExpectedInstances if InstanceId != self.ControlBotId]
+    return min(SubInstanceOffsets) if len(SubInstanceOffsets) > 0 else 0
+  
+  def GetMaxQueuedFrames(self) -> int:
+    return max(ConfigData["RelayMaxQueuedFrames"], 1)
+  
+  def GetSendQueue(self, InstanceId:int) -> deque[tuple[int, bytes]]:
+    Queue:deque[tuple[int, bytes]]|None = self.SendQueues.get(InstanceId)
+    if (Queue is None):
+      Queue = self.SendQueues[InstanceId] = deque()
+    return Queue
+  
+  # Sends right away if the instance is connected and has nothing queued, otherwise holds the frame
+  # until the instance says hello. Returns false if the instance is not one we know about.
+  def SendToInstance(self, InstanceId:int, Frame:bytes, MessageId:int=-1) -> bool:
+    if (not InstanceId in self.ExpectedInstances):
+      return False
+    
+    DestConnection:Connection|None = self.InstancesToConnections.get(InstanceId)
+    if (DestConnection is not None and not self.SendQueues.get(InstanceId) and not InstanceId in self.ReplayingInstances):
+      try:
+        DestConnection.send_bytes(Frame)
+        self.RoutingStats["Routed"] += 1
+        if (MessageId >= 0 and InstanceId in self.AckInstances):
+          self.Unacked.setdefault(InstanceId, {})[MessageId] = PendingDelivery(Frame)
+        return True
+      except OSError as ex:
+        Logger.Log(LogLevel.Warn, f"Failed to send to instance {InstanceId}, holding the message until it reconnects: {str(ex)}")
+        self.RoutingStats["SendErrors"] += 1
+        self.MarkConnectionDead(DestConnection)
+    
+    Queue = self.GetSendQueue(InstanceId)
+    if (len(Queue) >= self.GetMaxQueuedFrames()):
+      # The oldest message falls off the end, durable messages are sent again out of the outbox once the instance catches up
+      DroppedId, DroppedFrame = Queue.popleft()
+      self.RoutingStats["Dropped"] += 1
+      if (self.Outbox is not None and DroppedId >= 0 and RelayMessage.DecodeHeader(DroppedFrame)[0] in DurableMessageTypes): # pyright: ignore[reportOptionalSubscript]
+        self.ReplayCursors[InstanceId] = min(self.ReplayCursors.get(InstanceId, DroppedId - 1), DroppedId - 1)
+    self.WriteHeldOutbox(MessageId)
+    Queue.append((MessageId, Frame))
+    self.RoutingStats["Queued"] += 1
+    return True
+  
+  def FlushSendQueue(self, InstanceId:int):
+    # The replay flushes it when it's done
+    if (InstanceId in self.ReplayingInstances):
+      return
+    
+    Queue:deque[tuple[int, bytes]]|None = self.SendQueues.pop(InstanceId, None)
+    if (not Queue):
+      return
+    
+    Logger.Log(LogLevel.Log, f"Sending {len(Queue)} held messages to instance {InstanceId}")
+    self.RoutingStats["Flushed"] += len(Queue)
+    while (len(Queue) > 0):
+      MessageId, Frame = Queue.popleft()
+      if (not self.SendToInstance(InstanceId, Frame, MessageId)):
+        break
+      if (InstanceId in self.SendQueues):
+        # Sending failed part way through, keep the rest in order behind what was just requeued
+        self.SendQueues[InstanceId].extend(Queue)
+        break
+  
+  # Anything an instance never acked goes back to the front of its send queue, to be sent again after its next hello
+  def RequeueUnacked(self, InstanceId:int):
+    Pending:dict[int, PendingDelivery] = self.Unacked.pop(InstanceId, {})
+    if (len(Pending) == 0):
+      return
+    
+    Queue = self.GetSendQueue(InstanceId)
+    Queue.extendleft(reversed([(MessageId, Delivery.Frame) for MessageId, Delivery in Pending.items()]))
+    Logger.Log(LogLevel.Notice, f"Holding {len(Pending)} unacked messages for instance {InstanceId} until it reconnects")
+  
+  def HandleAck(self, InstanceId:int, MessageId:int):
+    Delivery:PendingDelivery|None = self.Unacked.get(InstanceId, {}).pop(MessageId, None)
+    # Acks for a retried message can show up more than once
+    if (Delivery is None):
+      return
+    self.Deliveries.setdefault(InstanceId, DeliveryStats()).AddAck(time.monotonic() - Delivery.FirstSentTime)
+    self.UpdateOffset(InstanceId, MessageId)
+  
+  # Sends anything that wasn't acked in time again, and gives up on messages after RelayMaxRetries attempts
+  def RetryUnackedMessages(self):
+    Now:float = time.monotonic()
+    Timeout:float = ConfigData["RelayAckTimeoutMS"] / 1000.0
+    for InstanceId in list(self.Unacked.keys()):
+      DestConnection:Connection|None = self.InstancesToConnections.get(InstanceId)
+      Pending:dict[int, PendingDelivery] = self.Unacked[InstanceId]
+      if (DestConnection is None):
+        continue
+      
+      Stats:DeliveryStats = self.Deliveries.setdefault(InstanceId, DeliveryStats())
+      for MessageId, Delivery in list(Pending.items()):
+        if (Now - Delivery.SentTime < Timeout):
+          continue
+        
+        if (Delivery.Attempts > ConfigData["RelayMaxRetries"]):
+          Logger.Log(LogLevel.Warn, f"Instance {InstanceId} never acked message #{MessageId} after {Delivery.Attempts} attempts, giving up on it")
+          del Pending[MessageId]
+          Stats.NumExpired += 1
+          self.UpdateOffset(InstanceId, MessageId)
+          continue
+        
+        try:
+          DestConnection.send_bytes(Delivery.Frame)
+        except OSError as ex:
+          Logger.Log(LogLevel.Warn, f"Failed to resend to instance {InstanceId}: {str(ex)}")
+          self.RoutingStats["SendErrors"] += 1
+          self.MarkConnectionDead(DestConnection)
+          break
+        Delivery.Attempts += 1
+        Delivery.SentTime = Now
+        Stats.NumRetries += 1
+    
+    # Instances that have caught up get the next part of their replay
+    for InstanceId in list(self.ReplayCursors.keys()):
+      if (InstanceId in self.InstancesToConnections and InstanceId in self.AckInstances and not self.Unacked.get(InstanceId) and not self.SendQueues.get(InstanceId)):
+        self.StartReplay(InstanceId)
+  
+  def GetRoutingStats(self) -> str:
+    Pending:int = sum(len(Queue) for Queue in self.SendQueues.values())
+    StatsStr:str = ", ".join(f"{Name} {Value}" for Name, Value in self.RoutingStats.items())
+    ReturnStr:str = f"Relay: {len(self.InstancesToConnections)}/{len(self.ExpectedInstances)} instances connected, {Pending} messages held | {StatsStr}"
+    for InstanceId in sorted(self.ExpectedInstances):
+      State:str = "connected" if InstanceId in self.InstancesToConnections else "down"
+      if (not InstanceId in self.AckInstances):
+        State += ", no acks"
+      if (InstanceId in self.ReplayCursors):
+        State += f", replaying after #{self.ReplayCursors[InstanceId]}"
+      ReturnStr += f"\n- #{InstanceId} {State}: {len(self.Unacked.get(InstanceId, {}))} unacked, {self.Deliveries.get(InstanceId, DeliveryStats())}"
+    return ReturnStr
   
   async def RestartAllConnections(self):
     if (self.BotInstance is None):
       Logger.Log(LogLevel.Notice, "BotInstance is somehow none while restarting all connections")
+      self.IsRestarting = False
       return
     
     Logger.Log(LogLevel.Notice, "Restarting all connections and instances.")
+    for ExistingConnection in self.Connections:
+      self.UnwatchConnection(ExistingConnection)
+    for InstanceId in list(self.Unacked.keys()):
+      self.RequeueUnacked(InstanceId)
+    await self.SaveOffsets()
     self.Connections = []
     self.InstancesToConnections = {}
+    self.ConnectionsToInstances = {}
+    self.AckInstances = set()
     self.DeadConnections = []
-    await self.BotInstance.StartAllInstances(BypassCheck=True, RestartMainClient=True)
+    # Anything sent while the instances come back up stays in their send queues until they say hello
+    self.LoadExpectedInstances()
+    try:
+      await self.BotInstance.StartAllInstances(BypassCheck=True, RestartMainClient=True)
+    finally:
+      self.IsRestarting = False
 
   async def TickRelay(self):
     if (self.ShouldStop):
@@ -128,49 +712,60 @@ class RelayServer:
       NewConnection = self.ListenSocket.accept()
       Logger.Log(LogLevel.Verbose, "A new connection has been made!")
       self.Connections.append(NewConnection)
+      self.WatchConnection(NewConnection)
 
   def HandleRecv(self):
     # This will make us only get the sockets that have messages waiting for them
     # And ignore everything else. The blocking operation should be fairly short.
     ConnectionsReady = wait(self.Connections, timeout=0)
     for ConnectionItr in ConnectionsReady:
-      CurrentConnection = cast(Connection, ConnectionItr)
-      # Read through all messages that we have for this connection
-      while (CurrentConnection.poll(0)):
-        RawMessage = None
-        # Check to see if we were suddenly disconnected for whatever reason
-        try:
-          RawMessage = CurrentConnection.recv()
-        except EOFError:
-          self.DeadConnections.append(CurrentConnection)
-          break
-        
-        # Check to see if the message is valid.                
-        if (not RelayMessage.IsValid(RawMessage)):
-          continue
-        Message:RelayMessage = RawMessage
-        match Message.Type:
-          case RelayMessageType.Hello:
-            if (not Message.Sender in self.InstancesToConnections):  
-              self.InstancesToConnections[Message.Sender] = CurrentConnection
-              Logger.Log(LogLevel.Notice, f"Established connection for {Message.Sender}")
-            else:
-              Logger.Log(LogLevel.Warn, f"Got a hello message from an known sender {Message.Sender}")
-          case RelayMessageType.BanUser | RelayMessageType.UnbanUser | RelayMessageType.ProcessServerActivation | RelayMessageType.Kick:
-            Logger.Log(LogLevel.Log, f"Sending command {Message.Type} to {len(self.Connections)} instances...")
-            # Resend this message to literally everyone
-            for ClientConnection in self.Connections:
-              # Skip the main bot instance, there's no reason for it to get messages.
-              if (ClientConnection == self.InstancesToConnections[self.ControlBotId]):
-                continue
-              ClientConnection.send(Message)
-          case _:
-            if (Message.Destination < 0 or Message.Destination >= len(self.InstancesToConnections)):
-              Logger.Log(LogLevel.Warn, f"Message went to a bad destination! {str(Message.Destination)}")
+      self.HandleConnection(cast(Connection, ConnectionItr))
+      
+  def HandleConnection(self, CurrentConnection:Connection):
+    # Read through all messages that we have for this connection
+    while (CurrentConnection.poll(0)):
+      Frame:bytes = b""
+      # Check to see if we were suddenly disconnected for whatever reason
+      try:
+        Frame = CurrentConnection.recv_bytes()
+      except EOFError:
+        self.MarkConnectionDead(CurrentConnection)
+        break
+      
+      # Frames are routed off of their header alone, and passed along without being decoded or re-encoded
+      Header = RelayMessage.DecodeHeader(Frame)
+      if (Header is None):
+        Logger.Log(LogLevel.Warn, "Relay server got a frame that is not a valid relay message")
+        continue
+      TypeValue, Sender, Destination = Header
+      match TypeValue:
+        case RelayMessageType.Hello:
+          HelloMessage:RelayMessage|None = RelayMessage.Decode(Frame)
+          self.RegisterInstance(Sender, CurrentConnection, HelloMessage is not None and HelloMessage.Data.get("Acks", False))
+        case RelayMessageType.Ack:
+          AckMessage:RelayMessage|None = RelayMessage.Decode(Frame)
+          if (AckMessage is not None):
+            self.HandleAck(Sender, AckMessage.Data.get("MessageId", -1))
+        case RelayMessageType.BanUser | RelayMessageType.UnbanUser | RelayMessageType.ProcessServerActivation | RelayMessageType.Kick | RelayMessageType.ActionBatch:
+          Logger.Log(LogLevel.Log, f"Sending command {RelayMessageType(TypeValue)} to {len(self.ExpectedInstances) - 1} instances...")
+          self.RoutingStats["Broadcasts"] += 1
+          # Every instance gets the same message id, they each ack it on their own
+          MessageId, Frame = self.AssignMessageId(Frame, TypeValue, -1)
+          # Resend this message to every instance, anything that hasn't said hello yet gets it once it does
+          for InstanceId in list(self.ExpectedInstances):
+            # Skip the main bot instance, there's no reason for it to get messages.
+            if (InstanceId == self.ControlBotId):
               continue
-            
-            DestConnection = self.InstancesToConnections[Message.Destination]
-            DestConnection.send(Message)
+            self.SendToInstance(InstanceId, Frame, MessageId)
+        case _:
+          # Checked before the message is written to the outbox
+          if (not Destination in self.ExpectedInstances):
+            self.RoutingStats["BadDestination"] += 1
+            Logger.Log(LogLevel.Warn, f"Message went to a bad destination! {str(Destination)}")
+            continue
+          
+          MessageId, Frame = self.AssignMessageId(Frame, TypeValue, Destination)
+          self.SendToInstance(Destination, Frame, MessageId)
      
 class RelayClient:
   BotID:int = -1
@@ -179,6 +774,16 @@ class RelayClient:
     self.Connection = None
     self.SentHello = False
     self.FunctionRouter = {}
+    self.EventLoop:asyncio.AbstractEventLoop|None = None
+    # Moderation actions waiting to go out as one batch, they all share the same action and authorizer
+    self.PendingAction:tuple[ModerationAction, str]|None = None
+    # The list keeps the order the users were queued in, the set is for checking if a user is already in the batch
+    self.PendingUsers:list[int] = []
+    self.PendingUserSet:set[int] = set()
+    self.BatchFlushHandle:asyncio.TimerHandle|None = None
+    # Ids of messages that were already handled, a retry of one of them is only acked again
+    self.HandledMessageIds:set[int] = set()
+    self.HandledMessageOrder:deque[int] = deque()
     
     if (UseUnixSockets()):
       self.Connection = Client(InFileLocation, "AF_UNIX")
@@ -190,15 +795,52 @@ class RelayClient:
     self.Disconnect()
 
   def Disconnect(self):
+    self.FlushActionBatch()
+    self.StopEventDriven()
     if (self.Connection is not None):
       Logger.Log(LogLevel.Log, f"Closing connection for instance {self.BotID}")
       self.Connection.close()
       self.Connection = None
+      
+  # Handles messages from a reader callback as soon as they arrive. Returns false if the running
+  # event loop can't watch sockets, in which case RecvMessage has to be polled instead.
+  def StartEventDriven(self) -> bool:
+    if (self.EventLoop is not None):
+      return True
+    if (self.Connection is None):
+      return False
+    
+    CurrentLoop = asyncio.get_running_loop()
+    try:
+      CurrentLoop.add_reader(self.Connection.fileno(), self.HandleMessages)
+    except NotImplementedError:
+      Logger.Log(LogLevel.Log, f"Event loop does not support reader callbacks, bot #{self.BotID} is falling back to polling the relay")
+      return False
+    
+    self.EventLoop = CurrentLoop
+    return True
+  
+  def IsEventDriven(self) -> bool:
+    return self.EventLoop is not None
+  
+  def StopEventDriven(self):
+    if (self.EventLoop is None):
+      return
+    
+    if (self.Connection is not None and not self.Connection.closed):
+      self.EventLoop.remove_reader(self.Connection.fileno())
+    self.EventLoop = None
     
   def GenerateMessage(self, Type:RelayMessageType, Destination:int=-1, TargetServer:int=-1, 
-                      HandlingCooldown:bool=False, TargetUserId:int=-1, NumToRetry=-1, AuthName:str="") -> RelayMessage:            
+                      HandlingCooldown:bool=False, TargetUserId:int=-1, NumToRetry=-1, AuthName:str="", Force:bool=False,
+                      Reset:bool=False, Report:str="", TargetUsers:list[int]|None=None, Action:ModerationAction=ModerationAction.Nothing,
+                      MessageId:int=-1) -> RelayMessage:            
     DataPayload={}
     match Type:
+      case RelayMessageType.Hello:
+        DataPayload={"Acks": True}
+      case RelayMessageType.Ack:
+        DataPayload={"MessageId": MessageId}
       case RelayMessageType.BanUser | RelayMessageType.UnbanUser | RelayMessageType.Kick:
         DataPayload={"TargetUser": TargetUserId, "AuthName": AuthName}
       case RelayMessageType.ProcessServerActivation:
@@ -209,7 +851,13 @@ class RelayClient:
         DataPayload={"NumToRetry": NumToRetry}
       case RelayMessageType.ReprocessBans:
         DataPayload={"TargetServer": TargetServer, "NumToRetry": NumToRetry, 
-                     "HandlingCooldown": HandlingCooldown}
+                     "HandlingCooldown": HandlingCooldown, "Force": Force}
+      case RelayMessageType.DatabaseProfile:
+        DataPayload={"Reset": Reset}
+      case RelayMessageType.DatabaseProfileReport:
+        DataPayload={"Report": Report}
+      case RelayMessageType.ActionBatch:
+        DataPayload={"TargetUsers": TargetUsers, "Action": int(Action), "AuthName": AuthName}
     
     return RelayMessage(Type, self.BotID, Destination, DataPayload)
   
@@ -220,6 +868,11 @@ class RelayClient:
     else:
       Logger.Log(LogLevel.Warn, f"Attempted to re-register function for {str(OnMessageType)} for {str(self)}")
   
+  def SendMessage(self, MessageToSend:RelayMessage):
+    if (self.Connection is None):
+      return
+    self.Connection.send_bytes(MessageToSend.Encode())
+  
   def SendHello(self):
     if (self.SentHello or self.Connection is None):
       Logger.Log(LogLevel.Warn, f"Bot #{self.BotID} unable to start up!")
@@ -227,98 +880,193 @@ class RelayClient:
     
     Logger.Log(LogLevel.Log, f"Bot #{self.BotID} sending hello!")
     NewMessage:RelayMessage = self.GenerateMessage(RelayMessageType.Hello)
-    self.Connection.send(NewMessage)
+    self.SendMessage(NewMessage)
     self.SentHello = True
   
+  # Bans, unbans and kicks that arrive within RelayBatchWindowMS of each other go out as one ActionBatch.
+  # A different action or authorizer flushes what is pending first, so instances still see them in order.
+  def QueueAction(self, Action:ModerationAction, UserId:int, InAuthName:str):
+    WindowMS:float = ConfigData["RelayBatchWindowMS"]
+    if (WindowMS <= 0):
+      self.SendMessage(self.GenerateMessage(ActionMessageTypes[Action], TargetUserId=UserId, AuthName=InAuthName))
+      return
+    
+    if (self.PendingAction != (Action, InAuthName)):
+      self.FlushActionBatch()
+      self.PendingAction = (Action, InAuthName)
+    
+    if (not UserId in self.PendingUserSet):
+      self.PendingUserSet.add(UserId)
+      self.PendingUsers.append(UserId)
+    
+    if (len(self.PendingUsers) >= MaxActionBatchSize):
+      self.FlushActionBatch()
+    elif (self.BatchFlushHandle is None):
+      self.BatchFlushHandle = asyncio.get_running_loop().call_later(WindowMS / 1000.0, self.FlushActionBatch)
+  
+  def FlushActionBatch(self):
+    if (self.BatchFlushHandle is not None):
+      self.BatchFlushHandle.cancel()
+      self.BatchFlushHandle = None
+    
+    if (self.PendingAction is None):
+      return
+    Action, AuthName = self.PendingAction
+    UsersToSend:list[int] = self.PendingUsers
+    self.PendingAction = None
+    self.PendingUsers = []
+    self.PendingUserSet = set()
+    
+    if (len(UsersToSend) == 1):
+      self.SendMessage(self.GenerateMessage(ActionMessageTypes[Action], TargetUserId=UsersToSend[0], AuthName=AuthName))
+    else:
+      Logger.Log(LogLevel.Log, f"Bot #{self.BotID} sending a batch of {len(UsersToSend)} {Action} actions")
+      self.SendMessage(self.GenerateMessage(RelayMessageType.ActionBatch, TargetUsers=UsersToSend, Action=Action, AuthName=AuthName))
+  
   # TODO: Make these functions automatically generated.
   def SendBan(self, UserId:int, InAuthName:str):
     if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
       return
-    self.Connection.send(self.GenerateMessage(RelayMessageType.BanUser, TargetUserId=UserId, AuthName=InAuthName))
+    self.QueueAction(ModerationAction.Ban, UserId, InAuthName)
     
   def SendKick(self, UserId:int, InAuthName:str):
     if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
       return
-    self.Connection.send(self.GenerateMessage(RelayMessageType.Kick, TargetUserId=UserId, AuthName=InAuthName))
+    self.QueueAction(ModerationAction.Kick, UserId, InAuthName)
     
   def SendUnban(self, UserId:int, InAuthName:str):
     if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
       return
-    self.Connection.send(self.GenerateMessage(RelayMessageType.UnbanUser, TargetUserId=UserId, AuthName=InAuthName))
+    self.QueueAction(ModerationAction.Unban, UserId, InAuthName)
   
   def SendLeaveServer(self, ServerToLeave:int, InstanceId):
     if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
       return
-    self.Connection.send(self.GenerateMessage(RelayMessageType.LeaveServer, Destination=InstanceId, TargetServer=ServerToLeave))
+    self.SendMessage(self.GenerateMessage(RelayMessageType.LeaveServer, Destination=InstanceId, TargetServer=ServerToLeave))
     
-  def SendReprocessBans(self, ServerToRetry:int, InstanceId, InNumToRetry:int=-1, InHandlingCooldown:bool=False):
+  def SendReprocessBans(self, ServerToRetry:int, InstanceId, InNumToRetry:int=-1, InHandlingCooldown:bool=False, InForce:bool=False):
     if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
       return
-    self.Connection.send(self.GenerateMessage(RelayMessageType.ReprocessBans, Destination=InstanceId, 
+    self.SendMessage(self.GenerateMessage(RelayMessageType.ReprocessBans, Destination=InstanceId, 
                                               TargetServer=ServerToRetry, NumToRetry=InNumToRetry,
-                                              HandlingCooldown=InHandlingCooldown))
+                                              HandlingCooldown=InHandlingCooldown, Force=InForce))
   
   def SendReprocessInstanceBans(self, InstanceId, InNumToRetry:int=-1):
     if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
       return
-    self.Connection.send(self.GenerateMessage(RelayMessageType.ReprocessInstance, Destination=InstanceId, NumToRetry=InNumToRetry))
+    self.SendMessage(self.GenerateMessage(RelayMessageType.ReprocessInstance, Destination=InstanceId, NumToRetry=InNumToRetry))
   
   def SendPing(self, InstanceToTarget):
     if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
       return
-    self.Connection.send(self.GenerateMessage(RelayMessageType.Ping, Destination=InstanceToTarget))
+    self.SendMessage(self.GenerateMessage(RelayMessageType.Ping, Destination=InstanceToTarget))
     
   def SendActivationForServerInstance(self, UserId, ServerId, InstanceToTarget):
     if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
       return
-    self.Connection.send(self.GenerateMessage(RelayMessageType.ProcessServerActivation, TargetUserId=UserId, TargetServer=ServerId, Destination=InstanceToTarget))
+    self.SendMessage(self.GenerateMessage(RelayMessageType.ProcessServerActivation, TargetUserId=UserId, TargetServer=ServerId, Destination=InstanceToTarget))
+  
+  def SendDatabaseProfileRequest(self, InstanceToTarget, InReset:bool=False):
+    if (self.Connection is None or self.BotID != ConfigData["ControlBotID"]):
+      return
+    self.SendMessage(self.GenerateMessage(RelayMessageType.DatabaseProfile, Destination=InstanceToTarget, Reset=InReset))
+    
+  # Any instance can send this, it always goes back to the control bot
+  def SendDatabaseProfileReport(self, InReport:str):
+    if (self.Connection is None):
+      return
+    self.SendMessage(self.GenerateMessage(RelayMessageType.DatabaseProfileReport, Destination=ConfigData["ControlBotID"], Report=InReport))
+  
+  def AcknowledgeMessage(self, MessageId:int):
+    if (not MessageId in self.HandledMessageIds):
+      self.HandledMessageIds.add(MessageId)
+      self.HandledMessageOrder.append(MessageId)
+      if (len(self.HandledMessageOrder) > RecentMessageIdLimit):
+        self.HandledMessageIds.discard(self.HandledMessageOrder.popleft())
+    self.SendMessage(self.GenerateMessage(RelayMessageType.Ack, MessageId=MessageId))
   
   async def RecvMessage(self):
+    self.HandleMessages()
+    
+  def HandleMessages(self):
     if (self.Connection is None):
       return
     
     # While we have active messages on this socket
     while (self.Connection.poll(0)):
-      RawMessage = None
+      Frame:bytes = b""
       try:
-        RawMessage = self.Connection.recv()
+        Frame = self.Connection.recv_bytes()
       except Exception as recvex:
         Logger.Log(LogLevel.Error, f"Encountered an error with {self.BotID} recv! {type(recvex)} | message: {str(recvex)} | trace: {traceback.format_stack()}")
+        # A broken connection stays readable forever, so stop watching it
+        if (isinstance(recvex, (EOFError, OSError))):
+          self.StopEventDriven()
         break
         
-      if (not RelayMessage.IsValid(RawMessage)):
-        Logger.Log(LogLevel.Warn, f"Bot #{self.BotID} received relay message is not a type of RelayMessage")
-        break
+      RelayedMessage:RelayMessage|None = RelayMessage.Decode(Frame)
+      if (RelayedMessage is None):
+        Logger.Log(LogLevel.Warn, f"Bot #{self.BotID} received a relay frame that is invalid or of an unknown type")
+        continue
+      
+      # Messages from the relay server carry an id, which gets acked once the handler has been scheduled
+      MessageId:int = RelayedMessage.Data.get("MessageId", -1)
+      if (MessageId in self.HandledMessageIds):
+        Logger.Log(LogLevel.Verbose, f"Bot #{self.BotID} got message #{MessageId} again, it was already handled")
+        self.AcknowledgeMessage(MessageId)
+        continue
       
-      RelayedMessage:RelayMessage = RawMessage            
       # If the message doesn't have a handler
       if (not RelayedMessage.Type in self.FunctionRouter):
         Logger.Log(LogLevel.Warn, f"We do not have a message router for type {RelayedMessage.Type}")
+        # Retrying won't give it a handler
+        if (MessageId >= 0):
+          self.AcknowledgeMessage(MessageId)
         break
       else:
         Logger.Log(LogLevel.Log, f"Bot #{self.BotID} just got a message of type {RelayedMessage.Type}")
       
       # Rework the arguments in a way that we can explode map them programmatically
       Arguments = None
-      if (RelayedMessage.Data is not None):
-        match RelayedMessage.Type:
-          case RelayMessageType.BanUser | RelayMessageType.UnbanUser | RelayMessageType.Kick:
-            Arguments = {"TargetId": RelayedMessage.Data["TargetUser"], "AuthName":RelayedMessage.Data["AuthName"]}
-          case RelayMessageType.ProcessServerActivation:
-            Arguments = {"UserId": RelayedMessage.Data["TargetUser"], "ServerId": RelayedMessage.Data["TargetServer"]}
-          case RelayMessageType.LeaveServer:
-            Arguments = {"ServerId": RelayedMessage.Data["TargetServer"]}
-          case RelayMessageType.ReprocessBans:
-            Arguments = {"ServerId": RelayedMessage.Data["TargetServer"], 
-                         "LastActions": RelayedMessage.Data["NumToRetry"], 
-                         "HandlingCooldown": RelayedMessage.Data["HandlingCooldown"]}
-          case RelayMessageType.ReprocessInstance:
-            Arguments = {"LastActions": RelayedMessage.Data["NumToRetry"]}
-
+      try:
+        if (RelayedMessage.Data is not None):
+          match RelayedMessage.Type:
+            case RelayMessageType.BanUser | RelayMessageType.UnbanUser | RelayMessageType.Kick:
+              Arguments = {"TargetId": RelayedMessage.Data["TargetUser"], "AuthName":RelayedMessage.Data["AuthName"]}
+            case RelayMessageType.ProcessServerActivation:
+              Arguments = {"UserId": RelayedMessage.Data["TargetUser"], "ServerId": RelayedMessage.Data["TargetServer"]}
+            case RelayMessageType.LeaveServer:
+              Arguments = {"ServerId": RelayedMessage.Data["TargetServer"]}
+            case RelayMessageType.ReprocessBans:
+              Arguments = {"ServerId": RelayedMessage.Data["TargetServer"], 
+                           "LastActions": RelayedMessage.Data["NumToRetry"], 
+                           "HandlingCooldown": RelayedMessage.Data["HandlingCooldown"],
+                           "Force": RelayedMessage.Data.get("Force", False)}
+            case RelayMessageType.ReprocessInstance:
+              Arguments = {"LastActions": RelayedMessage.Data["NumToRetry"]}
+            case RelayMessageType.DatabaseProfile:
+              Arguments = {"Reset": RelayedMessage.Data["Reset"]}
+            case RelayMessageType.DatabaseProfileReport:
+              Arguments = {"InstanceId": RelayedMessage.Sender, "Report": RelayedMessage.Data["Report"]}
+            case RelayMessageType.ActionBatch:
+              Arguments = {"TargetIds": RelayedMessage.Data["TargetUsers"], "AuthName": RelayedMessage.Data["AuthName"],
+                           "Action": ModerationAction(RelayedMessage.Data["Action"])}
+      except Exception as ex:
+        # A frame with missing or bad fields will never handle, so it's acked rather than retried
+        Logger.Log(LogLevel.Error, f"Bot #{self.BotID} got a malformed {RelayedMessage.Type} message #{MessageId}, dropping it. Exception type: {type(ex)} | message: {str(ex)}")
+        if (MessageId >= 0):
+          self.AcknowledgeMessage(MessageId)
+        continue
+      
       try:
         if (Arguments is None):
           self.FunctionRouter[RelayedMessage.Type]()
         else:
           self.FunctionRouter[RelayedMessage.Type](**Arguments)
       except Exception as ex:
-        Logger.Log(LogLevel.Warn, f"Bot #{self.BotID} Failed to handle recv message, got exception type: {type(ex)} | message: {str(ex)} | trace: {traceback.format_stack()}")
\ No newline at end of file
+        # Not acked, so the relay server tries it again
+        Logger.Log(LogLevel.Warn, f"Bot #{self.BotID} Failed to handle recv message, got exception type: {type(ex)} | message: {str(ex)} | trace: {traceback.format_stack()}")
+        continue
+      
+      if (MessageId >= 0):
+        self.AcknowledgeMessage(MessageId)
\ No newline at end of file
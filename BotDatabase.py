@@ -2,21 +2,63 @@
 from BotEnums import BanAction, ModerationAction
 from Logger import Logger, LogLevel
 from Config import Config
-import shutil, time, os
-from BotDatabaseSchema import Ban, ExhaustedServer, Server
-from sqlalchemy import create_engine, Engine, select, URL, desc, asc, func
-from sqlalchemy.orm import Session
+import sqlite3, time, os, sys, threading
+from BotDatabaseSchema import Ban, BanLedger, Counter, ExhaustedServer, RelayOutbox, RelayOffset, Server, ServerSnapshot, StatCounters
+from BotSetup import CreateDatabaseEngine, DatabaseContention
+from BotDatabaseProfiler import DatabaseProfiler
+from sqlalchemy import Engine, Row, select, insert, update, delete, text, desc, asc, func, case
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from BotServerSettings import BotSettingsPayload
 from datetime import timezone, datetime, timedelta
 from typing import cast
 
 ConfigData:Config = Config()
+# Keeps IN (...) lists under the SQLite bound parameter limit
+MaxParametersPerQuery:int = 500
+
+# Number of bans fetched per keyset page when iterating the ban list
+BanPageSize:int = 1000
+
+def ChunkList(List:list, Size:int=MaxParametersPerQuery):
+  for i in range(0, len(List), Size):
+    yield List[i:i+Size]
 
 class DatabaseDriver():
-  Database:Session = None # pyright: ignore[reportAssignmentType]
+  # Sessions are thread local, so the async database worker thread and the event loop never share one
+  Database:scoped_session[Session] = None # pyright: ignore[reportAssignmentType]
+  # Sessions for query only methods. This is the same as Database, unless the driver was opened with read-only queries
+  Reader:scoped_session[Session] = None # pyright: ignore[reportAssignmentType]
+  ReadOnlyQueries:bool = False
+  # Resident set of every banned discord user id, kept write-through with the bans table.
+  # It's changed from both the event loop and the database worker, so every change goes through BanIndexLock.
+  BanIndex:set[int] = set()
+  BanIndexLock:threading.Lock = None # pyright: ignore[reportAssignmentType]
+  # Changes made while the ban index is being reloaded, they are applied to the new set before it is swapped in
+  BanIndexChanges:list[tuple[int, bool]]|None = None
+  # Lookups the ban index answered, whether the user was banned or not
+  BanIndexHits:int = 0
+  # Lookups made while the ban index was empty or reloading, these fall back to the database
+  BanIndexMisses:int = 0
+  # Ban rows read for lookups of banned users
+  NumBanRowFetches:int = 0
+  # Snapshots of server rows and the time they were fetched, keyed by discord server id
+  ServerCache:dict[int, tuple[ServerSnapshot, float]] = {}
+  # Counter values the ban index and server cache were last synced against, see SyncExternalChanges
+  KnownBanSeq:int = 0
+  KnownServersVersion:int = 0
+  NumBanIndexReloads:int = 0
+  NumServerCacheFlushes:int = 0
+  # Session lifecycle stats, sessions are ended after every worker call and periodically on the event loop
+  NumSessionsEnded:int = 0
+  MaxIdentityMapSize:int = 0
   
   ### Initialization/Teardown ###
-  def __init__(self, *args, **kwargs):
+  def __init__(self, ReadOnlyQueries:bool=False):
+    self.ReadOnlyQueries = ReadOnlyQueries
+    self.BanIndex = set()
+    self.BanIndexLock = threading.Lock()
+    self.ServerCache = {}
     self.Open()
     
   def __del__(self):
@@ -25,18 +67,28 @@ class DatabaseDriver():
   def Open(self):
     self.Close()
 
-    database_url = URL.create(
-      'sqlite',
-      username='',
-      password='',
-      host='',
-      database=Config.GetDBFile(),
-    )
-    self.Database = Session(create_engine(database_url))
+    # Objects are not expired on commit, as they can be handed between the worker thread and the event loop.
+    self.Database = scoped_session(sessionmaker(bind=CreateDatabaseEngine(), expire_on_commit=False))
+    # Processes that mostly read (the sub-instances) can send their query traffic through a mode=ro handle
+    if (self.ReadOnlyQueries):
+      self.Reader = scoped_session(sessionmaker(bind=CreateDatabaseEngine(ReadOnly=True), expire_on_commit=False))
+    else:
+      self.Reader = self.Database
+    self.LoadBanIndex()
+    self.KnownServersVersion = self.GetCounter("servers_version")
+    self.InvalidateServerCache()
 
   def Close(self):
+    if (self.Reader is not None and self.Reader is not self.Database):
+      ReaderEngine:Engine = cast(Engine, self.Reader.get_bind())
+      self.Reader.remove()
+      ReaderEngine.dispose()
+    self.Reader = None # pyright: ignore[reportAttributeAccessIssue]
+    
     if (self.IsConnected()):
-      cast(Engine, self.Database.get_bind()).dispose()
+      DatabaseEngine:Engine = cast(Engine, self.Database.get_bind())
+      self.Database.remove()
+      DatabaseEngine.dispose()
       self.Database = None # pyright: ignore[reportAttributeAccessIssue]
       
   def IsConnected(self) -> bool:
@@ -44,6 +96,150 @@ class DatabaseDriver():
       return True
     return False
   
+  # Closes the calling thread's session, the next query on this thread starts a fresh one with an empty identity map.
+  # Objects that were handed out stay usable, they are just detached.
+  def EndSession(self):
+    if (not self.IsConnected()):
+      return
+    
+    CurrentSession:Session = self.Database()
+    self.MaxIdentityMapSize = max(self.MaxIdentityMapSize, len(CurrentSession.identity_map) + self.GetReaderIdentityMapSize())
+    if (len(CurrentSession.new) > 0 or len(CurrentSession.dirty) > 0 or len(CurrentSession.deleted) > 0):
+      Logger.Log(LogLevel.Warn, f"Ending a database session with uncommitted changes, they will be rolled back: {len(CurrentSession.new)} new, {len(CurrentSession.dirty)} dirty, {len(CurrentSession.deleted)} deleted")
+    self.Database.remove()
+    if (self.Reader is not self.Database):
+      self.Reader.remove()
+    self.NumSessionsEnded += 1
+    
+  def GetReaderIdentityMapSize(self) -> int:
+    if (self.Reader is None or self.Reader is self.Database):
+      return 0
+    return len(self.Reader().identity_map)
+    
+  def GetSessionStats(self) -> str:
+    IdentityMapSize:int = len(self.Database().identity_map) + self.GetReaderIdentityMapSize() if self.IsConnected() else 0
+    ProcessMemory:str = "n/a"
+    # Resident memory is only easy to get at on linux, this is a gauge rather than an exact number anyways
+    if (os.path.exists("/proc/self/statm")):
+      with open("/proc/self/statm", "r") as StatFile:
+        ProcessMemory = f"{int(StatFile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0):.1f}MB"
+    return (f"Database Session: {IdentityMapSize} objects in identity map (max {self.MaxIdentityMapSize} at session end), "
+            f"{self.NumSessionsEnded} sessions ended, process memory {ProcessMemory}")
+  
+  ### Ban Index ###
+  def LoadBanIndex(self):
+    StartTime:float = time.perf_counter()
+    with self.BanIndexLock:
+      self.BanIndexChanges = []
+    # Read the sequence first, anything banned while loading gets picked up again by the next sync
+    self.KnownBanSeq = self.GetCounter("ban_seq")
+    NewBanIndex:set[int] = set(self.Reader.scalars(select(Ban.discord_user_id)))
+    with self.BanIndexLock:
+      for TargetId, IsBanned in self.BanIndexChanges:
+        if (IsBanned):
+          NewBanIndex.add(TargetId)
+        else:
+          NewBanIndex.discard(TargetId)
+      self.BanIndexChanges = None
+      self.BanIndex = NewBanIndex
+    LoadTime:float = (time.perf_counter() - StartTime) * 1000.0
+    Logger.Log(LogLevel.Debug, f"Loaded {len(NewBanIndex)} bans into the ban index in {LoadTime:.2f}ms")
+    
+  # Used for this instance's own writes, and by instances that learn about a ban change from the relay
+  def UpdateBanIndex(self, TargetId:int, IsBanned:bool):
+    with self.BanIndexLock:
+      if (self.BanIndexChanges is not None):
+        self.BanIndexChanges.append((TargetId, IsBanned))
+      if (IsBanned):
+        self.BanIndex.add(TargetId)
+      else:
+        self.BanIndex.discard(TargetId)
+      
+  # Catches the ban index and server cache up with writes made by any process (or any connection) since the last sync.
+  # When nothing changed this is a single read of the counters table.
+  def SyncExternalChanges(self) -> bool:
+    stmt = select(Counter.name, Counter.value).where(Counter.name.in_(["ban_seq", "num_bans", "servers_version"]))
+    Counters:dict[str, int] = {Name: Value for Name, Value in self.Reader.execute(stmt)}
+    HasChanged:bool = False
+    
+    ServersVersion:int = Counters.get("servers_version", 0)
+    if (ServersVersion != self.KnownServersVersion):
+      self.KnownServersVersion = ServersVersion
+      self.InvalidateServerCache()
+      self.NumServerCacheFlushes += 1
+      HasChanged = True
+    
+    # New bans always get a higher seq, so only the bans we have not seen yet need to be read
+    BanSeq:int = Counters.get("ban_seq", 0)
+    if (BanSeq > self.KnownBanSeq):
+      stmt = select(Ban.discord_user_id).where((Ban.seq > self.KnownBanSeq) & (Ban.seq <= BanSeq))
+      NewBans:list[int] = list(self.Reader.scalars(stmt))
+      with self.BanIndexLock:
+        self.BanIndex.update(NewBans)
+      self.KnownBanSeq = BanSeq
+      HasChanged = True
+    
+    # Unbans leave the sequence alone, they only show up as a count that no longer matches
+    if (Counters.get("num_bans", 0) != len(self.BanIndex)):
+      Logger.Log(LogLevel.Verbose, f"Ban index has {len(self.BanIndex)} entries but there are {Counters.get('num_bans', 0)} bans, reloading it")
+      self.LoadBanIndex()
+      self.NumBanIndexReloads += 1
+      HasChanged = True
+    
+    return HasChanged
+  
+  # An empty index has not been loaded yet, and one being reloaded may still be missing bans
+  def CanUseBanIndex(self) -> bool:
+    return self.BanIndexChanges is None and len(self.BanIndex) > 0
+  
+  def GetBanIndexMemoryUsage(self) -> int:
+    # The worker thread can change the index while this runs, so measure a snapshot of it
+    with self.BanIndexLock:
+      BanIndexSnapshot:frozenset[int] = frozenset(self.BanIndex)
+    return sys.getsizeof(BanIndexSnapshot) + sum(sys.getsizeof(UserId) for UserId in BanIndexSnapshot)
+  
+  def GetBanIndexStats(self) -> str:
+    MemoryUsageKB:float = self.GetBanIndexMemoryUsage() / 1024.0
+    return f"Ban Index: {len(self.BanIndex)} entries, {MemoryUsageKB:.1f}KB, {self.BanIndexHits} hits, {self.BanIndexMisses} misses, {self.NumBanRowFetches} row fetches, {self.NumBanIndexReloads} reloads, {self.NumServerCacheFlushes} server cache flushes"
+  
+  ### Server Cache ###
+  # The single fetch path for looking up a server, any server row lookup should go through here
+  def GetServerSnapshot(self, ServerId:int) -> ServerSnapshot|None:
+    CurrentTime:float = time.monotonic()
+    CacheEntry = self.ServerCache.get(ServerId)
+    if (CacheEntry is not None and CurrentTime - CacheEntry[1] < ConfigData["ServerCacheSeconds"]):
+      return CacheEntry[0]
+    
+    ServersVersion:int = self.KnownServersVersion
+    stmt = select(Server).where(Server.discord_server_id==ServerId)
+    server = self.Reader.scalars(stmt).first()
+    # Servers we don't know about are not cached, as another instance could be adding them
+    if (server is None):
+      self.ServerCache.pop(ServerId, None)
+      return None
+    
+    Snapshot:ServerSnapshot = ServerSnapshot(server)
+    # If a sync flushed the cache while we were reading, this row may already be older than the flush
+    if (ServersVersion == self.KnownServersVersion):
+      self.ServerCache[ServerId] = (Snapshot, CurrentTime)
+    return Snapshot
+  
+  # Drops the cached server row, or every cached server if no id is given
+  def InvalidateServerCache(self, ServerId:int|None=None):
+    if (ServerId is None):
+      self.ServerCache.clear()
+    else:
+      self.ServerCache.pop(ServerId, None)
+  
+  def GetLockStats(self) -> str:
+    return DatabaseContention.GetStats()
+  
+  def GetProfileReport(self, Reset:bool=False) -> str:
+    Report:str = DatabaseProfiler.GetReport()
+    if (Reset):
+      DatabaseProfiler.Reset()
+    return Report
+  
   def HasBackupDirectory(self) -> bool:
     DestinationLocation = os.path.abspath(Config.GetBackupLocation())
     if (not os.path.exists(DestinationLocation)):
@@ -51,26 +247,38 @@ class DatabaseDriver():
     
     return True
   
+  # Takes an online snapshot of the database with SQLite's backup API. This does not close the session,
+  # and the copy stays consistent even if other instances write while it is running.
   def Backup(self) -> bool:
     if (not self.HasBackupDirectory()):
       Logger.Log(LogLevel.Warn, "Backup directory does not exist!!")
       return False
     
-    if (self.IsConnected()):
-      self.Database.commit()
-      self.Close()
-    
-    # Copy the database file over here
+    StartTime:float = time.perf_counter()
     DestinationLocation = os.path.abspath(Config.GetBackupLocation())
-    shutil.copy(os.path.relpath(Config.GetDBFile()), DestinationLocation)
-    
-    # Rename the file
     NewFileName:str = time.strftime("%Y%m%d-%H%M%S.db")
-    NewFile = os.path.join(DestinationLocation, NewFileName)
-    OriginalFile = os.path.join(DestinationLocation, Config.GetDBFile())
-    os.rename(OriginalFile, NewFile)
-    Logger.Log(LogLevel.Log, f"Current database has been backed up to new file {NewFileName}")
-    self.Open()
+    NewFile:str = os.path.join(DestinationLocation, NewFileName)
+    # Write to a temporary file first so that a partial backup never looks like a real one
+    StagingFile:str = f"{NewFile}.tmp"
+    
+    SourceConnection = cast(Engine, self.Database.get_bind()).raw_connection()
+    BackupConnection = sqlite3.connect(StagingFile)
+    try:
+      SourceConnection.driver_connection.backup(BackupConnection, pages=ConfigData["BackupPagesPerStep"]) # pyright: ignore[reportOptionalMemberAccess]
+    except sqlite3.Error as ex:
+      Logger.Log(LogLevel.Error, f"Failed to back up the database, got error {str(ex)}")
+      BackupConnection.close()
+      os.remove(StagingFile)
+      return False
+    finally:
+      SourceConnection.close()
+    
+    BackupConnection.close()
+    os.replace(StagingFile, NewFile)
+    
+    BackupTime:float = time.perf_counter() - StartTime
+    BackupSizeMB:float = os.path.getsize(NewFile) / (1024.0 * 1024.0)
+    Logger.Log(LogLevel.Log, f"Current database has been backed up to new file {NewFileName} ({BackupSizeMB:.2f}MB in {BackupTime:.2f}s)")
     return True
   
   def CleanupBackups(self):
@@ -95,18 +303,24 @@ class DatabaseDriver():
         
   ### Adding/Updating/Removing Server Entries ###
   def AddBotGuilds(self, ListOwnerAndServerTuples, BotID:int):
-    BotAdditionUpdates:list[Server] = []
-    for Entry in ListOwnerAndServerTuples:
-      server = Server(
-        bot_instance_id = BotID,
-        discord_server_id = Entry.id,
-        owner_discord_user_id = Entry.owner_id,
-        activator_discord_user_id = -1
-      )
-      BotAdditionUpdates.append(server)
-    
-    self.Database.bulk_save_objects(BotAdditionUpdates)
+    self.StageBotGuilds(ListOwnerAndServerTuples, BotID)
     self.Database.commit()
+    for Entry in ListOwnerAndServerTuples:
+      self.InvalidateServerCache(Entry.id)
+  
+  # Leaves the commit to the caller, so that reconciliation can add and remove servers in one transaction
+  def StageBotGuilds(self, ListOwnerAndServerTuples, BotID:int):
+    BotAdditionUpdates = []
+    for Entry in ListOwnerAndServerTuples:
+      BotAdditionUpdates.append({
+        "bot_instance_id": BotID,
+        "discord_server_id": Entry.id,
+        "owner_discord_user_id": Entry.owner_id,
+        "activator_discord_user_id": -1
+      })
+    
+    if (len(BotAdditionUpdates) > 0):
+      self.Database.execute(insert(Server), BotAdditionUpdates)
 
     Logger.Log(LogLevel.Notice, f"Bot #{BotID} had {len(BotAdditionUpdates)} new server updates")
     
@@ -118,10 +332,11 @@ class DatabaseDriver():
       Logger.Log(LogLevel.Warn, f"Bot #{BotId} attempted to set new owner on non-assigned server: {ServerId}")
       return
     
-    server.owner_discord_user_id = str(NewOwnerId)
+    server.owner_discord_user_id = NewOwnerId
 
     self.Database.add(server)
     self.Database.commit()
+    self.InvalidateServerCache(ServerId)
     
   def SetFromServerSettings(self, ServerId:int, ServerSettings:BotSettingsPayload):
     stmt = select(Server).where(Server.discord_server_id==ServerId)
@@ -136,6 +351,7 @@ class DatabaseDriver():
     serverToChange.kick_sus_users = 1 if ServerSettings.KickSusUsers else 0
     self.Database.add(serverToChange)
     self.Database.commit()
+    self.InvalidateServerCache(ServerId)
        
   def RemoveServerEntry(self, ServerId:int, BotId:int):
     stmt = select(Server).where((Server.discord_server_id==ServerId) & (Server.bot_instance_id==BotId))
@@ -148,8 +364,10 @@ class DatabaseDriver():
     # Remove any cooldown entries if we exist in there
     self.RemoveServerCooldown(ServerId)
     
+    self.Database.execute(delete(BanLedger).where(BanLedger.discord_server_id==ServerId))
     self.Database.delete(server)
     self.Database.commit()
+    self.InvalidateServerCache(ServerId)
     
   def ToggleServerBan(self, ServerId:int, NewStatus:bool):
     stmt = select(Server).where(Server.discord_server_id==ServerId)
@@ -160,6 +378,7 @@ class DatabaseDriver():
     server.should_ban_in = int(NewStatus)
     self.Database.add(server)
     self.Database.commit()
+    self.InvalidateServerCache(ServerId)
     
   def ToggleServerReport(self, ServerId:int, NewStatus:bool):
     stmt = select(Server).where(Server.discord_server_id==ServerId)
@@ -170,43 +389,42 @@ class DatabaseDriver():
     server.can_report = int(NewStatus)
     self.Database.add(server)
     self.Database.commit()
+    self.InvalidateServerCache(ServerId)
 
   def SetBotActivationForOwner(self, Servers:list[int], IsActive:bool, BotId:int, OwnerId:int=-1, ActivatorId:int=-1):
-    NumActivationChanges = 0
-    NumActivationAdditions = 0
     ActiveVal = int(IsActive)
+    TargetServers:list[int] = list(set(Servers))
     
-    for ServerId in Servers:
-      # If we're not in the server, and we've been given an OwnerId, then create the server
-      # IsActive SHOULD be False when passed in this manner
-      if (not self.IsInServer(ServerId)):
-        if (OwnerId > 0):
-          NumActivationAdditions += 1
-
-          serverToChange = Server(
-            bot_instance_id = BotId,
-            discord_server_id = ServerId,
-            owner_discord_user_id = OwnerId,
-            activation_state = ActiveVal,
-            activator_discord_user_id = -1, 
-          )
-
-          self.Database.add(serverToChange)
-      # Otherwise, fetch the existing server and update it
-      else:
-        NumActivationChanges += 1
-
-        stmt = select(Server).where(Server.discord_server_id==ServerId)
-        serverToChange = self.Database.scalars(stmt).first()
-        if (serverToChange is None):
-          Logger.Log(LogLevel.Warn, f"Attempted to change server info for {ServerId} but DB entry was missing!")
-          return
-        
-        serverToChange.activation_state = ActiveVal
-        serverToChange.activator_discord_user_id = str(ActivatorId)
-
-        self.Database.add(serverToChange)
+    # Resolve which of the servers already have an entry
+    ExistingServers:set[int] = set()
+    for Chunk in ChunkList(TargetServers):
+      ExistingServers.update(self.Database.scalars(select(Server.discord_server_id).where(Server.discord_server_id.in_(Chunk))))
+    
+    NumActivationChanges = len(ExistingServers)
+    NumActivationAdditions = 0
 
+    # If we've been given an OwnerId, then create the servers we are not in, and update the rest in the same statement.
+    # IsActive SHOULD be False when passed in this manner
+    if (OwnerId > 0):
+      NumActivationAdditions = len(TargetServers) - NumActivationChanges
+      stmt = sqlite_insert(Server)
+      stmt = stmt.on_conflict_do_update(index_elements=[Server.discord_server_id], set_={
+        "activation_state": stmt.excluded.activation_state,
+        "activator_discord_user_id": str(ActivatorId),
+        "updated_at": func.now()
+      })
+      self.Database.execute(stmt, [{
+        "bot_instance_id": BotId,
+        "discord_server_id": ServerId,
+        "owner_discord_user_id": OwnerId,
+        "activation_state": ActiveVal,
+        "activator_discord_user_id": -1
+      } for ServerId in TargetServers])
+    # Otherwise, only update the servers that exist
+    elif (NumActivationChanges > 0):
+      for Chunk in ChunkList(list(ExistingServers)):
+        self.Database.execute(update(Server).where(Server.discord_server_id.in_(Chunk))
+                              .values(activation_state=ActiveVal, activator_discord_user_id=str(ActivatorId)))
 
     if (NumActivationAdditions > 0):
       Logger.Log(LogLevel.Debug, f"We have {NumActivationAdditions} additions")
@@ -215,71 +433,56 @@ class DatabaseDriver():
       Logger.Log(LogLevel.Notice, f"Server activation changed in {NumActivationChanges} servers to {str(IsActive)} by {ActivatorId}")
 
     self.Database.commit()
+    for ServerId in TargetServers:
+      self.InvalidateServerCache(ServerId)
     
   ### Reconcile Servers ###
-  def ReconcileServers(self, Servers, BotId:int):       
-    NewAdditions = []
-    # Discord Guild IDs that we will later use to remove
-    ServersIn:list[int] = []
+  def ReconcileServers(self, Servers, BotId:int):
+    StartTime:float = time.perf_counter()
     # Control server id
     ControlServerID:int = ConfigData["ControlServer"]
-    # Loop through all the servers we are in and grab their guild ids
-    for DiscordServer in Servers:
-      # Check to see if we know about this server already.
-      if (not self.IsInServer(DiscordServer.id)):
-        NewAdditions.append(DiscordServer)
-      
-      # Ignore the control server but add any other servers to this list.
-      if (DiscordServer.id != ControlServerID):
-        ServersIn.append(DiscordServer.id)
+    # Discord guilds this bot is currently in, keyed by their guild id
+    GuildsIn = {DiscordServer.id: DiscordServer for DiscordServer in Servers}
+    # Every server that any instance knows about, guilds only count as new if no one has them yet
+    KnownServers:set[int] = set(self.Database.scalars(select(Server.discord_server_id)))
+    # All the servers the database thinks this bot is in, ignoring the control server
+    stmt = select(Server.discord_server_id).where((Server.discord_server_id!=ControlServerID) & (Server.bot_instance_id==BotId))
+    ServersWithThisBot:set[int] = set(self.Database.scalars(stmt))
+    Logger.Log(LogLevel.Debug, f"Bot #{BotId} server count: {len(ServersWithThisBot)} with discord in {len(GuildsIn)}")
     
     # Add any new servers we have found
+    NewAdditions = [GuildsIn[ServerId] for ServerId in GuildsIn.keys() - KnownServers]
     if (len(NewAdditions) > 0):
-      self.AddBotGuilds(NewAdditions, BotId)
-
-    # Check the current list of servers vs what the database has
-    # to see if there are any servers we need to remove
-    stmt = select(Server).where((Server.discord_server_id!=ControlServerID) & (Server.bot_instance_id==BotId))
-    AllServersWithThisBot = list(self.Database.scalars(stmt).all())
-    Logger.Log(LogLevel.Debug, f"Bot #{BotId} server count: {len(AllServersWithThisBot)} with discord in {len(ServersIn)}")
-    # Go through all the servers in the database for this bot
-    for InServerId in AllServersWithThisBot:
-      ServerId = int(InServerId.discord_server_id)
-      try:
-        # If we are in the server, then we remove the entry from the list of servers
-        # we are in. This is because this list will be used later to remove entries that
-        # mismatch
-        ServersIn.remove(ServerId)
-      except ValueError:
-        # If the entry fails to be removed from the discord guild list, then
-        # it's a floating entry in the database and should be removed.
-        ServersIn.append(ServerId)
-        continue
-        
-    if (len(ServersIn) > 0):
-      Logger.Log(LogLevel.Notice, f"Bot needs to reconcile {len(ServersIn)} servers from the list")
+      self.StageBotGuilds(NewAdditions, BotId)
+
+    # Any server the database has for this bot that discord does not is a floating entry and should be removed.
+    ServersToRemove:list[int] = list(ServersWithThisBot - GuildsIn.keys())
+    if (len(ServersToRemove) > 0):
+      Logger.Log(LogLevel.Notice, f"Bot needs to reconcile {len(ServersToRemove)} servers from the list")
+      for RemovalChunk in ChunkList(ServersToRemove):
+        self.Database.execute(delete(ExhaustedServer).where(ExhaustedServer.discord_server_id.in_(RemovalChunk)))
+        self.Database.execute(delete(BanLedger).where(BanLedger.discord_server_id.in_(RemovalChunk)))
+        self.Database.execute(delete(Server).where((Server.discord_server_id.in_(RemovalChunk)) & (Server.bot_instance_id==BotId)))
     else:
       Logger.Log(LogLevel.Debug, "Bot does not need to remove any servers from last run.")
-      return
-
-    for ServerToRemove in ServersIn:
-      self.RemoveServerEntry(ServerToRemove, BotId)
+    
+    self.Database.commit()
+    
+    for NewServer in NewAdditions:
+      self.InvalidateServerCache(NewServer.id)
+    for ServerToRemove in ServersToRemove:
+      self.InvalidateServerCache(ServerToRemove)
       Logger.Log(LogLevel.Warn, f"Bot #{BotId} has been removed from server {ServerToRemove}")
+    
+    ReconcileTime:float = (time.perf_counter() - StartTime) * 1000.0
+    Logger.Log(LogLevel.Notice, f"Bot #{BotId} reconciled {len(GuildsIn)} servers ({len(NewAdditions)} added, {len(ServersToRemove)} removed) in {ReconcileTime:.2f}ms")
 
   ### Query Status ###
   def IsInServer(self, ServerId:int) -> bool:
-    stmt = select(Server).where(Server.discord_server_id==ServerId)
-    server = self.Database.scalars(stmt).first()
-    if (server is None):
-      return False
-    return True
+    return self.GetServerSnapshot(ServerId) is not None
   
   def IsActivatedInServer(self, ServerId:int) -> bool:
-    if (not self.IsInServer(ServerId)):
-      return False
-
-    stmt = select(Server).where(Server.discord_server_id==ServerId)
-    server = self.Database.scalars(stmt).first()
+    server:ServerSnapshot|None = self.GetServerSnapshot(ServerId)
     if (server is None):
       return False
 
@@ -289,11 +492,7 @@ class DatabaseDriver():
     return False
   
   def CanServerReport(self, ServerId:int) -> bool:
-    if (not self.IsInServer(ServerId)):
-      return False
-
-    stmt = select(Server).where(Server.discord_server_id==ServerId)
-    server = self.Database.scalars(stmt).first()
+    server:ServerSnapshot|None = self.GetServerSnapshot(ServerId)
     if (server is None):
       return False
 
@@ -303,23 +502,31 @@ class DatabaseDriver():
     return False
 
   def DoesBanExist(self, TargetId:int) -> bool:
-    stmt = select(Ban).where(Ban.discord_user_id==TargetId)
-    result = self.Database.scalars(stmt).first()
-
-    if (result is None):
-      return False
-
-    return True
+    if (not self.CanUseBanIndex()):
+      self.BanIndexMisses += 1
+      stmt = select(Ban.seq).where(Ban.discord_user_id==TargetId).limit(1)
+      return self.Reader.scalars(stmt).first() is not None
+    
+    self.BanIndexHits += 1
+    return TargetId in self.BanIndex
   
   # Returns ban information
   def GetBanInfo(self, TargetId:int) -> Ban|None:
+    # Most lookups are for users that are not banned, which the index can answer without the database
+    if (self.CanUseBanIndex()):
+      self.BanIndexHits += 1
+      if (TargetId not in self.BanIndex):
+        return None
+    else:
+      self.BanIndexMisses += 1
+    
+    self.NumBanRowFetches += 1
     stmt = select(Ban).where(Ban.discord_user_id==TargetId)
-    return self.Database.scalars(stmt).first()
+    return self.Reader.scalars(stmt).first()
   
   # Returns server information
-  def GetServerInfo(self, ServerId:int) -> Server|None:
-    stmt = select(Server).where(Server.discord_server_id==ServerId)
-    return self.Database.scalars(stmt).first()
+  def GetServerInfo(self, ServerId:int) -> ServerSnapshot|None:
+    return self.GetServerSnapshot(ServerId)
 
   ### Adding/Removing Bans ###
   def AddBan(self, TargetId:int, BannerName:str, BannerId:int, ThreadId:int|None) -> BanAction:
@@ -337,6 +544,7 @@ class DatabaseDriver():
 
     self.Database.add(ban)
     self.Database.commit()
+    self.UpdateBanIndex(TargetId, True)
 
     return BanAction.Banned
   
@@ -349,6 +557,7 @@ class DatabaseDriver():
 
     self.Database.delete(ban)
     self.Database.commit()
+    self.UpdateBanIndex(TargetId, False)
 
     return BanAction.Unbanned
   
@@ -370,6 +579,7 @@ class DatabaseDriver():
     
     banToChange.evidence_thread = ThreadId
     self.Database.add(banToChange)
+    self.Database.commit()
   
   ### Getting Server Information ###
   def GetAllServersOfOwner(self, OwnerId:int) -> list[Server]:
@@ -382,18 +592,16 @@ class DatabaseDriver():
     return list(servers)
     
   def GetOwnerOfServer(self, ServerId:int) -> int|None:
-    stmt = select(Server).where(Server.discord_server_id==ServerId)
-    server = self.Database.scalars(stmt).first()
+    server:ServerSnapshot|None = self.GetServerSnapshot(ServerId)
 
     if (server is None):
       Logger.Log(LogLevel.Warn, f"Tried to load owner for non existant server: {ServerId}!")
       return None
 
-    return int(server.owner_discord_user_id)
+    return server.owner_discord_user_id
   
   def GetBotIdForServer(self, ServerId:int) -> int|None:
-    stmt = select(Server).where(Server.discord_server_id==ServerId)
-    server = self.Database.scalars(stmt).first()
+    server:ServerSnapshot|None = self.GetServerSnapshot(ServerId)
 
     if (server is None):
       Logger.Log(LogLevel.Warn, f"Tried to load bot instance for non existant server: {ServerId}!")
@@ -402,8 +610,7 @@ class DatabaseDriver():
     return int(server.bot_instance_id)
   
   def GetChannelIdForServer(self, ServerId:int) -> int|None:
-    stmt = select(Server).where(Server.discord_server_id==ServerId)
-    server = self.Database.scalars(stmt).first()
+    server:ServerSnapshot|None = self.GetServerSnapshot(ServerId)
 
     if (server is None):
       Logger.Log(LogLevel.Warn, f"Tried to load bot instance for non existant server: {ServerId}!")
@@ -415,19 +622,119 @@ class DatabaseDriver():
     
     return ReturnValue
 
-  def GetAllBans(self, NumLastActions:int=0) -> list[Ban]:
-    stmt = select(Ban)
+  ### Ban Iteration ###
+  # Bans are walked in sequence order with keyset pagination, so every page is a range scan on ix_bans_seq 
+  # and only one page is held in memory. Cursors are the seq of the last ban that was read, 0 starts from the first ban.
+  # Passing MissingFromServer skips every ban that the ban ledger says has already landed in that server.
+  def GetBanPage(self, AfterSeq:int=0, PageSize:int=BanPageSize, MissingFromServer:int|None=None) -> list[Row]:
+    if (MissingFromServer is not None):
+      # Jump over the ledger range the cursor is sitting in, rather than checking every ban in it
+      stmt = select(BanLedger.last_seq).where((BanLedger.discord_server_id==MissingFromServer) & (BanLedger.first_seq <= AfterSeq + 1))
+      CoveredUpTo:int = self.Reader.scalars(stmt.order_by(desc(BanLedger.first_seq)).limit(1)).first() or 0
+      AfterSeq = max(AfterSeq, CoveredUpTo)
+    
+    stmt = select(Ban.seq, Ban.discord_user_id, Ban.assigner_discord_user_name).where(Ban.seq > AfterSeq)
+    if (MissingFromServer is not None):
+      stmt = stmt.where(self.IsMissingFromLedger(MissingFromServer))
+      
+    stmt = stmt.order_by(asc(Ban.seq)).limit(PageSize)
+    return list(self.Reader.execute(stmt).all())
+  
+  def IterateBans(self, AfterSeq:int=0, PageSize:int=BanPageSize, MissingFromServer:int|None=None):
+    for Page in self.IterateBanPages(AfterSeq, PageSize, MissingFromServer):
+      yield from Page
+  
+  # Each page is only fetched once the one before it has been consumed
+  def IterateBanPages(self, AfterSeq:int=0, PageSize:int=BanPageSize, MissingFromServer:int|None=None):
+    Cursor:int = AfterSeq
+    while (True):
+      Page:list[Row] = self.GetBanPage(Cursor, PageSize, MissingFromServer)
+      if (len(Page) > 0):
+        yield Page
+      if (len(Page) < PageSize):
+        return
+      Cursor = Page[-1].seq
+  
+  # Gets the cursor that starts iteration at the last NumLastActions bans
+  def GetBanSeqForLastActions(self, NumLastActions:int=0) -> int:
+    if (NumLastActions <= 0):
+      return 0
     
-    if (NumLastActions):
-      stmt = stmt.order_by(desc(Ban.created_at)).limit(NumLastActions)
-    else:
-      stmt = stmt.order_by(asc(Ban.created_at))
+    stmt = select(Ban.seq).order_by(desc(Ban.seq)).offset(NumLastActions).limit(1)
+    return self.Reader.scalars(stmt).first() or 0
+  
+  # Sequence number of the last ban that was handed out, including bans that have since been removed
+  def GetLastBanSeq(self) -> int:
+    return self.GetCounter("ban_seq")
+  
+  def GetBanSeq(self, TargetId:int) -> int|None:
+    stmt = select(Ban.seq).where(Ban.discord_user_id==TargetId)
+    return self.Reader.scalars(stmt).first()
+  
+  ### Ban Ledger ###
+  # Ledger ranges never overlap, so only the closest range starting at or before a ban can cover it. 
+  # This keeps the check down to a single index seek per ban, no matter how many ranges the server has.
+  @staticmethod
+  def IsMissingFromLedger(ServerId:int):
+    ClosestRange = (select(BanLedger.last_seq).where((BanLedger.discord_server_id==ServerId) & (BanLedger.first_seq <= Ban.seq))
+                    .order_by(desc(BanLedger.first_seq)).limit(1).correlate(Ban).scalar_subquery())
+    return func.coalesce(ClosestRange, 0) < Ban.seq
+  
+  # Records that the bans from FirstSeq to LastSeq have landed in all of the given servers, merging with any ranges they touch
+  def RecordAppliedBans(self, Servers:list[int], FirstSeq:int, LastSeq:int):
+    if (len(Servers) == 0 or FirstSeq <= 0 or LastSeq < FirstSeq):
+      return
     
-    return list(self.Database.scalars(stmt).all())
+    # A range touches this one if nothing but removed bans sit between them
+    PrevSeq:int = self.Database.scalars(select(func.max(Ban.seq)).where(Ban.seq < FirstSeq)).first() or 0
+    NextSeq:int = self.Database.scalars(select(func.min(Ban.seq)).where(Ban.seq > LastSeq)).first() or LastSeq + 1
+    
+    for Chunk in ChunkList(list(set(Servers))):
+      TouchingRanges = (BanLedger.discord_server_id.in_(Chunk)) & (BanLedger.last_seq >= PrevSeq) & (BanLedger.first_seq <= NextSeq)
+      stmt = select(BanLedger.discord_server_id, func.min(BanLedger.first_seq), func.max(BanLedger.last_seq)).where(TouchingRanges).group_by(BanLedger.discord_server_id)
+      MergedRanges:dict[int, tuple[int, int]] = {ServerId: (First, Last) for ServerId, First, Last in self.Database.execute(stmt)}
+      if (len(MergedRanges) > 0):
+        self.Database.execute(delete(BanLedger).where(TouchingRanges))
+      
+      NewRanges = []
+      for ServerId in Chunk:
+        First, Last = MergedRanges.get(ServerId, (FirstSeq, LastSeq))
+        NewRanges.append({"discord_server_id": ServerId, "first_seq": min(First, FirstSeq), "last_seq": max(Last, LastSeq)})
+      self.Database.execute(insert(BanLedger), NewRanges)
+    
+    self.Database.commit()
+  
+  # Number of bans that still exist and have landed in each server, None gets every server in the ledger
+  def GetAppliedBanCounts(self, Servers:list[int]|None=None) -> dict[int, int]:
+    # Every count is a range scan on ix_bans_seq. Ranges merge as they fill in, so a server that has every ban has one range over
+    # the whole table, which is cheaper to count as all bans minus the ones on either side of it than by scanning the inside.
+    NumBans = select(Counter.value).where(Counter.name=="num_bans").scalar_subquery()
+    MaxSeq = select(Counter.value).where(Counter.name=="ban_seq").scalar_subquery()
+    def CountBans(Condition):
+      return select(func.count()).select_from(Ban).where(Condition).correlate(BanLedger).scalar_subquery()
+    def CountBansUpTo(Seq):
+      return case((Seq <= MaxSeq - Seq, CountBans(Ban.seq <= Seq)), else_=NumBans - CountBans(Ban.seq > Seq))
+    
+    FirstSeq, LastSeq = BanLedger.first_seq, BanLedger.last_seq
+    EdgeScanSize = func.min(LastSeq, MaxSeq - LastSeq) + func.min(FirstSeq, MaxSeq - FirstSeq)
+    NumInRange = case((LastSeq - FirstSeq <= EdgeScanSize, CountBans(Ban.seq.between(FirstSeq, LastSeq))),
+                      else_=CountBansUpTo(LastSeq) - CountBansUpTo(FirstSeq - 1))
+    stmt = select(BanLedger.discord_server_id, func.sum(NumInRange)).group_by(BanLedger.discord_server_id)
+    if (Servers is not None):
+      stmt = stmt.where(BanLedger.discord_server_id.in_(Servers))
+    return {ServerId: NumApplied for ServerId, NumApplied in self.Reader.execute(stmt)}
   
   def GetAllServers(self, FilterOnlyActivated:bool=False, OfInstance:int=-1, FilterBanability:bool=False, FilterKicking:bool=False) -> list[Server]:
-    stmt = select(Server)
-
+    stmt = self.FilterServers(select(Server), FilterOnlyActivated, OfInstance, FilterBanability, FilterKicking)
+    return list(self.Reader.scalars(stmt).all())
+  
+  # Same as GetAllServers but only selects the discord server ids, nothing gets loaded into the session
+  def GetAllServerIds(self, FilterOnlyActivated:bool=False, OfInstance:int=-1, FilterBanability:bool=False, FilterKicking:bool=False) -> list[int]:
+    stmt = self.FilterServers(select(Server.discord_server_id), FilterOnlyActivated, OfInstance, FilterBanability, FilterKicking)
+    return list(self.Reader.scalars(stmt).all())
+  
+  @staticmethod
+  def FilterServers(stmt, FilterOnlyActivated:bool=False, OfInstance:int=-1, FilterBanability:bool=False, FilterKicking:bool=False):
     if (FilterOnlyActivated):
       stmt = stmt.where(Server.activation_state==True)
 
@@ -440,17 +747,17 @@ class DatabaseDriver():
     if (FilterKicking):
       stmt = stmt.where(Server.kick_sus_users==1)
 
-    return list(self.Database.scalars(stmt).all())
+    return stmt
   
   def GetAllActivatedServers(self, OfInstance:int=-1) -> list[Server]:
     return self.GetAllServers(True, OfInstance)
   
-  def GetAllActivatedServersForAction(self, OfInstance:int=-1, Action:ModerationAction=ModerationAction.Nothing) -> list[Server]:
+  def GetAllActivatedServerIdsForAction(self, OfInstance:int=-1, Action:ModerationAction=ModerationAction.Nothing) -> list[int]:
     match Action:
       case ModerationAction.Ban | ModerationAction.Unban:
-        return self.GetAllServers(True, OfInstance, True)
+        return self.GetAllServerIds(True, OfInstance, True)
       case ModerationAction.Kick:
-        return self.GetAllServers(True, OfInstance, False, True)
+        return self.GetAllServerIds(True, OfInstance, False, True)
 
     return []
   
@@ -485,7 +792,8 @@ class DatabaseDriver():
     self.Database.add(exUpdate)
     self.Database.commit()
   
-  def UpdateServerCooldown(self, ServerId:int, NumCompleted:int) -> int:
+  # Moves the server's cooldown cursor to the last ban sequence it has applied, creating the cooldown if it doesn't exist.
+  def UpdateServerCooldown(self, ServerId:int, LastAppliedSeq:int) -> int:
     exhaustedUpdate:ExhaustedServer|None = self.GetServerCooldown(ServerId)
     
     # Create if it doesn't exist.
@@ -493,16 +801,17 @@ class DatabaseDriver():
       exhaustedUpdate = ExhaustedServer()
       exhaustedUpdate.discord_server_id = ServerId
     
-    if (exhaustedUpdate.current_pos is not None and exhaustedUpdate.current_pos > 0):
-      exhaustedUpdate.current_pos = exhaustedUpdate.current_pos + NumCompleted
-    else:
-      exhaustedUpdate.current_pos = NumCompleted
-    
+    exhaustedUpdate.last_seq = max(LastAppliedSeq, 0)
     exhaustedUpdate.is_processing = False
     self.Database.add(exhaustedUpdate)
     self.Database.commit()
     
-    return exhaustedUpdate.current_pos
+    return exhaustedUpdate.last_seq
+  
+  # Cursor to resume applying bans from for a server in cooldown, 0 if the server is not in cooldown
+  def GetServerCooldownSeq(self, ServerId:int) -> int:
+    stmt = select(ExhaustedServer.last_seq).where(ExhaustedServer.discord_server_id==ServerId)
+    return self.Reader.scalars(stmt).first() or 0
   
   def RemoveServerCooldown(self, ServerId:int):
     server = self.GetServerCooldown(ServerId)
@@ -513,6 +822,10 @@ class DatabaseDriver():
     self.Database.commit()
 
   def GetExhaustedServers(self, OverrideTime:bool=False):
+    return self.Database.scalars(self.GetExhaustedServersQuery(OverrideTime)).all()
+  
+  @staticmethod
+  def GetExhaustedServersQuery(OverrideTime:bool=False):
     stmt = select(ExhaustedServer)
     
     if (OverrideTime is False):
@@ -520,26 +833,107 @@ class DatabaseDriver():
       BeginningOfTime:datetime = datetime.fromtimestamp(0)
       ADayAgo:timedelta = timedelta(hours=CooldownWaitTime)
       ADayAgoTime:datetime = datetime.now(timezone.utc) - ADayAgo
-      print(ADayAgoTime)
       stmt = stmt.where(ExhaustedServer.last_run.between(BeginningOfTime, ADayAgoTime))
-    return self.Database.scalars(stmt).all()
+    return stmt
   
   def GetAllExhaustedServers(self):
-    return self.Database.scalars(select(ExhaustedServer)).all()
+    return self.Reader.scalars(select(ExhaustedServer)).all()
+  
+  ### Relay Outbox ###
+  # The relay server calls these through the AsyncDatabase worker, so every one of them ends its transaction before returning
+  # Messages are (message id, message type, destination, frame), the relay server hands out the ids
+  def AppendRelayOutbox(self, Messages:list[tuple[int, int, int, bytes]]):
+    if (len(Messages) == 0):
+      return
+    
+    self.Database.execute(insert(RelayOutbox), [{"id": MessageId, "message_type": MessageType, "destination": Destination, "frame": Frame} 
+                                                for MessageId, MessageType, Destination, Frame in Messages])
+    self.Database.commit()
+  
+  def GetLastRelayOutboxId(self) -> int:
+    LastId:int = self.Database.scalars(select(func.max(RelayOutbox.id))).first() or 0
+    self.Database.commit()
+    return LastId
+  
+  # Messages after the given offset that should be replayed to an instance, oldest first
+  def GetRelayOutboxAfter(self, InstanceId:int, AfterOffset:int, MessageTypes:list[int], Limit:int, IncludeBroadcasts:bool=True) -> list[tuple[int, bytes]]:
+    IsForInstance = (RelayOutbox.destination == InstanceId)
+    if (IncludeBroadcasts):
+      IsForInstance = IsForInstance | (RelayOutbox.destination == -1)
+    stmt = select(RelayOutbox.id, RelayOutbox.frame).where(RelayOutbox.id > AfterOffset).where(RelayOutbox.message_type.in_(MessageTypes)).where(IsForInstance).order_by(RelayOutbox.id).limit(Limit)
+    Messages:list[tuple[int, bytes]] = [(MessageId, Frame) for MessageId, Frame in self.Database.execute(stmt)]
+    self.Database.commit()
+    return Messages
+  
+  def GetRelayOffsets(self) -> dict[int, int]:
+    Offsets:dict[int, int] = {InstanceId: Offset for InstanceId, Offset in self.Database.execute(select(RelayOffset.instance_id, RelayOffset.last_offset))}
+    self.Database.commit()
+    return Offsets
+  
+  def SaveRelayOffsets(self, Offsets:dict[int, int]):
+    if (len(Offsets) == 0):
+      return
+    
+    stmt = sqlite_insert(RelayOffset).values([{"instance_id": InstanceId, "last_offset": Offset} for InstanceId, Offset in Offsets.items()])
+    # Offsets only ever move forward
+    stmt = stmt.on_conflict_do_update(index_elements=[RelayOffset.instance_id], 
+                                      set_={"last_offset": func.max(RelayOffset.last_offset, stmt.excluded.last_offset), "updated_at": func.now()})
+    self.Database.execute(stmt)
+    self.Database.commit()
+  
+  # Drops messages every instance has consumed, and anything older than the retention window regardless
+  def PruneRelayOutbox(self, ConsumedOffset:int, RetentionHours:float) -> int:
+    OldestToKeep:datetime = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=RetentionHours)
+    Result = self.Database.execute(delete(RelayOutbox).where((RelayOutbox.id <= ConsumedOffset) | (RelayOutbox.created_at < OldestToKeep)))
+    self.Database.commit()
+    return Result.rowcount # pyright: ignore[reportAttributeAccessIssue]
   
   ### Stats ###
+  # Counters are maintained by triggers on the tables they count, see StatTriggers
+  def GetCounter(self, Name:str) -> int:
+    stmt = select(Counter.value).where(Counter.name==Name)
+    return self.Reader.scalars(stmt).first() or 0
+  
   def GetNumBans(self) -> int:
-    stmt = select(func.count()).select_from(Ban)
-    return self.Database.scalars(stmt).first() or 0
+    return self.GetCounter("num_bans")
+  
+  def GetNumBansAfter(self, AfterSeq:int, MissingFromServer:int|None=None) -> int:
+    stmt = select(func.count()).select_from(Ban).where(Ban.seq > AfterSeq)
+    if (MissingFromServer is not None):
+      stmt = stmt.where(self.IsMissingFromLedger(MissingFromServer))
+    return self.Reader.scalars(stmt).first() or 0
   
   def GetNumActivatedServers(self) -> int:
-    stmt = select(func.count()).select_from(Server).where(Server.activation_state==True)
-    return self.Database.scalars(stmt).first() or 0
+    return self.GetCounter("num_activated_servers")
   
   def GetNumServers(self) -> int:
-    stmt = select(func.count()).select_from(Server)
-    return self.Database.scalars(stmt).first() or 0
+    return self.GetCounter("num_servers")
   
   def GetNumExhaustedServers(self) -> int:
-    stmt = select(func.count()).select_from(ExhaustedServer)
-    return self.Database.scalars(stmt).first() or 0
\ No newline at end of file
+    return self.GetCounter("num_exhausted_servers")
+  
+  # Recounts every stat counter and fixes any that have drifted, returns a description of what was fixed
+  def RebuildStats(self) -> str:
+    StoredValues:dict[str, int] = dict(self.Database.execute(select(Counter.name, Counter.value)).tuples().all())
+    ActualValues:dict[str, int] = {Name: self.Database.scalars(CountQuery).first() or 0 for Name, CountQuery in StatCounters.items()}
+    # End the read so the fixes below recount inside their own write transaction
+    self.Database.commit()
+    
+    Mismatches:list[str] = []
+    for Name, ActualValue in ActualValues.items():
+      StoredValue:int|None = StoredValues.get(Name)
+      if (StoredValue == ActualValue):
+        continue
+      
+      Mismatches.append(f"{Name} {StoredValue} -> {ActualValue}")
+      if (StoredValue is None):
+        self.Database.execute(insert(Counter).values(name=Name, value=StatCounters[Name].scalar_subquery()))
+      else:
+        self.Database.execute(update(Counter).where(Counter.name==Name).values(value=StatCounters[Name].scalar_subquery()))
+    self.Database.commit()
+    
+    if (len(Mismatches) == 0):
+      return "All stat counters are consistent"
+    
+    Logger.Log(LogLevel.Warn, f"Stat counters had drifted and were rebuilt: {', '.join(Mismatches)}")
+    return f"Rebuilt stat counters: {', '.join(Mismatches)}"
\ No newline at end of file
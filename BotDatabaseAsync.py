@@ -0,0 +1,81 @@
+# Async facade for the DatabaseDriver. Database calls are run on a dedicated worker thread
+# so that slow commits and lock waits do not stall the discord event loop (and the gateway heartbeats).
+from BotDatabase import DatabaseDriver, BanPageSize
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, time
+
+__all__ = ["AsyncDatabaseDriver"]
+
+class AsyncDatabaseDriver():
+  Driver:DatabaseDriver = None # pyright: ignore[reportAssignmentType]
+  # Latency instrumentation, all times are in seconds
+  NumCalls:int = 0
+  TotalQueueTime:float = 0.0
+  MaxQueueTime:float = 0.0
+  TotalRunTime:float = 0.0
+  MaxRunTime:float = 0.0
+  SlowestCall:str = ""
+  
+  def __init__(self, InDriver:DatabaseDriver):
+    self.Driver = InDriver
+    # A single worker keeps database access serialized, just like it was when it ran on the event loop
+    self.Executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Database")
+    
+  # Allows any DatabaseDriver function to be awaited, i.e. await AsyncDatabase.AddBan(...)
+  def __getattr__(self, Name:str):
+    DriverFunction = getattr(self.Driver, Name)
+    if (not callable(DriverFunction)):
+      raise AttributeError(f"DatabaseDriver.{Name} is not a function")
+
+    async def RunOnWorker(*args, **kwargs):
+      return await self.Run(DriverFunction, *args, **kwargs)
+    return RunOnWorker
+  
+  # Async version of DatabaseDriver.IterateBans, the driver's page iterator is stepped on the worker thread
+  # so that each page is fetched there as the caller consumes the last one
+  async def IterateBans(self, AfterSeq:int=0, PageSize:int=BanPageSize, MissingFromServer:int|None=None):
+    Pages = self.Driver.IterateBanPages(AfterSeq, PageSize, MissingFromServer)
+    while (True):
+      Page = await self.Run(next, Pages, None)
+      if (Page is None):
+        return
+      for BanRow in Page:
+        yield BanRow
+  
+  async def Run(self, DriverFunction, *args, **kwargs):
+    QueuedAt:float = time.perf_counter()
+    
+    def Execute():
+      StartedAt:float = time.perf_counter()
+      try:
+        return DriverFunction(*args, **kwargs)
+      finally:
+        # Every worker call is its own unit of work, so the worker's identity map never outlives a call
+        self.Driver.EndSession()
+        self.RecordCall(DriverFunction.__name__, StartedAt - QueuedAt, time.perf_counter() - StartedAt)
+    
+    return await asyncio.get_running_loop().run_in_executor(self.Executor, Execute)
+  
+  def RecordCall(self, Name:str, QueueTime:float, RunTime:float):
+    self.NumCalls += 1
+    self.TotalQueueTime += QueueTime
+    self.TotalRunTime += RunTime
+    self.MaxQueueTime = max(self.MaxQueueTime, QueueTime)
+    if (RunTime > self.MaxRunTime):
+      self.MaxRunTime = RunTime
+      self.SlowestCall = Name
+  
+  def ResetStats(self):
+    self.NumCalls = 0
+    self.TotalQueueTime = self.MaxQueueTime = 0.0
+    self.TotalRunTime = self.MaxRunTime = 0.0
+    self.SlowestCall = ""
+  
+  def GetStats(self) -> str:
+    if (self.NumCalls == 0):
+      return "Database Worker: no calls"
+    
+    AvgQueueMS:float = (self.TotalQueueTime / self.NumCalls) * 1000.0
+    AvgRunMS:float = (self.TotalRunTime / self.NumCalls) * 1000.0
+    return (f"Database Worker: {self.NumCalls} calls, queue avg {AvgQueueMS:.2f}ms max {self.MaxQueueTime * 1000.0:.2f}ms, "
+            f"run avg {AvgRunMS:.2f}ms max {self.MaxRunTime * 1000.0:.2f}ms ({self.SlowestCall})")
\ No newline at end of file
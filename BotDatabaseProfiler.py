@@ -0,0 +1,134 @@
+from Config import Config
+from sqlalchemy import Engine, event
+import bisect, re, sys, threading, time
+
+__all__ = ["DatabaseProfiler"]
+
+ConfigData:Config = Config()
+
+# Upper bounds (in ms) for the latency histogram buckets, anything slower lands in the last bucket
+LatencyBucketsMS:list[float] = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0]
+# Frames that belong to the database driver, the outermost one is what the statement gets charged to
+DriverModuleName:str = "BotDatabase"
+
+class ProfileEntry():
+  __slots__ = ("NumCalls", "TotalTime", "MaxTime", "NumRows", "NumLockWaits", "Buckets")
+
+  def __init__(self):
+    self.NumCalls:int = 0
+    self.TotalTime:float = 0.0
+    self.MaxTime:float = 0.0
+    self.NumRows:int = 0
+    self.NumLockWaits:int = 0
+    self.Buckets:list[int] = [0] * (len(LatencyBucketsMS) + 1)
+
+  def Add(self, Time:float, NumRows:int, LockWait:bool):
+    self.NumCalls += 1
+    self.TotalTime += Time
+    self.MaxTime = max(self.MaxTime, Time)
+    self.NumRows += max(NumRows, 0)
+    if (LockWait):
+      self.NumLockWaits += 1
+    self.Buckets[bisect.bisect_left(LatencyBucketsMS, Time * 1000.0)] += 1
+
+  # Upper bound of the bucket the given percentile falls into
+  def GetPercentile(self, Percentile:float) -> str:
+    Target:float = self.NumCalls * Percentile
+    Seen:int = 0
+    for Index, Count in enumerate(self.Buckets):
+      Seen += Count
+      if (Seen >= Target and Count > 0):
+        if (Index >= len(LatencyBucketsMS)):
+          return f">{LatencyBucketsMS[-1]:g}ms"
+        return f"<={LatencyBucketsMS[Index]:g}ms"
+    return "n/a"
+
+  def __str__(self) -> str:
+    AvgMS:float = (self.TotalTime / max(self.NumCalls, 1)) * 1000.0
+    return (f"{self.NumCalls} stmts, total {self.TotalTime * 1000.0:.1f}ms avg {AvgMS:.2f}ms "
+            f"p50 {self.GetPercentile(0.5)} p99 {self.GetPercentile(0.99)} max {self.MaxTime * 1000.0:.1f}ms, "
+            f"{self.NumRows} rows changed, {self.NumLockWaits} lock waits")
+
+# Opt-in (DatabaseProfiling in the config) statement profiler. Every statement is timed through the engine
+# events and charged both to its SQL text and to the DatabaseDriver method that issued it.
+class DatabaseProfiler():
+  Statements:dict[str, ProfileEntry] = {}
+  Methods:dict[str, ProfileEntry] = {}
+  StartTime:float = time.time()
+  StatsLock:threading.Lock = threading.Lock()
+
+  @staticmethod
+  def Attach(EngineToProfile:Engine):
+    event.listen(EngineToProfile, "before_cursor_execute", DatabaseProfiler.BeforeExecute)
+    event.listen(EngineToProfile, "after_cursor_execute", DatabaseProfiler.AfterExecute)
+
+  @staticmethod
+  def IsEnabled() -> bool:
+    return bool(ConfigData["DatabaseProfiling"])
+
+  @staticmethod
+  def BeforeExecute(Connection, Cursor, Statement, Parameters, Context, ExecuteMany):
+    Connection.info["ProfileStartTime"] = time.perf_counter()
+
+  @staticmethod
+  def AfterExecute(Connection, Cursor, Statement, Parameters, Context, ExecuteMany):
+    StartTime:float|None = Connection.info.pop("ProfileStartTime", None)
+    if (StartTime is None):
+      return
+
+    ExecuteTime:float = time.perf_counter() - StartTime
+    IsWrite:bool = Context is not None and (Context.isinsert or Context.isupdate or Context.isdelete)
+    # Same definition as DatabaseContention, a write that took longer than the threshold waited on a lock
+    LockWait:bool = IsWrite and ExecuteTime * 1000.0 >= ConfigData["DatabaseLockWaitThresholdMS"]
+    NumRows:int = Cursor.rowcount if IsWrite else 0
+    StatementKey:str = DatabaseProfiler.NormalizeStatement(Statement)
+    MethodKey:str = DatabaseProfiler.GetCallingMethod()
+
+    with DatabaseProfiler.StatsLock:
+      DatabaseProfiler.Statements.setdefault(StatementKey, ProfileEntry()).Add(ExecuteTime, NumRows, LockWait)
+      DatabaseProfiler.Methods.setdefault(MethodKey, ProfileEntry()).Add(ExecuteTime, NumRows, LockWait)
+
+  # Chunked IN lists and multi-row VALUES produce a different parameter count on every call, fold them together
+  @staticmethod
+  def NormalizeStatement(Statement:str) -> str:
+    Statement = re.sub(r"\s+", " ", Statement).strip()
+    Statement = re.sub(r"\?(?:, \?)+", "?, ...", Statement)
+    return re.sub(r"(\([^()]*\))(?:, \1)+", r"\1, ...", Statement)
+
+  @staticmethod
+  def GetCallingMethod() -> str:
+    Frame = sys._getframe(2)
+    MethodName:str = ""
+    while (Frame is not None):
+      if (Frame.f_globals.get("__name__") == DriverModuleName):
+        MethodName = Frame.f_code.co_name
+      elif (len(MethodName) > 0):
+        # Walked out of the driver, the last frame we saw is the method that was called from outside
+        break
+      Frame = Frame.f_back
+
+    return MethodName if len(MethodName) > 0 else "<outside driver>"
+
+  @staticmethod
+  def Reset():
+    with DatabaseProfiler.StatsLock:
+      DatabaseProfiler.Statements = {}
+      DatabaseProfiler.Methods = {}
+      DatabaseProfiler.StartTime = time.time()
+
+  @staticmethod
+  def GetReport(NumEntries:int=5) -> str:
+    if (not DatabaseProfiler.IsEnabled()):
+      return "Database profiling is disabled, set DatabaseProfiling in the config to enable it"
+
+    with DatabaseProfiler.StatsLock:
+      TopMethods = sorted(DatabaseProfiler.Methods.items(), key=lambda Item: Item[1].TotalTime, reverse=True)[:NumEntries]
+      TopStatements = sorted(DatabaseProfiler.Statements.items(), key=lambda Item: Item[1].TotalTime, reverse=True)[:NumEntries]
+      ReportStr:str = f"Database Profile over the last {(time.time() - DatabaseProfiler.StartTime) / 60.0:.1f}mins\nTop methods:\n"
+      for MethodName, Entry in TopMethods:
+        ReportStr += f"- {MethodName}: {Entry}\n"
+      ReportStr += "Top statements:\n"
+      for StatementText, Entry in TopStatements:
+        ReportStr += f"- {StatementText[:150]}: {Entry}\n"
+
+    return ReportStr
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Integer, DateTime, String
+from sqlalchemy import Integer, BigInteger, DateTime, String, LargeBinary, Index, DDL, FetchedValue, event, select
 from sqlalchemy.sql import func, null
 from sqlalchemy.orm import DeclarativeBase, mapped_column
 
@@ -13,24 +13,42 @@ class Migration(Base):
   created_at = mapped_column(DateTime(), server_default=func.now())
   updated_at = mapped_column(DateTime(), server_default=func.now(), onupdate=func.now())
 
+# Named counters shared between every process using the database
+class Counter(Base):
+  __tablename__ = "counters"
+  
+  name = mapped_column(String(32), primary_key=True)
+  value = mapped_column(Integer, nullable=False, server_default="0")
+
 class Ban(Base):
   __tablename__ = "bans"
+  __table_args__ = (
+    # Ban iteration and cooldown resumes page through the ban sequence
+    Index("ix_bans_seq", "seq", unique=True),
+  )
 
   id = mapped_column(Integer, primary_key=True, autoincrement=True)
-  discord_user_id = mapped_column(String(32), unique=True, nullable=False)
+  discord_user_id = mapped_column(BigInteger, unique=True, nullable=False)
   assigner_discord_user_id = mapped_column(String(32), nullable=False)
   assigner_discord_user_name = mapped_column(String(32), nullable=False)
   created_at = mapped_column(DateTime(), server_default=func.now())
   updated_at = mapped_column(DateTime(), server_default=func.now(), onupdate=func.now())
   evidence_thread = mapped_column(Integer, nullable=True, server_default=null())
+  # Monotonically increasing position in the ban list, assigned by the bans_assign_seq trigger. Never reused after an unban.
+  seq = mapped_column(Integer, nullable=True, server_default=FetchedValue())
 
 class Server(Base):
   __tablename__ = "servers"
+  __table_args__ = (
+    # Matches the GetAllServers filters, most selective first for the action propagation queries
+    Index("ix_servers_activation", "activation_state", "bot_instance_id", "should_ban_in", "kick_sus_users"),
+    Index("ix_servers_owner", "owner_discord_user_id"),
+  )
 
   id = mapped_column(Integer, primary_key=True, autoincrement=True)
   bot_instance_id = mapped_column(Integer, nullable=False, server_default="0")
-  discord_server_id = mapped_column(String(32), unique=True, nullable=False)
-  owner_discord_user_id = mapped_column(String(32), nullable=False)
+  discord_server_id = mapped_column(BigInteger, unique=True, nullable=False)
+  owner_discord_user_id = mapped_column(BigInteger, nullable=False)
   activation_state = mapped_column(Integer, server_default="0")
   activator_discord_user_id = mapped_column(String(32), nullable=False, server_default='-1')
   created_at = mapped_column(DateTime(), server_default=func.now())
@@ -43,8 +61,134 @@ class Server(Base):
 
 class ExhaustedServer(Base):
   __tablename__ = "exhausted_servers"
+  __table_args__ = (
+    # GetExhaustedServers does a range over the last time a server ran
+    Index("ix_exhausted_servers_last_run", "last_run"),
+  )
   
-  discord_server_id = mapped_column(String(32), primary_key=True, unique=True, nullable=False)
-  current_pos = mapped_column(Integer, nullable=False, server_default="0")
+  discord_server_id = mapped_column(BigInteger, primary_key=True, unique=True, nullable=False)
+  # Sequence number of the last ban that was applied to this server
+  last_seq = mapped_column(Integer, nullable=False, server_default="0")
   last_run = mapped_column(DateTime(), server_default=func.now(), onupdate=func.now())
-  is_processing = mapped_column(Integer, nullable=False, server_default="0")
\ No newline at end of file
+  is_processing = mapped_column(Integer, nullable=False, server_default="0")
+
+# Ranges of ban sequence numbers that have landed in a server, so reprocessing only has to send the bans that are missing.
+# Ranges only need to be contiguous over bans that still exist, and neighboring ranges are merged together as they are written.
+class BanLedger(Base):
+  __tablename__ = "ban_ledger"
+  
+  discord_server_id = mapped_column(BigInteger, primary_key=True)
+  first_seq = mapped_column(Integer, primary_key=True)
+  last_seq = mapped_column(Integer, nullable=False)
+
+# Every durable message the relay server routes, in the order it routed them. The id is the message id (the offset) the instances ack.
+# Ids are handed out by the relay server and never reused, so that an offset always points at the same place in the outbox even after old messages are pruned.
+class RelayOutbox(Base):
+  __tablename__ = "relay_outbox"
+  __table_args__ = (
+    # Pruning goes by age
+    Index("ix_relay_outbox_created_at", "created_at"),
+    {"sqlite_autoincrement": True},
+  )
+  
+  id = mapped_column(Integer, primary_key=True, autoincrement=True)
+  message_type = mapped_column(Integer, nullable=False)
+  # -1 for messages that go to every sub-instance
+  destination = mapped_column(Integer, nullable=False)
+  # The relay frame as the sender encoded it, the message id is added when it is sent
+  frame = mapped_column(LargeBinary, nullable=False)
+  created_at = mapped_column(DateTime(), server_default=func.now())
+
+# Last outbox id each instance has consumed (acked, or given up on), replays start after it
+class RelayOffset(Base):
+  __tablename__ = "relay_offsets"
+  
+  instance_id = mapped_column(Integer, primary_key=True)
+  last_offset = mapped_column(Integer, nullable=False, server_default="0")
+  updated_at = mapped_column(DateTime(), server_default=func.now(), onupdate=func.now())
+
+# Row counts that are kept current by the StatTriggers, so that the stats never need a COUNT(*).
+# These queries are only used to seed the counters and to check them for drift.
+StatCounters:dict = {
+  "num_bans": select(func.count()).select_from(Ban),
+  "num_servers": select(func.count()).select_from(Server),
+  "num_activated_servers": select(func.count()).select_from(Server).where(Server.activation_state==1),
+  "num_exhausted_servers": select(func.count()).select_from(ExhaustedServer),
+}
+# ban_seq and servers_version only ever move forward, other processes compare them against what they last saw to find out about writes
+CounterNames:list[str] = ["ban_seq", "servers_version"] + list(StatCounters.keys())
+CreateCounters = DDL("INSERT OR IGNORE INTO counters (name, value) VALUES " + ", ".join(f"('{Name}', 0)" for Name in CounterNames))
+
+# Hands out the next ban sequence number on every insert, regardless of which process inserted the ban
+BanSequenceTrigger = DDL("""CREATE TRIGGER IF NOT EXISTS bans_assign_seq AFTER INSERT ON bans WHEN NEW.seq IS NULL
+BEGIN
+  UPDATE counters SET value = value + 1 WHERE name = 'ban_seq';
+  UPDATE bans SET seq = (SELECT value FROM counters WHERE name = 'ban_seq') WHERE id = NEW.id;
+END""")
+
+# Any write to the servers table bumps servers_version, so that cached server rows can be dropped in every process
+ServerVersionTriggers:list = [
+  DDL(f"""CREATE TRIGGER IF NOT EXISTS servers_version_{Operation.lower()} AFTER {Operation} ON servers
+BEGIN
+  UPDATE counters SET value = value + 1 WHERE name = 'servers_version';
+END""") for Operation in ["INSERT", "UPDATE", "DELETE"]
+]
+
+StatTriggers:dict = {
+  Ban.__table__: [
+    DDL("""CREATE TRIGGER IF NOT EXISTS bans_count_insert AFTER INSERT ON bans
+BEGIN
+  UPDATE counters SET value = value + 1 WHERE name = 'num_bans';
+END"""),
+    DDL("""CREATE TRIGGER IF NOT EXISTS bans_count_delete AFTER DELETE ON bans
+BEGIN
+  UPDATE counters SET value = value - 1 WHERE name = 'num_bans';
+END"""),
+  ],
+  Server.__table__: [
+    DDL("""CREATE TRIGGER IF NOT EXISTS servers_count_insert AFTER INSERT ON servers
+BEGIN
+  UPDATE counters SET value = value + 1 WHERE name = 'num_servers';
+  UPDATE counters SET value = value + (NEW.activation_state IS 1) WHERE name = 'num_activated_servers';
+END"""),
+    DDL("""CREATE TRIGGER IF NOT EXISTS servers_count_delete AFTER DELETE ON servers
+BEGIN
+  UPDATE counters SET value = value - 1 WHERE name = 'num_servers';
+  UPDATE counters SET value = value - (OLD.activation_state IS 1) WHERE name = 'num_activated_servers';
+END"""),
+    DDL("""CREATE TRIGGER IF NOT EXISTS servers_count_activation AFTER UPDATE OF activation_state ON servers 
+WHEN (NEW.activation_state IS 1) != (OLD.activation_state IS 1)
+BEGIN
+  UPDATE counters SET value = value + (NEW.activation_state IS 1) - (OLD.activation_state IS 1) WHERE name = 'num_activated_servers';
+END"""),
+  ],
+  ExhaustedServer.__table__: [
+    DDL("""CREATE TRIGGER IF NOT EXISTS exhausted_servers_count_insert AFTER INSERT ON exhausted_servers
+BEGIN
+  UPDATE counters SET value = value + 1 WHERE name = 'num_exhausted_servers';
+END"""),
+    DDL("""CREATE TRIGGER IF NOT EXISTS exhausted_servers_count_delete AFTER DELETE ON exhausted_servers
+BEGIN
+  UPDATE counters SET value = value - 1 WHERE name = 'num_exhausted_servers';
+END"""),
+  ],
+}
+
+event.listen(Counter.__table__, "after_create", CreateCounters)
+event.listen(Ban.__table__, "after_create", BanSequenceTrigger)
+for Trigger in ServerVersionTriggers:
+  event.listen(Server.__table__, "after_create", Trigger)
+for Table, Triggers in StatTriggers.items():
+  for Trigger in Triggers:
+    event.listen(Table, "after_create", Trigger)
+
+# Detached, read-only copy of a servers row. These are safe to hold onto between commits,
+# unlike the ORM objects which expire whenever the session commits.
+class ServerSnapshot():
+  __slots__ = ("bot_instance_id", "discord_server_id", "owner_discord_user_id", "activation_state", 
+               "activator_discord_user_id", "created_at", "updated_at", "message_channel", 
+               "has_webhooks", "kick_sus_users", "can_report", "should_ban_in")
+  
+  def __init__(self, Row:Server):
+    for Column in self.__slots__:
+      setattr(self, Column, getattr(Row, Column))
\ No newline at end of file
@@ -45,3 +45,10 @@ class RelayMessageType(CompareEnum):
   ProcessServerActivation=auto()
   Ping=auto()
   Kick=auto()
+  # Asks an instance for its database profile, it answers with a DatabaseProfileReport to the control bot
+  DatabaseProfile=auto()
+  DatabaseProfileReport=auto()
+  # Many target users with the same moderation action and authorizer, coalesced by the sender
+  ActionBatch=auto()
+  # Sent back to the relay server once a message with a MessageId has been handled
+  Ack=auto()
@@ -1,6 +1,6 @@
 from discord import ui, Guild, ButtonStyle, Interaction, User, Member, TextChannel, Permissions
 from ModalHelpers import YesNoSelector, SelfDeletingView, ModChannelSelector
-from BotDatabaseSchema import Server
+from BotDatabaseSchema import ServerSnapshot
 from Logger import Logger, LogLevel
 from TextWrapper import TextLibrary
 from Config import Config
@@ -42,7 +42,7 @@ class BotSettingsPayload:
   
   def LoadFromDB(self, BotInstance):
     DB = BotInstance.Database
-    ServerInfo:Server = DB.GetServerInfo(self.GetServerID())
+    ServerInfo:ServerSnapshot = DB.GetServerInfo(self.GetServerID())
     if (int(ServerInfo.activation_state) == 0):
       self.KickSusRequired = self.WebHookRequired = True
     else:
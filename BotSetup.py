@@ -1,20 +1,98 @@
 from Config import Config
 from Logger import LogLevel, Logger
-from sqlalchemy import create_engine, Engine, select, text, URL, desc
+from sqlalchemy import create_engine, event, Engine, select, update, text, URL, desc, asc
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import Session
 from datetime import datetime
-from BotDatabaseSchema import Base, Migration, Ban, Server
+from BotDatabaseProfiler import DatabaseProfiler
+from BotDatabaseSchema import Base, Migration, Ban, Server, ExhaustedServer, Counter, BanLedger, RelayOutbox, RelayOffset, BanSequenceTrigger, CreateCounters, StatCounters, StatTriggers, ServerVersionTriggers
+import time, re
 
-class DatabaseMigrator:
-  # When the BotDatabaseSchema gets updated, update this value here and create a function that updates
-  # from the last database version to this one. The naming scheme should match "upgrade_versionXtoY"
-  # Database migrations apply linearly.
-  DATABASE_VERSION=7
-  VersionMap={}
-  DatabaseCon:Engine=None # pyright: ignore[reportAssignmentType]
+ConfigData:Config = Config()
+
+# Process wide counters for how often we end up waiting on another connection's write lock.
+# SQLite handles the busy waiting internally, so any write statement that takes longer than
+# DatabaseLockWaitThresholdMS is counted as having waited on a lock. Reads are tracked separately,
+# split by whether they went through the read-only handle.
+class DatabaseContention():
+  NumWrites:int = 0
+  NumLockWaits:int = 0
+  TotalLockWaitTime:float = 0.0
+  MaxLockWaitTime:float = 0.0
+  NumLockErrors:int = 0
+  NumReads:int = 0
+  NumReadOnlyReads:int = 0
+  NumSlowReads:int = 0
+  MaxReadTime:float = 0.0
   
-  def __init__(self):
+  @staticmethod
+  def GetStats() -> str:
+    return (f"Database Locks: {DatabaseContention.NumLockWaits}/{DatabaseContention.NumWrites} writes waited, "
+            f"total {DatabaseContention.TotalLockWaitTime * 1000.0:.1f}ms max {DatabaseContention.MaxLockWaitTime * 1000.0:.1f}ms, "
+            f"{DatabaseContention.NumLockErrors} lock errors | Reads: {DatabaseContention.NumReads} "
+            f"({DatabaseContention.NumReadOnlyReads} read-only), {DatabaseContention.NumSlowReads} slow, max {DatabaseContention.MaxReadTime * 1000.0:.1f}ms")
+
+def ApplyConnectionSettings(DBAPIConnection, ConnectionRecord):
+  Cursor = DBAPIConnection.cursor()
+  Cursor.execute(f"PRAGMA journal_mode={ConfigData['DatabaseJournalMode']}")
+  Cursor.close()
+  ApplyReadOnlyConnectionSettings(DBAPIConnection, ConnectionRecord)
+
+# Read-only connections cannot change the journal mode, WAL is stored in the file so the read-write connections handle it
+def ApplyReadOnlyConnectionSettings(DBAPIConnection, ConnectionRecord):
+  Cursor = DBAPIConnection.cursor()
+  Cursor.execute(f"PRAGMA synchronous={ConfigData['DatabaseSynchronous']}")
+  Cursor.execute(f"PRAGMA busy_timeout={int(ConfigData['DatabaseBusyTimeoutMS'])}")
+  # Negative values are in KiB rather than pages
+  Cursor.execute(f"PRAGMA cache_size=-{int(ConfigData['DatabaseCacheSizeKB'])}")
+  Cursor.execute(f"PRAGMA mmap_size={int(ConfigData['DatabaseMmapSizeMB']) * 1024 * 1024}")
+  Cursor.close()
+  
+def BeforeStatementExecute(Connection, Cursor, Statement, Parameters, Context, ExecuteMany):
+  Connection.info["StatementStartTime"] = time.perf_counter()
+
+def AfterStatementExecute(Connection, Cursor, Statement, Parameters, Context, ExecuteMany):
+  StartTime:float|None = Connection.info.pop("StatementStartTime", None)
+  if (StartTime is None or Context is None):
+    return
+  
+  if (not (Context.isinsert or Context.isupdate or Context.isdelete)):
+    ReadTime:float = time.perf_counter() - StartTime
+    DatabaseContention.NumReads += 1
+    if (IsReadOnlyEngine(Connection.engine)):
+      DatabaseContention.NumReadOnlyReads += 1
+    if (ReadTime * 1000.0 >= ConfigData["DatabaseLockWaitThresholdMS"]):
+      DatabaseContention.NumSlowReads += 1
+    DatabaseContention.MaxReadTime = max(DatabaseContention.MaxReadTime, ReadTime)
+    return
+  
+  WriteTime:float = time.perf_counter() - StartTime
+  DatabaseContention.NumWrites += 1
+  if (WriteTime * 1000.0 >= ConfigData["DatabaseLockWaitThresholdMS"]):
+    DatabaseContention.NumLockWaits += 1
+    DatabaseContention.TotalLockWaitTime += WriteTime
+    DatabaseContention.MaxLockWaitTime = max(DatabaseContention.MaxLockWaitTime, WriteTime)
+    
+def HandleDatabaseError(ExceptionContext):
+  if (isinstance(ExceptionContext.sqlalchemy_exception, OperationalError) and "locked" in str(ExceptionContext.original_exception)):
+    DatabaseContention.NumLockErrors += 1
+    Logger.Log(LogLevel.Warn, f"Database lock could not be acquired within {ConfigData['DatabaseBusyTimeoutMS']}ms")
+
+def IsReadOnlyEngine(InEngine:Engine) -> bool:
+  return InEngine.url.query.get("mode") == "ro"
+
+# Every process (the control bot, the sub-instances and the migrator) should create their engine here,
+# so that they all agree on journaling and locking behavior for the shared database file.
+# Read-only engines open the file with a mode=ro URI, any write through them fails.
+def CreateDatabaseEngine(ReadOnly:bool=False) -> Engine:
+  if (ReadOnly):
+    database_url = URL.create(
+      'sqlite',
+      database=f"file:{Config.GetDBFile()}",
+      query={"mode": "ro", "uri": "true"},
+    )
+  else:
     database_url = URL.create(
       'sqlite',
       username='',
@@ -22,8 +100,38 @@ class DatabaseMigrator:
       host='',
       database=Config.GetDBFile(),
     )
+  
+  BusyTimeout:float = float(ConfigData["DatabaseBusyTimeoutMS"]) / 1000.0
+  NewEngine:Engine = create_engine(database_url, connect_args={"timeout": BusyTimeout})
+  event.listen(NewEngine, "connect", ApplyReadOnlyConnectionSettings if ReadOnly else ApplyConnectionSettings)
+  event.listen(NewEngine, "before_cursor_execute", BeforeStatementExecute)
+  event.listen(NewEngine, "after_cursor_execute", AfterStatementExecute)
+  event.listen(NewEngine, "handle_error", HandleDatabaseError)
+  if (DatabaseProfiler.IsEnabled()):
+    DatabaseProfiler.Attach(NewEngine)
+  return NewEngine
+
+# The exhausted_servers table as versions 6 and 7 created it. Those upgrades used to run create_all, which builds the
+# tables in their current shape and breaks every later upgrade that alters them, so the definition is frozen here.
+ExhaustedServersVersion7SQL:str = """CREATE TABLE IF NOT EXISTS exhausted_servers (
+  discord_server_id VARCHAR(32) NOT NULL,
+  current_pos INTEGER DEFAULT '0' NOT NULL,
+  last_run DATETIME DEFAULT CURRENT_TIMESTAMP,
+  is_processing INTEGER DEFAULT '0' NOT NULL,
+  PRIMARY KEY (discord_server_id),
+  UNIQUE (discord_server_id)
+)"""
 
-    self.DatabaseCon = create_engine(database_url)
+class DatabaseMigrator:
+  # When the BotDatabaseSchema gets updated, update this value here and create a function that updates
+  # from the last database version to this one. The naming scheme should match "upgrade_versionXtoY"
+  # Database migrations apply linearly.
+  DATABASE_VERSION=14
+  VersionMap={}
+  DatabaseCon:Engine=None # pyright: ignore[reportAssignmentType]
+  
+  def __init__(self):
+    self.DatabaseCon = CreateDatabaseEngine()
 
     MatchingObjects = [a for a in dir(self) if a.startswith('upgrade_version') and callable(getattr(self, a))]
     for UpgradeFunc in MatchingObjects:
@@ -140,30 +248,148 @@ class DatabaseMigrator:
   
   def upgrade_version5to6(self) -> bool:
     session = Session(self.DatabaseCon)
-    Base.metadata.create_all(self.DatabaseCon)
+    session.execute(text(ExhaustedServersVersion7SQL))
     session.commit()
     return True
   
   def upgrade_version6to7(self) -> bool:
     session = Session(self.DatabaseCon)
     session.execute(text("drop table exhausted_servers"))
+    session.execute(text(ExhaustedServersVersion7SQL))
     session.commit()
-    Base.metadata.create_all(self.DatabaseCon)
-    session.commit()
     return True
+  
+  def upgrade_version7to8(self) -> bool:
+    NewIndexes:list[str] = ["ix_servers_activation", "ix_servers_owner", "ix_exhausted_servers_last_run"]
+    for Table in [Ban.__table__, Server.__table__, ExhaustedServer.__table__]:
+      for TableIndex in Table.indexes:
+        if (TableIndex.name in NewIndexes):
+          TableIndex.create(self.DatabaseCon, checkfirst=True)
+    return True
+
+  def upgrade_version8to9(self) -> bool:
+    # SQLite cannot change a column type in place, so rebuild the tables with the snowflake columns as integers.
+    # The tables are rebuilt from their own stored definitions so that later schema changes do not leak into this version.
+    SnowflakeColumns:dict[str, list[str]] = {
+      "bans": ["discord_user_id"],
+      "servers": ["discord_server_id", "owner_discord_user_id"],
+      "exhausted_servers": ["discord_server_id"],
+    }
+
+    with self.DatabaseCon.begin() as Connection:
+      for TableName, Columns in SnowflakeColumns.items():
+        TableSQL:str = Connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": TableName}).scalar_one()
+        IndexRows = Connection.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :name AND sql IS NOT NULL"), {"name": TableName}).all()
+        ColumnNames:list[str] = [Row[1] for Row in Connection.execute(text(f"PRAGMA table_info({TableName})"))]
+        for Column in Columns:
+          TableSQL = re.sub(rf"\b{Column} VARCHAR\(32\)", f"{Column} BIGINT", TableSQL)
+        
+        for IndexName, _ in IndexRows:
+          Connection.execute(text(f"DROP INDEX {IndexName}"))
+        Connection.execute(text(f"ALTER TABLE {TableName} RENAME TO {TableName}_old"))
+        Connection.execute(text(TableSQL))
+        
+        SelectList:list[str] = [f"CAST({Name} AS INTEGER)" if Name in Columns else Name for Name in ColumnNames]
+        Connection.execute(text(f"INSERT INTO {TableName} ({', '.join(ColumnNames)}) SELECT {', '.join(SelectList)} FROM {TableName}_old"))
+        Connection.execute(text(f"DROP TABLE {TableName}_old"))
+        for _, IndexSQL in IndexRows:
+          Connection.execute(text(IndexSQL))
+
+    with self.DatabaseCon.connect() as Connection:
+      Connection.execute(text("VACUUM"))
+    return True
+  
+  def upgrade_version9to10(self) -> bool:
+    with self.DatabaseCon.begin() as Connection:
+      Connection.execute(text("ALTER TABLE bans ADD seq INTEGER"))
+      Connection.execute(text("ALTER TABLE exhausted_servers ADD last_seq INTEGER NOT NULL DEFAULT 0"))
+      # Number the existing bans in the order they were created. This is the same order that current_pos counted
+      # through, so a server that had processed current_pos bans has applied everything up to seq current_pos.
+      Connection.execute(text("UPDATE bans SET seq = Numbered.seq FROM "
+                              "(SELECT id, row_number() OVER (ORDER BY created_at, id) AS seq FROM bans) AS Numbered "
+                              "WHERE bans.id = Numbered.id"))
+      Connection.execute(text("UPDATE exhausted_servers SET last_seq = current_pos"))
+      Connection.execute(text("ALTER TABLE exhausted_servers DROP COLUMN current_pos"))
+      
+      Counter.__table__.create(Connection, checkfirst=True)
+      Connection.execute(text("UPDATE counters SET value = (SELECT COALESCE(MAX(seq), 0) FROM bans) WHERE name = 'ban_seq'"))
+      Connection.execute(BanSequenceTrigger)
+      for TableIndex in Ban.__table__.indexes:
+        TableIndex.create(Connection, checkfirst=True)
+    return True
+  
+  def upgrade_version10to11(self) -> bool:
+    # Seed the stat counters and install their triggers in the same transaction, so no change can slip in between
+    with self.DatabaseCon.begin() as Connection:
+      Connection.execute(CreateCounters)
+      for CounterName, CountQuery in StatCounters.items():
+        Connection.execute(update(Counter).where(Counter.name==CounterName).values(value=CountQuery.scalar_subquery()))
+      for Triggers in StatTriggers.values():
+        for Trigger in Triggers:
+          Connection.execute(Trigger)
+    return True
+  
+  def upgrade_version11to12(self) -> bool:
+    with self.DatabaseCon.begin() as Connection:
+      BanLedger.__table__.create(Connection, checkfirst=True)
+      # Servers in cooldown are known to have every ban up to their last_seq
+      Connection.execute(text("INSERT INTO ban_ledger (discord_server_id, first_seq, last_seq) "
+                              "SELECT discord_server_id, 1, last_seq FROM exhausted_servers WHERE last_seq > 0"))
+    return True
+  
+  def upgrade_version12to13(self) -> bool:
+    with self.DatabaseCon.begin() as Connection:
+      Connection.execute(CreateCounters)
+      for Trigger in ServerVersionTriggers:
+        Connection.execute(Trigger)
+    return True
+  
+  def upgrade_version13to14(self) -> bool:
+    with self.DatabaseCon.begin() as Connection:
+      RelayOutbox.__table__.create(Connection, checkfirst=True)
+      RelayOffset.__table__.create(Connection, checkfirst=True)
+    return True
+  
+  # Runs EXPLAIN QUERY PLAN on the hot queries, as the database driver builds them, and makes sure they go through the index built for them.
+  # The queries are built from the current schema, so this can only be run once the database has caught up to it.
+  def VerifyIndexUsage(self) -> bool:
+    # BotDatabase imports this module, so it can only be imported once both are loaded
+    from BotDatabase import DatabaseDriver
+    ExpectedPlans = [
+      ("ix_servers_activation", DatabaseDriver.FilterServers(select(Server.discord_server_id), True, 1, FilterBanability=True)),
+      ("ix_servers_activation", DatabaseDriver.FilterServers(select(Server.discord_server_id), True, 1, FilterKicking=True)),
+      ("ix_servers_owner", select(Server).where(Server.owner_discord_user_id==1)),
+      ("ix_bans_seq", select(Ban.seq, Ban.discord_user_id, Ban.assigner_discord_user_name).where(Ban.seq > 0).order_by(asc(Ban.seq)).limit(1000)),
+      ("ix_exhausted_servers_last_run", DatabaseDriver.GetExhaustedServersQuery()),
+    ]
+    
+    AllIndexesUsed:bool = True
+    with self.DatabaseCon.connect() as Connection:
+      for IndexName, Query in ExpectedPlans:
+        # Skip indexes that a later database version adds
+        if (not Connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"), {"name": IndexName}).first()):
+          continue
+        
+        QuerySQL:str = str(Query.compile(dialect=Connection.dialect, compile_kwargs={"literal_binds": True}))
+        try:
+          QueryPlan:str = " ".join(str(Row[-1]) for Row in Connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {QuerySQL}"))
+        except Exception as ex:
+          Logger.Log(LogLevel.Warn, f"Unable to get the query plan for '{QuerySQL}': {str(ex)}")
+          AllIndexesUsed = False
+          continue
+        
+        if (f"INDEX {IndexName}" not in QueryPlan):
+          Logger.Log(LogLevel.Warn, f"Query '{QuerySQL}' does not use {IndexName}, plan was: {QueryPlan}")
+          AllIndexesUsed = False
+        else:
+          Logger.Log(LogLevel.Debug, f"Query plan uses {IndexName}: {QueryPlan}")
+    
+    return AllIndexesUsed
 
 def SetupDatabases():
   Logger.Log(LogLevel.Notice, "Loading database for scam bot setup")
   
-  database_url = URL.create(
-    'sqlite',
-    username='',
-    password='',
-    host='',
-    database=Config.GetDBFile(),
-  )
-
-  engine = create_engine(database_url)
+  engine = CreateDatabaseEngine()
 
   session = Session(engine)
 
@@ -195,7 +421,6 @@ def SetupDatabases():
         exit()
     else:
       Logger.Log(LogLevel.Debug, f"Database version is currently {CurrentVersion}")
-      return
   else:
     Base.metadata.create_all(engine)
 
@@ -208,3 +433,10 @@ def SetupDatabases():
     session.commit()
 
     Logger.Log(LogLevel.Notice, "Created the bot databases!")
+  
+  # Checked on every start, a hot query that stops using its index is only a slowdown in production, but a bug in development
+  if (not DatabaseMigrator().VerifyIndexUsage()):
+    if (ConfigData.IsDevelopment()):
+      Logger.Log(LogLevel.Error, "Database queries are not using their indexes!")
+      exit()
+    Logger.Log(LogLevel.Warn, "Database queries are not using their indexes, the bot will run slower")
\ No newline at end of file
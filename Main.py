@@ -14,6 +14,8 @@ Messages:TextLibrary = TextLibrary()
 
 if __name__ == '__main__':  
   ### MAIN INSTANCE SETUP ###
+  # Setup any database migration, this has to happen before the bot opens the database
+  SetupDatabases()
   CommandControlServer=Object(id=ConfigData["ControlServer"])
   ScamGuardBot = ScamGuard(ConfigData["ControlBotID"])
   
@@ -28,10 +30,11 @@ if __name__ == '__main__':
   @ScamGuardBot.Commands.command(name="backup", description="Backs up the current database", guild=CommandControlServer)
   @app_commands.checks.has_role(ConfigData["MaintainerRole"])
   async def BackupCommand(interaction:Interaction):
-    if (ScamGuardBot.Database.Backup()):
-      await interaction.response.send_message("Backed up current database")
+    await interaction.response.defer(thinking=True)
+    if (await ScamGuardBot.AsyncDatabase.Backup()):
+      await interaction.followup.send("Backed up current database")
     else:
-      await interaction.response.send_message("Failed to backup database!")
+      await interaction.followup.send("Failed to backup database!")
     
   @ScamGuardBot.Commands.command(name="forceleave", description="Makes the bot force leave a server", guild=CommandControlServer)
   @app_commands.checks.has_role(ConfigData["MaintainerRole"])
@@ -63,7 +66,7 @@ if __name__ == '__main__':
       Logger.Log(LogLevel.Notice, f"Reprocessing bans for server {server} from {interaction.user.id}")
       ScamGuardBot.AddAsyncTask(ScamGuardBot.ReprocessBansForServer(server))
       ServersActivated = [server]
-      ScamGuardBot.Database.SetBotActivationForOwner(ServersActivated, True, BotInstance, ActivatorId=interaction.user.id)
+      await ScamGuardBot.AsyncDatabase.SetBotActivationForOwner(ServersActivated, True, BotInstance, ActivatorId=interaction.user.id)
       await interaction.response.send_message(f"Reprocessing bans for {server}")
     else:
       await interaction.response.send_message(f"I am unable to resolve that server id!")
@@ -71,8 +74,9 @@ if __name__ == '__main__':
 
   @ScamGuardBot.Commands.command(name="retryactions", description="Forces the bot to retry last actions", guild=CommandControlServer)
   @app_commands.checks.has_role(ConfigData["MaintainerRole"])
-  @app_commands.describe(server='Discord ID of the server to force activate', numactions='The number of actions to perform')
-  async def RetryActions(interaction:Interaction, server:app_commands.Transform[int, ServerIdTransformer], numactions:app_commands.Range[int, 0]):
+  @app_commands.describe(server='Discord ID of the server to force activate', numactions='The number of actions to perform',
+                         force='Resend bans even if the ban ledger says they have already been applied')
+  async def RetryActions(interaction:Interaction, server:app_commands.Transform[int, ServerIdTransformer], numactions:app_commands.Range[int, 0], force:bool=False):
     if (server <= -1):
       await interaction.response.send_message(Messages["cmds_error"]["invalid_id"], ephemeral=True, delete_after=5.0)
       return
@@ -81,8 +85,8 @@ if __name__ == '__main__':
       await interaction.response.send_message(Messages["cmds_error"]["server_already_processing"])
       return
       
-    ScamGuardBot.AddAsyncTask(ScamGuardBot.ReprocessBansForServer(server, LastActions=numactions))
-    ReturnStr:str = f"Reprocessing the last {numactions} actions in {server}..."
+    ScamGuardBot.AddAsyncTask(ScamGuardBot.ReprocessBansForServer(server, LastActions=numactions, Force=force))
+    ReturnStr:str = f"Reprocessing the last {numactions} actions in {server}{' (forced)' if force else ''}..."
     Logger.Log(LogLevel.Notice, ReturnStr)
     await interaction.response.send_message(ReturnStr)
     
@@ -118,10 +122,12 @@ if __name__ == '__main__':
       ReplyStr = "I am in the following servers:\n"
       
       # Format all servers that we know
-      QueryResults = ScamGuardBot.Database.GetAllServers()
+      QueryResults = await ScamGuardBot.AsyncDatabase.GetAllServers()
+      AppliedCounts:dict[int, int] = await ScamGuardBot.AsyncDatabase.GetAppliedBanCounts()
       for BotServers in QueryResults:
         IsActivated:bool = bool(BotServers.activation_state)
-        ReplyStr += f"#{RowNum}: Inst {BotServers.bot_instance_id}, Server {BotServers.discord_server_id}, Owner {BotServers.owner_discord_user_id}, Activated {str(IsActivated)}\n"
+        NumApplied:int = AppliedCounts.get(BotServers.discord_server_id, 0)
+        ReplyStr += f"#{RowNum}: Inst {BotServers.bot_instance_id}, Server {BotServers.discord_server_id}, Owner {BotServers.owner_discord_user_id}, Activated {str(IsActivated)}, Bans {NumApplied}/{NumBans}\n"
         RowNum += 1
         if (IsActivated):
           ActivatedServers += 1
@@ -130,7 +136,7 @@ if __name__ == '__main__':
     
     # Exhausted server information
     NumExhausted:int = ScamGuardBot.Database.GetNumExhaustedServers()
-    ExhaustedServers = ScamGuardBot.Database.GetAllExhaustedServers()
+    ExhaustedServers = await ScamGuardBot.AsyncDatabase.GetAllExhaustedServers()
     ExhaustedStr:str = ""
     # Only print if we have servers to print
     if (NumExhausted > 0):
@@ -144,11 +150,11 @@ if __name__ == '__main__':
         # Figure out the difference
         TimeDiff:int = int(((CurrentTime - TimeRan).seconds / 60) / 60)
         # Print
-        ExhaustedStr += f"#{RowNum}: Server ID: {ExhaustedServer.discord_server_id}, CurPos: {ExhaustedServer.current_pos}, Last Time: `{TimeRan}`, Next Time in: ~{abs(TimeDiff - CooldownWaitTime)}hrs\n"
+        ExhaustedStr += f"#{RowNum}: Server ID: {ExhaustedServer.discord_server_id}, Last Ban: #{ExhaustedServer.last_seq}, Last Time: `{TimeRan}`, Next Time in: ~{abs(TimeDiff - CooldownWaitTime)}hrs\n"
         RowNum += 1
 
     # Final formatting
-    ReplyStr = f"{ReplyStr}{ExhaustedStr}\n{ActivatedStr}| Num Bans: {NumBans} | Num Exhausted: {NumExhausted}"
+    ReplyStr = f"{ReplyStr}{ExhaustedStr}\n{ActivatedStr}| Num Bans: {NumBans} | Num Exhausted: {NumExhausted}\n{ScamGuardBot.Database.GetBanIndexStats()}\n{ScamGuardBot.Database.GetLockStats()}\n{ScamGuardBot.Database.GetSessionStats()}\n{ScamGuardBot.ServerHandler.GetRoutingStats()}"
     # Split the string so that it fits properly into discord messaging
     MessageChunkLen:int = 2000
     MessageChunks = [ReplyStr[i:i+MessageChunkLen] for i in range(0, len(ReplyStr), MessageChunkLen)]
@@ -157,6 +163,30 @@ if __name__ == '__main__':
       
     await ResponseHook.send("Done printing", ephemeral=True)
 
+  @ScamGuardBot.Commands.command(name="rebuildstats", description="Recounts the database stats and fixes any that have drifted", guild=CommandControlServer)
+  @app_commands.checks.has_role(ConfigData["MaintainerRole"])
+  async def RebuildStats(interaction:Interaction):
+    await interaction.response.defer(thinking=True)
+    Result:str = await ScamGuardBot.AsyncDatabase.RebuildStats()
+    Logger.Log(LogLevel.Notice, f"{interaction.user} rebuilt the stats: {Result}")
+    await interaction.followup.send(Result)
+
+  @ScamGuardBot.Commands.command(name="dbprofile", description="Prints the slowest database calls for an instance, or all of them", guild=CommandControlServer)
+  @app_commands.checks.has_role(ConfigData["MaintainerRole"])
+  @app_commands.describe(instance='Bot Instance ID to profile, leave empty for all instances', reset='Clear the profile after printing it')
+  async def PrintDatabaseProfile(interaction:Interaction, instance:int=-1, reset:bool=False):
+    # Sub-instances answer over the relay, their reports are posted to the notification channel
+    if (instance < 0):
+      for InstanceID in Config.GetAllSubTokens():
+        ScamGuardBot.ClientHandler.SendDatabaseProfileRequest(int(InstanceID), reset)
+    elif (instance != ScamGuardBot.BotID):
+      ScamGuardBot.ClientHandler.SendDatabaseProfileRequest(instance, reset)
+      await interaction.response.send_message(f"Requested the database profile from instance #{instance}", ephemeral=True, delete_after=5.0)
+      return
+
+    Report:str = ScamGuardBot.Database.GetProfileReport(reset)
+    await interaction.response.send_message(f"Instance #{ScamGuardBot.BotID} ```{Report[:1900]}```")
+
   @ScamGuardBot.Commands.command(name="scamban", description="Bans a scammer", guild=CommandControlServer)
   @app_commands.checks.has_role(ConfigData["ApproverRole"])
   @app_commands.describe(targetid='The discord id for the user to ban')
@@ -230,7 +260,7 @@ if __name__ == '__main__':
       await interaction.response.send_message("Cannot set an evidence thread on a non-ban at this time!", ephemeral=True)
       return
     
-    ScamGuardBot.Database.SetEvidenceThread(target, InteractionLocation)
+    await ScamGuardBot.AsyncDatabase.SetEvidenceThread(target, InteractionLocation)
     await interaction.response.send_message(f"Updated the thread for {target} to <#{interaction.channel_id}>")
     Logger.Log(LogLevel.Log, f"Thread set for {target} to {interaction.channel_id}")
   
@@ -246,7 +276,7 @@ if __name__ == '__main__':
       await interaction.response.send_message(f"ScamGuard is not in server {server}!", ephemeral=True, delete_after=5.0)    
       return
     
-    ScamGuardBot.Database.ToggleServerBan(server, state)
+    await ScamGuardBot.AsyncDatabase.ToggleServerBan(server, state)
     await interaction.response.send_message(f"Server {server} ban ability set to {state}", ephemeral=True, delete_after=10.0)
     Logger.Log(LogLevel.Log, f"Ban ability set for {server} to {state}")
     
@@ -261,7 +291,7 @@ if __name__ == '__main__':
       await interaction.response.send_message(f"ScamGuard is not in server {server}!", ephemeral=True, delete_after=5.0)    
       return
     
-    ScamGuardBot.Database.ToggleServerReport(server, state)
+    await ScamGuardBot.AsyncDatabase.ToggleServerReport(server, state)
     await interaction.response.send_message(f"Server {server} report ability set to {state}", ephemeral=True, delete_after=10.0)
     Logger.Log(LogLevel.Log, f"Report ability set for {server} to {state}")
     
@@ -271,7 +301,5 @@ if __name__ == '__main__':
     await interaction.response.send_message(f"Attempting to clean up inactive servers now. Dry Run? {dryrun}")
     await ScamGuardBot.RunPeriodicLeave(dryrun) 
   
-  # Setup any database migration
-  SetupDatabases()
   # Run the actual bot until the death of this application
   ScamGuardBot.run(ConfigData.GetToken())
\ No newline at end of file
@@ -26,6 +26,7 @@ class ScamGuard(DiscordBot):
   def __init__(self, AssignedBotID:int):
     self.ServerHandler = RelayServer(AssignedBotID, self)
     super().__init__(self.ServerHandler.GetFileLocation(), AssignedBotID)
+    self.ServerHandler.AttachOutbox(self.AsyncDatabase)
     
   async def setup_hook(self):
     # TODO: Make a fancy table for this in the future
@@ -37,14 +38,28 @@ class ScamGuard(DiscordBot):
       self.ConfigLeaveInterval()
       self.PeriodicLeave.start()
       
-    self.HandleListenRelay.start()
+    # Only poll the relay server if the event loop can't call us back when a connection is readable
+    if (not self.ServerHandler.StartEventDriven()):
+      self.HandleListenRelay.start()
     self.HandleBanExceed.start()
+    self.HandleRelayRetries.start()
+    self.PruneRelayOutbox.start()
     await super().setup_hook()
       
   ### Discord Tasks Handling ###
   @tasks.loop(seconds=0.5)
   async def HandleListenRelay(self):
     await self.ServerHandler.TickRelay()
+    
+  @tasks.loop(seconds=1)
+  async def HandleRelayRetries(self):
+    self.ServerHandler.RetryUnackedMessages()
+    await self.ServerHandler.SaveOffsets()
+    
+  @tasks.loop(hours=1)
+  async def PruneRelayOutbox(self):
+    NumPruned:int = await self.AsyncDatabase.PruneRelayOutbox(self.ServerHandler.GetConsumedOffset(), ConfigData["RelayOutboxRetentionHours"])
+    Logger.CLog(NumPruned > 0, LogLevel.Debug, f"Pruned {NumPruned} messages from the relay outbox")
   
   ### Task Interval Handling ###
   def ConfigBackupInterval(self):
@@ -66,19 +81,10 @@ class ScamGuard(DiscordBot):
       self.ConfigBackupInterval()
       return
     
-    # If we have active async tasks in progress, then delay this task until we are free.
-    if (len(self.AsyncTasks) > 0):
-      Logger.Log(LogLevel.Warn, "There are currently async tasks in progress, will try backup again in 5 minutes...")
-      self.RetryTaskInterval(self.PeriodicBackup)
-      return
-    
-    # If we currently have the minutes value set, then we need to make sure we get back onto the right track
-    if (self.PeriodicBackup.minutes != 0.0):
-      self.ConfigBackupInterval()
-    
+    # Backups are taken online on the database worker, so they no longer need to wait for other tasks to finish.
     Logger.Log(LogLevel.Log, "Periodic Bot DB Backup Started...")    
-    self.Database.Backup()
-    self.Database.CleanupBackups()
+    await self.AsyncDatabase.Backup()
+    await self.AsyncDatabase.CleanupBackups()
     
   ### Instance Cleanup ###
   @tasks.loop(minutes=2)
@@ -111,13 +117,13 @@ class ScamGuard(DiscordBot):
       self.ConfigLeaveInterval()
 
     CurrentTime:datetime = datetime.now() - timedelta(days=float(InactiveInstanceWindow))
-    AllDisabledServers = self.Database.GetAllDeactivatedServers()
+    AllDisabledServers = await self.AsyncDatabase.GetAllDeactivatedServers()
     OldServerCount:int = len(AllDisabledServers)
     Logger.CLog(OldServerCount > 0, LogLevel.Notice, f"Non-activated server ({OldServerCount}) purge. Dry run? {DryRun}")
     ServersLeft:int = 0
     for ServerData in AllDisabledServers:
       if (CurrentTime > ServerData.created_at):
-        ServerID:int = int(ServerData.discord_server_id)
+        ServerID:int = ServerData.discord_server_id
         if (DryRun or self.LeaveServer(ServerID)):
           ServersLeft += 1
           Logger.Log(LogLevel.Verbose, f"Attempting to leave server {ServerID}.")
@@ -134,7 +140,7 @@ class ScamGuard(DiscordBot):
   ### Handling Ban Exceeds ###
   @tasks.loop(hours=1)
   async def HandleBanExceed(self):
-    ExhaustedList = self.Database.GetExhaustedServers()
+    ExhaustedList = await self.AsyncDatabase.GetExhaustedServers()
     ExhaustedListCount = len(ExhaustedList)
     if (ExhaustedListCount <= 0):
       return
@@ -143,20 +149,22 @@ class ScamGuard(DiscordBot):
     if (not self.HasStartedInstances):
       return
     
-    NumBans:int = self.Database.GetNumBans()
     Logger.Log(LogLevel.Notice, f"Attempting to process {ExhaustedListCount} cooldown servers now")
     for Server in ExhaustedList:
-      NumCount:int = NumBans - int(Server.current_pos)
-      ServerId:int = int(Server.discord_server_id)
-      self.Database.SetProcessingServerCooldown(ServerId, True)
-      self.AddAsyncTask(self.ReprocessBansForServer(ServerId, NumCount, True))
-      Logger.Log(LogLevel.Log, f"Enqueueing reprocessing of {NumCount} bans for server {ServerId}")
+      ServerId:int = Server.discord_server_id
+      NumCount:int = await self.AsyncDatabase.GetNumBansAfter(Server.last_seq)
+      await self.AsyncDatabase.SetProcessingServerCooldown(ServerId, True)
+      # The instance resumes from the cooldown's last applied ban itself
+      self.AddAsyncTask(self.ReprocessBansForServer(ServerId, HandlingCooldown=True))
+      Logger.Log(LogLevel.Log, f"Enqueueing reprocessing of {NumCount} bans after ban #{Server.last_seq} for server {ServerId}")
   
   # Handling async tasks step flow
   @PeriodicBackup.before_loop
   @HandleBanExceed.before_loop
   @PeriodicLeave.before_loop
   @HandleListenRelay.before_loop
+  @HandleRelayRetries.before_loop
+  @PruneRelayOutbox.before_loop
   async def BeforeScheduledAsyncTasks(self):
     # Wait until the bot is all set up before attempting periodic leaves
     await self.wait_until_ready()
@@ -228,8 +236,11 @@ class ScamGuard(DiscordBot):
   async def StartInstance(self, InstanceID:int):
     RelayFileHandleLocation = self.ServerHandler.GetFileLocation()
     if (InstanceID == 0):
+      if (self.ClientHandler is not None):
+        self.ClientHandler.Disconnect()
       self.ClientHandler = None # pyright: ignore[reportAttributeAccessIssue]
       self.SetupClientConnection(RelayFileHandleLocation)
+      self.ClientHandler.StartEventDriven()
       self.ClientHandler.SendHello()
       return
     
@@ -275,9 +286,9 @@ class ScamGuard(DiscordBot):
     DatabaseAction:BanAction
     
     if (Action == ModerationAction.Ban):
-      DatabaseAction = self.Database.AddBan(TargetId, Sender.name, Sender.id, ThreadId)
+      DatabaseAction = await self.AsyncDatabase.AddBan(TargetId, Sender.name, Sender.id, ThreadId)
     elif (Action == ModerationAction.Unban):
-      DatabaseAction = self.Database.RemoveBan(TargetId)
+      DatabaseAction = await self.AsyncDatabase.RemoveBan(TargetId)
     else:
       Logger.Log(LogLevel.Error, f"An invalid moderation action was passed to HandleBanAction, {Action}")
       return BanAction.DBError
@@ -305,15 +316,15 @@ class ScamGuard(DiscordBot):
     else:
       self.ClientHandler.SendReprocessInstanceBans(InstanceId=InstanceID, InNumToRetry=LastActions)
 
-  async def ReprocessBansForServer(self, ServerId:int, LastActions:int=0, HandlingCooldown:bool=False) -> BanResult:
-    TargetBotId:int|None = self.Database.GetBotIdForServer(ServerId)
+  async def ReprocessBansForServer(self, ServerId:int, LastActions:int=0, HandlingCooldown:bool=False, Force:bool=False) -> BanResult:
+    TargetBotId:int|None = await self.AsyncDatabase.GetBotIdForServer(ServerId)
     if (TargetBotId == self.BotID):
-      return await self.ReprocessBans(ServerId, LastActions, HandlingCooldown)
+      return await self.ReprocessBans(ServerId, LastActions, HandlingCooldown, Force)
     elif (TargetBotId is None):
       return BanResult.Error
     else:
       self.ClientHandler.SendReprocessBans(ServerId, InstanceId=TargetBotId, 
-                                           InNumToRetry=LastActions, InHandlingCooldown=HandlingCooldown)
+                                           InNumToRetry=LastActions, InHandlingCooldown=HandlingCooldown, InForce=Force)
       return BanResult.Processed
     
   async def PropagateActionToServers(self, TargetId:int, Sender:Member|User, Action:ModerationAction):